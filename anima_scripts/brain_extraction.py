@@ -0,0 +1,191 @@
+# Atlas based brain extraction: the ICC atlas of the extra data folder is registered on the image (rigid, affine then
+# dense, first on the whole image then on its rough brain) and its brain mask resampled on it. Outputs are
+# <prefix>_brainMask.nrrd and <prefix>_masked.nrrd next to the image
+
+import os
+import shutil
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from anima_scripts.cache import computeKey, toolSignature
+from anima_scripts.images import imagePrefix, isLargeImage, readImageHeader
+from anima_scripts.pipeline import Pipeline
+from anima_scripts.resources import getResourceManager
+from anima_scripts.runner import getRunner
+from anima_scripts.scratch import getScratchPolicy
+
+
+def brainExtractionOutputs(brainImage):
+    brainImagePrefix = imagePrefix(brainImage)
+    return [brainImagePrefix + "_brainMask.nrrd", brainImagePrefix + "_masked.nrrd"]
+
+
+def brainExtractionPyramidOptions(brainImageHeader):
+    # Decide on whether to use large image setting or small image setting, from the image header only
+    if isLargeImage(brainImageHeader):
+        return ["-p", "5", "-l", "2"]
+
+    return ["-p", "4", "-l", "1"]
+
+
+def brainExtractionAtlas(configParser):
+    # Atlas image, masked atlas image and atlas brain mask
+    animaExtraDataDir = configParser.get("anima-scripts", 'extra-data-root')
+    return [animaExtraDataDir + "icc_atlas/Reference_T1.nrrd", animaExtraDataDir + "icc_atlas/Reference_T1_masked.nrrd",
+            animaExtraDataDir + "icc_atlas/BrainMask.nrrd"]
+
+
+def brainExtractionKey(configParser, brainImage, brainImageHeader=None):
+    # Same image, atlas, options and tools give the same masks: result cache key, also usable as a pipeline step key
+    animaDir = configParser.get("anima-scripts", 'anima')
+    if brainImageHeader is None:
+        brainImageHeader = readImageHeader(brainImage)
+
+    tools = ["animaPyramidalBMRegistration", "animaDenseSVFBMRegistration", "animaApplyTransformSerie",
+             "animaMaskImage"]
+    return computeKey([brainImage] + brainExtractionAtlas(configParser),
+                      ["brain-extraction"] + brainExtractionPyramidOptions(brainImageHeader) +
+                      [toolSignature(os.path.join(animaDir, tool)) for tool in tools])
+
+
+def extractBrain(configParser, brainImage, runner=None, resultCache=None):
+    # Commands are run by runner (within the cores held by the calling pipeline step if any), results are fetched from
+    # and stored to resultCache (see getCacheFromConfig) if given
+    runner = getRunner(configParser, runner)
+
+    animaDir = configParser.get("anima-scripts", 'anima')
+    animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
+    animaDenseSVFBMRegistration = os.path.join(animaDir, "animaDenseSVFBMRegistration")
+    animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
+    animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
+    animaMaskImage = os.path.join(animaDir, "animaMaskImage")
+
+    atlasImage, atlasImageMasked, iccImage = brainExtractionAtlas(configParser)
+
+    scratchPolicy = getScratchPolicy(configParser)
+    imgExt = scratchPolicy.intermediateExtension
+
+    print("Brain masking image: " + brainImage)
+
+    brainImagePrefix = imagePrefix(brainImage)
+    brainMask, maskedImage = brainExtractionOutputs(brainImage)
+    brainImageHeader = readImageHeader(brainImage)
+
+    # Intermediate files go to a private scratch folder so that several images (or several runs) never share them,
+    # about ten float images (and three displacement fields) are written there
+    tmpFolder = scratchPolicy.makeWorkDir("animaBrainExtraction_", 20 * brainImageHeader.numVoxels() * 4)
+    tmpImagePrefix = os.path.join(tmpFolder, os.path.basename(brainImagePrefix))
+
+    try:
+        pyramidOptions = brainExtractionPyramidOptions(brainImageHeader)
+
+        cacheKey = ""
+        if resultCache is not None:
+            cacheKey = brainExtractionKey(configParser, brainImage, brainImageHeader)
+            if resultCache.fetch(cacheKey, {"brainMask": brainMask, "masked": maskedImage}):
+                print("Brain mask of " + brainImage + " found in cache")
+                return
+
+        # Registrations are chained steps sharing the cores of the runner, each intermediate being deleted as soon as
+        # the last step using it is done
+        pipeline = Pipeline(runner, scratch=scratchPolicy.manager(tmpFolder))
+        chainCores = pipeline.maxCores
+
+        def addRegistrationSteps(name, atlas, reference, prefix):
+            # Rigid, affine then dense registration of atlas on reference, returns the transform serie
+            command = [animaPyramidalBMRegistration, "-m", atlas, "-r", reference, "-o", prefix + "_rig" + imgExt,
+                       "-O", prefix + "_rig_tr.txt", "--sp", "3"] + pyramidOptions
+            pipeline.addStep(name + "Rigid", command, inputs=[atlas, reference],
+                             outputs=[prefix + "_rig" + imgExt, prefix + "_rig_tr.txt"], cores=chainCores)
+
+            command = [animaPyramidalBMRegistration, "-m", atlas, "-r", reference, "-o", prefix + "_aff" + imgExt,
+                       "-O", prefix + "_aff_tr.txt", "-i", prefix + "_rig_tr.txt", "--sp", "3", "--ot",
+                       "2"] + pyramidOptions
+            pipeline.addStep(name + "Affine", command, inputs=[atlas, reference, prefix + "_rig_tr.txt"],
+                             outputs=[prefix + "_aff" + imgExt, prefix + "_aff_tr.txt"], cores=chainCores)
+
+            command = [animaDenseSVFBMRegistration, "-r", reference, "-m", prefix + "_aff" + imgExt, "-o",
+                       prefix + "_nl" + imgExt, "-O", prefix + "_nl_tr" + imgExt, "--sr", "1"] + pyramidOptions
+            pipeline.addStep(name + "Dense", command, inputs=[reference, prefix + "_aff" + imgExt],
+                             outputs=[prefix + "_nl" + imgExt, prefix + "_nl_tr" + imgExt], cores=chainCores)
+
+            # The serie only refers to the transform files, which stay needed until it is applied
+            command = [animaTransformSerieXmlGenerator, "-i", prefix + "_aff_tr.txt", "-i", prefix + "_nl_tr" + imgExt,
+                       "-o", prefix + "_nl_tr.xml"]
+            pipeline.addStep(name + "Serie", command, inputs=[prefix + "_aff_tr.txt", prefix + "_nl_tr" + imgExt],
+                             outputs=[prefix + "_nl_tr.xml"])
+
+            return [prefix + "_nl_tr.xml", prefix + "_aff_tr.txt", prefix + "_nl_tr" + imgExt]
+
+        # Rough mask with whole brain
+        roughTransform = addRegistrationSteps("rough", atlasImage, brainImage, tmpImagePrefix)
+
+        command = [animaApplyTransformSerie, "-i", iccImage, "-t", roughTransform[0], "-g", brainImage, "-o",
+                   tmpImagePrefix + "_rough_brainMask" + imgExt, "-n", "nearest"]
+        pipeline.addStep("roughMaskResampling", command, inputs=[iccImage, brainImage] + roughTransform,
+                         outputs=[tmpImagePrefix + "_rough_brainMask" + imgExt], cores=chainCores)
+
+        brainImageRoughMasked = tmpImagePrefix + "_rough_masked" + imgExt
+        command = [animaMaskImage, "-i", brainImage, "-m", tmpImagePrefix + "_rough_brainMask" + imgExt, "-o",
+                   brainImageRoughMasked]
+        pipeline.addStep("roughMasking", command, inputs=[brainImage, tmpImagePrefix + "_rough_brainMask" + imgExt],
+                         outputs=[brainImageRoughMasked])
+
+        # Fine mask with masked brain
+        fineTransform = addRegistrationSteps("fine", atlasImageMasked, brainImageRoughMasked,
+                                             tmpImagePrefix + "_fine")
+
+        command = [animaApplyTransformSerie, "-i", iccImage, "-t", fineTransform[0], "-g", brainImage, "-o",
+                   brainMask, "-n", "nearest"]
+        pipeline.addStep("maskResampling", command, inputs=[iccImage, brainImage] + fineTransform,
+                         outputs=[brainMask], cores=chainCores)
+
+        command = [animaMaskImage, "-i", brainImage, "-m", brainMask, "-o", maskedImage]
+        pipeline.addStep("masking", command, inputs=[brainImage, brainMask], outputs=[maskedImage])
+
+        if resultCache is not None:
+            cachedFiles = {"brainMask": brainMask, "masked": maskedImage, "affineTransform": fineTransform[1],
+                           "nonLinearTransform": fineTransform[2]}
+            pipeline.addStep("cacheStore", function=lambda: resultCache.store(cacheKey, cachedFiles),
+                             inputs=list(cachedFiles.values()))
+
+        pipeline.run()
+    finally:
+        shutil.rmtree(tmpFolder, ignore_errors=True)
+
+
+def extractBrains(configParser, images, runner=None, numJobs=1, resultCache=None):
+    # Brain masks of several images, numJobs of them (0: one per core) processed concurrently, each getting its share
+    # of the cores. Returns (image, error) pairs, a failure (its traceback as error) not stopping the other images
+    runner = getRunner(configParser, runner)
+    # Runners without a resource manager get the configured cores budget, as pipelines do
+    resources = getattr(runner, "resources", None)
+    if resources is None:
+        resources = getResourceManager(configParser)
+
+    if numJobs <= 0:
+        numJobs = resources.maxCores
+    numJobs = max(1, min(numJobs, len(images)))
+    chainCores = max(1, resources.maxCores // numJobs)
+
+    def extractBrainWorker(brainImage):
+        cores = resources.acquire(chainCores)
+        resources.setHeld(cores)
+        try:
+            extractBrain(configParser, brainImage, runner, resultCache)
+        except Exception:
+            return brainImage, traceback.format_exc()
+        finally:
+            resources.setHeld(0)
+            resources.release(cores)
+
+        return brainImage, ""
+
+    if numJobs > 1:
+        pool = ThreadPool(numJobs)
+        results = pool.map(extractBrainWorker, images, chunksize=1)
+        pool.close()
+        pool.join()
+        return results
+
+    return [extractBrainWorker(brainImage) for brainImage in images]
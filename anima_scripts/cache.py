@@ -0,0 +1,177 @@
+# On-disk cache of pipeline results, indexed by the content of their inputs and the options used to compute them
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+cacheVersion = "1"
+
+_hashLock = threading.Lock()
+_hashMemory = {}
+
+
+def hashFile(filePath):
+    # Files are hashed once per process for a given size and modification time
+    fileStat = os.stat(filePath)
+    memoryKey = (os.path.realpath(filePath), fileStat.st_size, fileStat.st_mtime)
+    with _hashLock:
+        if memoryKey in _hashMemory:
+            return _hashMemory[memoryKey]
+
+    fileHash = hashlib.sha256()
+    with open(filePath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            fileHash.update(block)
+
+    with _hashLock:
+        _hashMemory[memoryKey] = fileHash.hexdigest()
+
+    return fileHash.hexdigest()
+
+
+def computeKey(inputFiles, options):
+    # Key from input files content (order matters) and any list of options (strings)
+    keyHash = hashlib.sha256()
+    keyHash.update(("anima-cache-" + cacheVersion + "\n").encode('utf-8'))
+    for inputFile in inputFiles:
+        keyHash.update((hashFile(inputFile) + "\n").encode('utf-8'))
+    for option in options:
+        keyHash.update((str(option) + "\n").encode('utf-8'))
+
+    return keyHash.hexdigest()
+
+
+def toolSignature(toolPath):
+    # Stand-in for the tool version: changes whenever the binary is rebuilt
+    if not os.path.exists(toolPath):
+        return os.path.basename(toolPath)
+
+    toolStat = os.stat(toolPath)
+    return os.path.basename(toolPath) + ":" + str(toolStat.st_size) + ":" + str(int(toolStat.st_mtime))
+
+
+# Content-addressed store of result files, with a size limit (bytes, 0 for none) and least recently used eviction.
+# Each entry is a folder named after its key holding the result files and an entry.json listing them. Entries are
+# written to a temporary folder and renamed into place, so concurrent processes never see partial entries.
+class ResultCache(object):
+    def __init__(self, cacheDir, maxSize=0):
+        self.cacheDir = os.path.abspath(os.path.expanduser(cacheDir))
+        self.maxSize = maxSize
+        if not os.path.isdir(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                if not os.path.isdir(self.cacheDir):
+                    raise
+
+    def entryFolder(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def fetch(self, key, outputFiles):
+        # outputFiles maps result names to destination paths, returns False if the entry is not (fully) available
+        entryFolder = self.entryFolder(key)
+        entryFile = os.path.join(entryFolder, "entry.json")
+        if not os.path.exists(entryFile):
+            return False
+
+        try:
+            with open(entryFile) as f:
+                entryFiles = json.load(f)["files"]
+
+            for name in outputFiles:
+                if name not in entryFiles:
+                    return False
+
+            for name, destination in outputFiles.items():
+                shutil.copyfile(os.path.join(entryFolder, entryFiles[name]), destination)
+
+            # Marks the entry as recently used
+            os.utime(entryFile, None)
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+
+        return True
+
+    def store(self, key, resultFiles):
+        # resultFiles maps result names to the files to keep
+        entryFolder = self.entryFolder(key)
+        if os.path.exists(entryFolder):
+            return
+
+        tmpFolder = tempfile.mkdtemp(prefix="tmp-", dir=self.cacheDir)
+        try:
+            entryFiles = {}
+            for name, resultFile in resultFiles.items():
+                entryFiles[name] = name + "-" + os.path.basename(resultFile)
+                shutil.copyfile(resultFile, os.path.join(tmpFolder, entryFiles[name]))
+
+            with open(os.path.join(tmpFolder, "entry.json"), 'w') as f:
+                json.dump({"key": key, "files": entryFiles}, f)
+
+            parentFolder = os.path.dirname(entryFolder)
+            if not os.path.isdir(parentFolder):
+                try:
+                    os.makedirs(parentFolder)
+                except OSError:
+                    if not os.path.isdir(parentFolder):
+                        raise
+
+            os.rename(tmpFolder, entryFolder)
+        except OSError:
+            # Another process stored the same entry in the meantime
+            if not os.path.exists(entryFolder):
+                raise
+        finally:
+            shutil.rmtree(tmpFolder, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        if self.maxSize <= 0:
+            return
+
+        entries = []
+        totalSize = 0
+        for prefixFolder in os.listdir(self.cacheDir):
+            prefixPath = os.path.join(self.cacheDir, prefixFolder)
+            if prefixFolder.startswith("tmp-") or not os.path.isdir(prefixPath):
+                continue
+
+            for key in os.listdir(prefixPath):
+                entryFolder = os.path.join(prefixPath, key)
+                entryFile = os.path.join(entryFolder, "entry.json")
+                try:
+                    lastUse = os.path.getmtime(entryFile)
+                    entrySize = sum(os.path.getsize(os.path.join(entryFolder, fileName))
+                                    for fileName in os.listdir(entryFolder))
+                except OSError:
+                    continue
+
+                entries.append((lastUse, entrySize, entryFolder))
+                totalSize += entrySize
+
+        for lastUse, entrySize, entryFolder in sorted(entries):
+            if totalSize <= self.maxSize:
+                break
+
+            shutil.rmtree(entryFolder, ignore_errors=True)
+            totalSize -= entrySize
+
+
+def getCacheFromConfig(configParser, cacheDir="", maxSize=None):
+    # Returns the cache described in the configuration file (cache-dir, cache-size in GB), None if disabled
+    if cacheDir == "" and configParser.has_option("anima-scripts", "cache-dir"):
+        cacheDir = configParser.get("anima-scripts", "cache-dir")
+
+    if cacheDir == "":
+        return None
+
+    if maxSize is None:
+        maxSize = 0
+        if configParser.has_option("anima-scripts", "cache-size"):
+            maxSize = float(configParser.get("anima-scripts", "cache-size"))
+
+    return ResultCache(cacheDir, int(maxSize * (1 << 30)))
@@ -0,0 +1,22 @@
+# Configuration file of the Anima python scripts (~/.anima/config.txt, see example-config.txt), read once and passed
+# to the API functions so that a long-lived process does not read it again for each call
+
+import os
+import sys
+
+if sys.version_info[0] > 2:
+    import configparser as ConfParser
+else:
+    import ConfigParser as ConfParser
+
+
+def readConfig(configFilePath=""):
+    if configFilePath == "":
+        configFilePath = os.path.expanduser("~") + "/.anima/config.txt"
+
+    if not os.path.exists(configFilePath):
+        raise IOError('Please create a configuration file for Anima python scripts. Refer to the README')
+
+    configParser = ConfParser.RawConfigParser()
+    configParser.read(configFilePath)
+    return configParser
@@ -0,0 +1,298 @@
+# DWI preprocessing for model estimation: gradients reworking on Siemens from dicoms, Eddy current and susceptibility
+# distortion correction, denoising, brain masking and tensor estimation. Outputs are written next to the DWI image
+
+import os
+import shutil
+
+from anima_scripts.brain_extraction import brainExtractionKey, brainExtractionOutputs, extractBrain
+from anima_scripts.gradients import extractGradients, readImageOrientation
+from anima_scripts.images import compressImage, imagePrefix, readImageHeader
+from anima_scripts.manifest import Manifest
+from anima_scripts.pipeline import Pipeline
+from anima_scripts.runner import getRunner
+from anima_scripts.scratch import getScratchPolicy
+
+
+def preprocessDWI(configParser, dwiImage, bval, grad="", reverse="", direction=1, dicomFiles=(), t1="",
+                  distortionCorrection=True, denoising=True, brainMasking=True, eddyCorrection=True, workDir="",
+                  runner=None, resultCache=None):
+    # direction is the phase encoding direction (0: x, 1: y, 2: z). With a persistent workDir, intermediate files are
+    # kept there and a new call resumes from them. Brain extractions are run in this process, using resultCache if
+    # given. Returns the output files (preprocessed image and gradients, brain mask, tensors)
+    runner = getRunner(configParser, runner)
+
+    animaDir = configParser.get("anima-scripts", 'anima')
+    animaDataDir = configParser.get("anima-scripts", 'extra-data-root')
+
+    # Intermediate files go to the configured scratch folder and format
+    scratchPolicy = getScratchPolicy(configParser)
+    imgExt = scratchPolicy.intermediateExtension
+
+    # Check geometry before any heavy processing: one b-value is expected per volume
+    dwiHeader = readImageHeader(dwiImage)
+    print("DWI image " + dwiImage + ": " + "x".join(str(size) for size in dwiHeader.dimensions) + " voxels, " +
+          str(dwiHeader.numVolumes) + " volumes")
+
+    if os.path.exists(bval):
+        with open(bval) as bvalFile:
+            numBValues = len(bvalFile.read().split())
+        if numBValues != dwiHeader.numVolumes:
+            print("Warning: " + str(numBValues) + " b-values for " + str(dwiHeader.numVolumes) + " DWI volumes")
+
+    if grad == "" and len(dicomFiles) == 0:
+        raise ValueError("Gradient file needs to be provided (either through Dicom folder or through dcm2nii)")
+
+    # A persistent work folder keeps intermediate files and the manifest of completed steps, so that a new run only
+    # recomputes what changed
+    if workDir != "":
+        tmpFolder = os.path.abspath(workDir)
+        if not os.path.isdir(tmpFolder):
+            os.makedirs(tmpFolder)
+    else:
+        # About ten float copies of the DWI image are written along the way
+        tmpFolder = scratchPolicy.makeWorkDir("animaDiffusionPreprocessing_", 10 * dwiHeader.numVoxels() *
+                                              dwiHeader.numVolumes * 4)
+
+    dwiImagePrefix = imagePrefix(dwiImage)
+    tmpDWIImagePrefix = os.path.join(tmpFolder, os.path.basename(dwiImagePrefix))
+
+    outputImage = dwiImage
+    outputBVec = grad
+
+    if len(dicomFiles) > 0 and grad != "":
+        # adapted from http://neurohut.blogspot.fr/2015/11/how-to-extract-bval-bvec-from-dicom.html
+        # The goal here is to ensure the bvec file extracted from dcm2nii is well put
+        # back in real coordinates. This assumes dcm2nii worked for gradient extraction which is not always the case.
+        # If not, use the dicom folder option In any case, it works only for Siemens scanners though as far as I know
+        import numpy as np
+
+        orMatrix = readImageOrientation(dicomFiles[0])
+
+        bvecs = np.loadtxt(grad)
+        bvecs_corrected = np.dot(orMatrix.transpose(), bvecs)
+
+        np.savetxt(tmpDWIImagePrefix + "_real.bvec", bvecs_corrected, fmt="%.12f")
+        outputBVec = tmpDWIImagePrefix + "_real.bvec"
+
+    elif len(dicomFiles) > 0:
+        # Gradients from Siemens private tags, headers only and read in parallel
+        import numpy as np
+
+        gradientsCacheDir = ""
+        if configParser.has_option("anima-scripts", "cache-dir"):
+            gradientsCacheDir = configParser.get("anima-scripts", "cache-dir")
+
+        bvecs_corrected = extractGradients(dicomFiles, runner.resources.maxCores, gradientsCacheDir)
+        np.savetxt(tmpDWIImagePrefix + "_real.bvec", bvecs_corrected.transpose(), fmt="%.12f")
+        outputBVec = tmpDWIImagePrefix + "_real.bvec"
+
+    # Preprocessing steps are declared with their inputs and outputs, independent branches (e.g. T1 brain extraction
+    # and Eddy current correction) are then run concurrently within the cores budget
+    manifest = None
+    if workDir != "":
+        manifest = Manifest(os.path.join(tmpFolder, "pipelineManifest.json"))
+
+    pipeline = Pipeline(runner, 0, manifest, scratch=scratchPolicy.manager(tmpFolder))
+    heavyCores = max(1, pipeline.maxCores // 2)
+
+    # Distortion correction first
+    # Eddy current first
+    if eddyCorrection:
+        eddyCorrectionCommand = [animaDir + "animaEddyCurrentCorrection", "-i", dwiImage, "-I", outputBVec, "-o",
+                                 tmpDWIImagePrefix + "_eddy_corrected" + imgExt, \
+                                 "-O", tmpDWIImagePrefix + "_eddy_corrected.bvec", "-d", str(direction)]
+        pipeline.addStep("eddyCorrection", eddyCorrectionCommand, inputs=[dwiImage, outputBVec],
+                         outputs=[tmpDWIImagePrefix + "_eddy_corrected" + imgExt,
+                                  tmpDWIImagePrefix + "_eddy_corrected.bvec"],
+                         cores=heavyCores)
+
+        outputImage = tmpDWIImagePrefix + "_eddy_corrected" + imgExt
+        outputBVec = tmpDWIImagePrefix + "_eddy_corrected.bvec"
+
+    T1Prefix = ""
+    tmpT1Prefix = ""
+    if not t1 == "":
+        T1Prefix = imagePrefix(t1)
+        tmpT1Prefix = os.path.join(tmpFolder, os.path.basename(T1Prefix))
+
+    # Extract brain from T1 image if present (used for further processing), in this process within the step cores. Its
+    # key (atlas, options, tools) lets the manifest skip it only if the masks of the T1 are still those it would compute
+    if (distortionCorrection or brainMasking) and not t1 == "":
+        pipeline.addStep("t1BrainExtraction", function=lambda: extractBrain(configParser, t1, runner, resultCache),
+                         inputs=[t1], outputs=brainExtractionOutputs(t1), cores=heavyCores,
+                         key=[brainExtractionKey(configParser, t1)])
+
+    # The B0 is extracted once, for distortion correction and brain masking
+    b0Image = ""
+    maskB0Image = ""
+    if (distortionCorrection and (reverse != "" or t1 != "")) or brainMasking:
+        b0Image = tmpDWIImagePrefix + "_B0" + imgExt
+        b0ExtractCommand = [animaDir + "animaCropImage", "-i", outputImage, "-t", "0", "-T", "0", "-o", b0Image]
+        pipeline.addStep("b0Extraction", b0ExtractCommand, inputs=[outputImage], outputs=[b0Image])
+        maskB0Image = b0Image
+
+    # Rigid transform of the masked T1 on the B0, computed once for distortion correction or brain masking
+    t1Transform = ""
+
+    # Then susceptibility distortion
+    if distortionCorrection and (reverse != "" or t1 != ""):
+        correctedB0Image = tmpDWIImagePrefix + "_B0_corrected" + imgExt
+
+        if not (reverse == ""):
+            idTrsfName = os.path.join(animaDataDir, "id.txt")
+            idTrsfXmlName = os.path.join(tmpFolder, "id.xml")
+            idGenCommand = [animaDir + "animaTransformSerieXmlGenerator", "-i", idTrsfName, "-o", idTrsfXmlName]
+            pipeline.addStep("identityTransform", idGenCommand, inputs=[idTrsfName], outputs=[idTrsfXmlName])
+
+            resampleB0PACommand = [animaDir + "animaApplyTransformSerie", "-i", reverse, "-t", idTrsfXmlName, "-o",
+                                   tmpDWIImagePrefix + "_B0_Reverse" + imgExt, "-g", b0Image]
+            pipeline.addStep("reverseB0Resampling", resampleB0PACommand, inputs=[reverse, idTrsfXmlName, b0Image],
+                             outputs=[tmpDWIImagePrefix + "_B0_Reverse" + imgExt])
+
+            initCorrectionCommand = [animaDir + "animaDistortionCorrection", "-s", "2", "-d", str(direction), \
+                                     "-f", b0Image, "-b", tmpDWIImagePrefix + "_B0_Reverse" + imgExt, "-o",
+                                     tmpDWIImagePrefix + "_init_correction_tr" + imgExt]
+            pipeline.addStep("initialDistortionCorrection", initCorrectionCommand,
+                             inputs=[b0Image, tmpDWIImagePrefix + "_B0_Reverse" + imgExt],
+                             outputs=[tmpDWIImagePrefix + "_init_correction_tr" + imgExt])
+
+            bmCorrectionCommand = [animaDir + "animaBMDistortionCorrection", "-f", b0Image, \
+                                   "-b", tmpDWIImagePrefix + "_B0_Reverse" + imgExt, "-o", correctedB0Image, "-i",
+                                   tmpDWIImagePrefix + "_init_correction_tr" + imgExt, \
+                                   "--bs", "3", "-s", "10", "-d", str(direction), "-O",
+                                   tmpDWIImagePrefix + "_B0_correction_tr" + imgExt]
+            pipeline.addStep("bmDistortionCorrection", bmCorrectionCommand,
+                             inputs=[b0Image, tmpDWIImagePrefix + "_B0_Reverse" + imgExt,
+                                     tmpDWIImagePrefix + "_init_correction_tr" + imgExt],
+                             outputs=[correctedB0Image, tmpDWIImagePrefix + "_B0_correction_tr" + imgExt],
+                             cores=heavyCores)
+        else:
+            registeredT1 = tmpT1Prefix + "_rig" + imgExt
+            t1Transform = tmpT1Prefix + "_rig_tr.txt"
+            command = [animaDir + "animaPyramidalBMRegistration", "-r", b0Image, "-m", T1Prefix + "_masked.nrrd", "-o",
+                       registeredT1, "-O", t1Transform]
+            pipeline.addStep("t1ToB0Registration", command, inputs=[b0Image, T1Prefix + "_masked.nrrd"],
+                             outputs=[registeredT1, t1Transform], cores=heavyCores)
+
+            correctionCommand = [animaDir + "animaDenseSVFBMRegistration", "-r", registeredT1, \
+                                 "-m", b0Image, "-o", correctedB0Image, "-d", str(direction), \
+                                 "-O", tmpDWIImagePrefix + "_B0_correction_tr" + imgExt, "-t", "3"]
+            pipeline.addStep("t1DistortionCorrection", correctionCommand,
+                             inputs=[registeredT1, b0Image],
+                             outputs=[correctedB0Image, tmpDWIImagePrefix + "_B0_correction_tr" + imgExt],
+                             cores=heavyCores)
+
+        applyCorrectionCommand = [animaDir + "animaApplyDistortionCorrection", "-f", outputImage, "-t", \
+                                  tmpDWIImagePrefix + "_B0_correction_tr" + imgExt, "-o",
+                                  tmpDWIImagePrefix + "_corrected" + imgExt]
+        pipeline.addStep("distortionCorrection", applyCorrectionCommand,
+                         inputs=[outputImage, tmpDWIImagePrefix + "_B0_correction_tr" + imgExt],
+                         outputs=[tmpDWIImagePrefix + "_corrected" + imgExt])
+
+        outputImage = tmpDWIImagePrefix + "_corrected" + imgExt
+        maskB0Image = correctedB0Image
+
+    # Then re-orient image to be axial first
+    dwiReorientCommand = [animaDir + "animaConvertImage", "-i", outputImage, "-o", tmpDWIImagePrefix + "_or" + imgExt,
+                          "-R", "AXIAL"]
+    pipeline.addStep("reorientation", dwiReorientCommand, inputs=[outputImage],
+                     outputs=[tmpDWIImagePrefix + "_or" + imgExt])
+    outputImage = tmpDWIImagePrefix + "_or" + imgExt
+
+    # Then perform denoising
+    if denoising:
+        denoisingCommand = [animaDir + "animaNLMeansTemporal", "-i", outputImage, "-b", "0.5", "-o",
+                            tmpDWIImagePrefix + "_nlm" + imgExt]
+        pipeline.addStep("denoising", denoisingCommand, inputs=[outputImage],
+                         outputs=[tmpDWIImagePrefix + "_nlm" + imgExt], cores=heavyCores)
+        outputImage = tmpDWIImagePrefix + "_nlm" + imgExt
+
+    # Finally, brain mask image. The mask is computed on the B0 brought on the final grid: reorientation and denoising
+    # keep the physical space, so that the T1 to B0 transform also holds for the final DWI image
+    if brainMasking:
+        brainImage = tmpDWIImagePrefix + "_forBrainExtract" + imgExt
+        b0ReorientCommand = [animaDir + "animaConvertImage", "-i", maskB0Image, "-o", brainImage, "-R", "AXIAL"]
+        pipeline.addStep("maskingB0Reorientation", b0ReorientCommand, inputs=[maskB0Image], outputs=[brainImage])
+
+        if t1 == "":
+            pipeline.addStep("b0BrainExtraction",
+                             function=lambda: extractBrain(configParser, brainImage, runner, resultCache),
+                             inputs=[brainImage], outputs=[tmpDWIImagePrefix + "_forBrainExtract_brainMask.nrrd"],
+                             cores=heavyCores)
+
+            pipeline.addStep("brainMaskCopy",
+                             function=lambda: compressImage(tmpDWIImagePrefix + "_forBrainExtract_brainMask.nrrd",
+                                                            dwiImagePrefix + "_brainMask.nrrd",
+                                                            scratchPolicy.outputCompressionLevel),
+                             inputs=[tmpDWIImagePrefix + "_forBrainExtract_brainMask.nrrd"],
+                             outputs=[dwiImagePrefix + "_brainMask.nrrd"])
+        else:
+            # Without T1 based distortion correction, the T1 is registered on the (corrected) B0 for masking only
+            if t1Transform == "":
+                t1Transform = tmpT1Prefix + "_forMask_rig_tr.txt"
+                command = [animaDir + "animaPyramidalBMRegistration", "-r", maskB0Image, "-m",
+                           T1Prefix + "_masked.nrrd", "-o", tmpT1Prefix + "_forMask_rig" + imgExt, "-O", t1Transform,
+                           "-p", "4", "-l", "1", "--sp", "2", "-I", "0"]
+                pipeline.addStep("t1MaskRegistration", command, inputs=[maskB0Image, T1Prefix + "_masked.nrrd"],
+                                 outputs=[tmpT1Prefix + "_forMask_rig" + imgExt, t1Transform], cores=heavyCores)
+
+            t1TransformXml = os.path.splitext(t1Transform)[0] + ".xml"
+            command = [animaDir + "animaTransformSerieXmlGenerator", "-i", t1Transform, "-o", t1TransformXml]
+            pipeline.addStep("t1MaskTransform", command, inputs=[t1Transform], outputs=[t1TransformXml])
+
+            command = [animaDir + "animaApplyTransformSerie", "-i", T1Prefix + "_brainMask.nrrd", "-t",
+                       t1TransformXml, "-o", dwiImagePrefix + "_brainMask.nrrd", "-g", brainImage, "-n", "nearest"]
+            pipeline.addStep("t1MaskResampling", command,
+                             inputs=[T1Prefix + "_brainMask.nrrd", t1TransformXml, brainImage],
+                             outputs=[dwiImagePrefix + "_brainMask.nrrd"])
+
+        brainExtractionCommand = [animaDir + "animaMaskImage", "-i", outputImage, "-m",
+                                  dwiImagePrefix + "_brainMask.nrrd", "-o", tmpDWIImagePrefix + "_masked" + imgExt]
+        pipeline.addStep("dwiMasking", brainExtractionCommand,
+                         inputs=[outputImage, dwiImagePrefix + "_brainMask.nrrd"],
+                         outputs=[tmpDWIImagePrefix + "_masked" + imgExt])
+
+        outputImage = tmpDWIImagePrefix + "_masked" + imgExt
+
+    def copyPreprocessed(preprocessedImage, preprocessedBVec):
+        # Intermediates may be uncompressed or in another format than the final compressed nrrd output
+        if preprocessedImage.endswith(".nrrd"):
+            compressImage(preprocessedImage, dwiImagePrefix + "_preprocessed.nrrd",
+                          scratchPolicy.outputCompressionLevel)
+        else:
+            runner.run([animaDir + "animaConvertImage", "-i", preprocessedImage, "-o",
+                        dwiImagePrefix + "_preprocessed.nrrd"], "preprocessedConversion")
+        shutil.copy(preprocessedBVec, dwiImagePrefix + "_preprocessed.bvec")
+
+    preprocessedImage = outputImage
+    preprocessedBVec = outputBVec
+    pipeline.addStep("preprocessedCopy", function=lambda: copyPreprocessed(preprocessedImage, preprocessedBVec),
+                     inputs=[outputImage, outputBVec],
+                     outputs=[dwiImagePrefix + "_preprocessed.nrrd", dwiImagePrefix + "_preprocessed.bvec"])
+
+    # Estimate tensors if files were provided
+    dtiEstimationCommand = [animaDir + "animaDTIEstimator", "-i", outputImage, "-o", dwiImagePrefix + "_Tensors.nrrd",
+                            "-O", dwiImagePrefix + "_Tensors_B0.nrrd", "-N",
+                            dwiImagePrefix + "_Tensors_NoiseVariance.nrrd", "-g", outputBVec, "-b", bval]
+
+    dtiInputs = [outputImage, outputBVec, bval]
+    if brainMasking:
+        dtiEstimationCommand += ["-m", dwiImagePrefix + "_brainMask.nrrd"]
+        dtiInputs.append(dwiImagePrefix + "_brainMask.nrrd")
+
+    pipeline.addStep("dtiEstimation", dtiEstimationCommand, inputs=dtiInputs,
+                     outputs=[dwiImagePrefix + "_Tensors.nrrd", dwiImagePrefix + "_Tensors_B0.nrrd",
+                              dwiImagePrefix + "_Tensors_NoiseVariance.nrrd"],
+                     cores=heavyCores)
+
+    pipeline.run()
+
+    if workDir == "":
+        shutil.rmtree(tmpFolder)
+
+    outputs = {"preprocessed": dwiImagePrefix + "_preprocessed.nrrd",
+               "bvec": dwiImagePrefix + "_preprocessed.bvec", "tensors": dwiImagePrefix + "_Tensors.nrrd"}
+    if brainMasking:
+        outputs["brainMask"] = dwiImagePrefix + "_brainMask.nrrd"
+
+    return outputs
@@ -0,0 +1,116 @@
+# Extraction of the gradient table of Siemens diffusion series from DICOM headers: only the needed tags are parsed
+# (pixel data is never loaded), files are read by a pool of processes and tables are cached per series
+
+import hashlib
+import os
+import struct
+from multiprocessing import Pool
+
+# B-value, diffusion directionality, gradient direction (Siemens private tags), acquisition number, series UID
+bValueTag = 0x0019100c
+directionalityTag = 0x0019100d
+gradientDirectionTag = 0x0019100e
+acquisitionNumberTag = 0x00200012
+seriesUIDTag = 0x0020000e
+gradientTags = [bValueTag, directionalityTag, gradientDirectionTag, acquisitionNumberTag, seriesUIDTag]
+
+
+def _readDicomHeader(dicomFile, tags):
+    import pydicom
+
+    readFunction = getattr(pydicom, "dcmread", None) or pydicom.read_file
+    return readFunction(dicomFile, stop_before_pixels=True, specific_tags=tags)
+
+
+def _tagValue(image, tag, default=None):
+    if tag not in image:
+        return default
+
+    value = image[tag].value
+    if isinstance(value, bytes) and tag != gradientDirectionTag:
+        value = value.decode('latin-1').strip(" \0")
+
+    return value
+
+
+def readGradientInfo(dicomFile):
+    # Returns acquisition number, series UID and gradient direction (zero for b0 or non directional volumes)
+    image = _readDicomHeader(dicomFile, gradientTags)
+
+    bValue = float(_tagValue(image, bValueTag, 0))
+    direction = (0.0, 0.0, 0.0)
+    if _tagValue(image, directionalityTag, "NONE") != "NONE" and bValue != 0:
+        value = _tagValue(image, gradientDirectionTag)
+        if isinstance(value, bytes):
+            direction = struct.unpack('ddd', value[0:24])
+        else:
+            direction = tuple(float(component) for component in value)
+
+    return int(_tagValue(image, acquisitionNumberTag, -1)), str(_tagValue(image, seriesUIDTag, "")), direction
+
+
+def readImageOrientation(dicomFile):
+    # Image orientation (patient) direction cosines, as a 3x3 matrix whose rows are the row, column and slice axes
+    import numpy as np
+
+    orientation = _readDicomHeader(dicomFile, [0x00200037])[0x0020, 0x0037].value
+    rowAxis = np.array([float(value) for value in orientation[0:3]])
+    columnAxis = np.array([float(value) for value in orientation[3:6]])
+
+    return np.array([rowAxis, columnAxis, np.cross(rowAxis, columnAxis)])
+
+
+def _filesSignature(dicomFiles):
+    signature = hashlib.sha256()
+    for dicomFile in dicomFiles:
+        fileStat = os.stat(dicomFile)
+        signature.update((os.path.abspath(dicomFile) + ":" + str(fileStat.st_size) + ":" +
+                          str(int(fileStat.st_mtime)) + "\n").encode('utf-8'))
+
+    return signature.hexdigest()
+
+
+def extractGradients(dicomFiles, numProcesses=1, cacheDir=""):
+    # Gradient directions (n x 3) of the volumes of a series, files being sorted by name and consecutive files of the
+    # same acquisition giving a single volume. With a cache folder, tables are stored per series UID along with an
+    # index from the files (names, sizes, dates) to their series, so that a second extraction reads no DICOM at all
+    import numpy as np
+
+    dicomFiles = sorted(dicomFiles)
+    indexFile = ""
+    if cacheDir != "":
+        gradientsCacheDir = os.path.join(cacheDir, "gradients")
+        if not os.path.isdir(gradientsCacheDir):
+            os.makedirs(gradientsCacheDir)
+
+        indexFile = os.path.join(gradientsCacheDir, _filesSignature(dicomFiles) + ".series")
+        if os.path.exists(indexFile):
+            with open(indexFile) as f:
+                tableFile = os.path.join(gradientsCacheDir, f.read().strip() + ".bvec")
+            if os.path.exists(tableFile):
+                print("Gradient table read from cache " + tableFile)
+                return np.loadtxt(tableFile, ndmin=2).transpose()
+
+    if numProcesses > 1 and len(dicomFiles) > 1:
+        pool = Pool(min(numProcesses, len(dicomFiles)))
+        gradientInfos = pool.map(readGradientInfo, dicomFiles, chunksize=max(1, len(dicomFiles) // (4 * numProcesses)))
+        pool.close()
+        pool.join()
+    else:
+        gradientInfos = [readGradientInfo(dicomFile) for dicomFile in dicomFiles]
+
+    acquisitionNumbers = np.array([gradientInfo[0] for gradientInfo in gradientInfos])
+    directions = np.array([gradientInfo[2] for gradientInfo in gradientInfos], dtype=float).reshape(-1, 3)
+    keptFiles = np.concatenate(([True], acquisitionNumbers[1:] != acquisitionNumbers[:-1]))
+    gradients = directions[keptFiles]
+
+    seriesUID = gradientInfos[0][1] if len(gradientInfos) > 0 else ""
+    if indexFile != "" and seriesUID != "":
+        tableFile = os.path.join(os.path.dirname(indexFile), seriesUID + ".bvec")
+        np.savetxt(tableFile + ".tmp", gradients.transpose(), fmt="%.12f")
+        os.rename(tableFile + ".tmp", tableFile)
+        with open(indexFile + ".tmp", 'w') as f:
+            f.write(seriesUID + "\n")
+        os.rename(indexFile + ".tmp", indexFile)
+
+    return gradients
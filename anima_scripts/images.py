@@ -0,0 +1,433 @@
+# Image geometry read directly from NRRD and NIfTI headers, without loading voxel data nor launching any tool.
+# Voxel data can also be read and written (requires numpy) for the few operations done in python (e.g. mask splitting)
+
+import bz2
+import gzip
+import math
+import os
+import struct
+import zlib
+
+# NIfTI data type codes to (numpy like) pixel type names
+niftiDataTypes = {2: "uint8", 4: "int16", 8: "int32", 16: "float32", 64: "float64", 256: "int8", 512: "uint16",
+                  768: "uint32", 1024: "int64", 1280: "uint64"}
+
+pixelSizes = {"int8": 1, "uint8": 1, "int16": 2, "uint16": 2, "int32": 4, "uint32": 4, "int64": 8, "uint64": 8,
+              "float32": 4, "float64": 8}
+
+# NRRD type names to pixel type names
+nrrdDataTypes = {"signed char": "int8", "int8": "int8", "int8_t": "int8",
+                 "uchar": "uint8", "unsigned char": "uint8", "uint8": "uint8", "uint8_t": "uint8",
+                 "short": "int16", "short int": "int16", "signed short": "int16", "signed short int": "int16",
+                 "int16": "int16", "int16_t": "int16",
+                 "ushort": "uint16", "unsigned short": "uint16", "unsigned short int": "uint16", "uint16": "uint16",
+                 "uint16_t": "uint16",
+                 "int": "int32", "signed int": "int32", "int32": "int32", "int32_t": "int32",
+                 "uint": "uint32", "unsigned int": "uint32", "uint32": "uint32", "uint32_t": "uint32",
+                 "longlong": "int64", "long long": "int64", "long long int": "int64", "signed long long": "int64",
+                 "signed long long int": "int64", "int64": "int64", "int64_t": "int64",
+                 "ulonglong": "uint64", "unsigned long long": "uint64", "unsigned long long int": "uint64",
+                 "uint64": "uint64", "uint64_t": "uint64",
+                 "float": "float32", "double": "float64"}
+
+
+class ImageHeader(object):
+    # Geometry of an image: spatial dimensions, spacing, origin and direction (LPS, one unit vector per axis), number of
+    # volumes (product of non spatial sizes, e.g. DWI gradients or vector components) and pixel type.
+    # fileFormat and fields keep the raw header information needed to read the voxels later on
+
+    def __init__(self, fileName, fileFormat, dimensions, spacing, origin, direction, numVolumes, pixelType, fields):
+        self.fileName = fileName
+        self.fileFormat = fileFormat
+        self.dimensions = dimensions
+        self.spacing = spacing
+        self.origin = origin
+        self.direction = direction
+        self.numVolumes = numVolumes
+        self.pixelType = pixelType
+        self.fields = fields
+
+    def numVoxels(self):
+        numVoxels = 1
+        for size in self.dimensions:
+            numVoxels *= size
+
+        return numVoxels
+
+    def dataSize(self):
+        # Size in bytes of the uncompressed voxel data, useful for memory estimates
+        return self.numVoxels() * self.numVolumes * pixelSizes.get(self.pixelType, 8)
+
+    def __repr__(self):
+        return "ImageHeader(" + self.fileName + ", dimensions=" + str(self.dimensions) + ", spacing=" + \
+               str(self.spacing) + ", volumes=" + str(self.numVolumes) + ", type=" + self.pixelType + ")"
+
+
+def readImageHeader(fileName):
+    if fileName.endswith(".nrrd") or fileName.endswith(".nhdr"):
+        return readNrrdHeader(fileName)
+    elif fileName.endswith(".nii") or fileName.endswith(".nii.gz"):
+        return readNiftiHeader(fileName)
+
+    raise ValueError("Unsupported image format (NRRD or NIfTI expected): " + fileName)
+
+
+def _parseNrrdVector(vectorString):
+    return [float(value) for value in vectorString.strip().strip("()").split(",")]
+
+
+def _splitNrrdVectors(valueString):
+    # Splits "(a,b,c) (d,e,f) none" into its items
+    items = []
+    for item in valueString.replace(") (", ")\n(").replace(")(", ")\n(").split():
+        if item.startswith("(") and not item.endswith(")"):
+            items.append(item)
+        elif len(items) > 0 and items[-1].startswith("(") and not items[-1].endswith(")"):
+            items[-1] += item
+        else:
+            items.append(item)
+
+    return items
+
+
+def readNrrdHeader(fileName):
+    fields = {}
+    headerSize = 0
+    with open(fileName, 'rb') as f:
+        magic = f.readline()
+        headerSize += len(magic)
+        if not magic.startswith(b"NRRD"):
+            raise ValueError("Not a NRRD file: " + fileName)
+
+        for line in iter(f.readline, b''):
+            headerSize += len(line)
+            line = line.decode('latin-1').rstrip("\r\n")
+            if line == "":
+                break
+            if line.startswith("#"):
+                continue
+
+            if ":=" in line:
+                key, value = line.split(":=", 1)
+                fields["keyvalue:" + key.strip()] = value.strip()
+            elif ": " in line:
+                key, value = line.split(": ", 1)
+                fields[key.strip().lower()] = value.strip()
+
+    fields["header size"] = headerSize
+
+    dimension = int(fields["dimension"])
+    sizes = [int(size) for size in fields["sizes"].split()]
+    kinds = fields.get("kinds", "").split()
+
+    # Axes with a space direction are spatial, others (list, vector, time...) are volumes
+    spatialAxes = []
+    axisDirections = {}
+    if "space directions" in fields:
+        directionItems = _splitNrrdVectors(fields["space directions"])
+        for axis in range(0, dimension):
+            if axis < len(directionItems) and directionItems[axis] != "none":
+                spatialAxes.append(axis)
+                axisDirections[axis] = _parseNrrdVector(directionItems[axis])
+    elif len(kinds) == dimension:
+        spatialAxes = [axis for axis in range(0, dimension) if kinds[axis] in ["domain", "space"]]
+    else:
+        spatialAxes = list(range(0, min(dimension, 3)))
+
+    nrrdSpacings = fields.get("spacings", "").split()
+    dimensions = []
+    spacing = []
+    direction = []
+    for axis in spatialAxes:
+        dimensions.append(sizes[axis])
+        if axis in axisDirections:
+            axisSpacing = math.sqrt(sum(value * value for value in axisDirections[axis]))
+            spacing.append(axisSpacing)
+            direction.append([value / axisSpacing if axisSpacing > 0 else 0 for value in axisDirections[axis]])
+        else:
+            axisSpacing = 1.0
+            if axis < len(nrrdSpacings) and nrrdSpacings[axis].lower() != "nan":
+                axisSpacing = float(nrrdSpacings[axis])
+            spacing.append(axisSpacing)
+            direction.append([1.0 if i == len(direction) else 0.0 for i in range(0, len(spatialAxes))])
+
+    # RAS spaces are flipped to LPS, as is done for NIfTI
+    space = fields.get("space", "left-posterior-superior").lower()
+    flip = [1.0, 1.0, 1.0]
+    if space in ["right-anterior-superior", "ras", "scanner-xyz"]:
+        flip = [-1.0, -1.0, 1.0]
+    elif space in ["left-anterior-superior", "las"]:
+        flip = [1.0, -1.0, 1.0]
+    direction = [[value * flip[i] if i < 3 else value for i, value in enumerate(axisDirection)]
+                 for axisDirection in direction]
+
+    origin = [0.0] * len(spatialAxes)
+    if "space origin" in fields:
+        origin = [value * flip[i] if i < 3 else value
+                  for i, value in enumerate(_parseNrrdVector(fields["space origin"]))]
+
+    numVolumes = 1
+    for axis in range(0, dimension):
+        if axis not in spatialAxes:
+            numVolumes *= sizes[axis]
+
+    fields["spatial axes"] = spatialAxes
+    fields["shape"] = sizes
+
+    return ImageHeader(fileName, "nrrd", tuple(dimensions), tuple(spacing), tuple(origin),
+                       tuple(tuple(axisDirection) for axisDirection in direction), numVolumes,
+                       nrrdDataTypes.get(fields["type"].lower(), fields["type"]), fields)
+
+
+def _openMaybeCompressed(fileName):
+    if fileName.endswith(".gz"):
+        return gzip.open(fileName, 'rb')
+
+    return open(fileName, 'rb')
+
+
+def readNiftiHeader(fileName):
+    # Only the header bytes are read, which for compressed files means decompressing the first block only
+    with _openMaybeCompressed(fileName) as f:
+        headerBytes = f.read(540)
+
+    if len(headerBytes) < 348:
+        raise ValueError("Truncated NIfTI header: " + fileName)
+
+    endian = "<"
+    headerSize = struct.unpack(endian + "i", headerBytes[0:4])[0]
+    if headerSize not in [348, 540]:
+        endian = ">"
+        headerSize = struct.unpack(endian + "i", headerBytes[0:4])[0]
+
+    if headerSize == 348:
+        dims = struct.unpack(endian + "8h", headerBytes[40:56])
+        dataType = struct.unpack(endian + "h", headerBytes[70:72])[0]
+        pixdim = struct.unpack(endian + "8f", headerBytes[76:108])
+        voxOffset = int(struct.unpack(endian + "f", headerBytes[108:112])[0])
+        sclSlope, sclInter = struct.unpack(endian + "2f", headerBytes[112:120])
+        qformCode, sformCode = struct.unpack(endian + "2h", headerBytes[252:256])
+        quaternion = struct.unpack(endian + "6f", headerBytes[256:280])
+        srows = struct.unpack(endian + "12f", headerBytes[280:328])
+    elif headerSize == 540 and len(headerBytes) == 540:
+        dataType = struct.unpack(endian + "h", headerBytes[12:14])[0]
+        dims = struct.unpack(endian + "8q", headerBytes[16:80])
+        pixdim = struct.unpack(endian + "8d", headerBytes[104:168])
+        voxOffset = struct.unpack(endian + "q", headerBytes[168:176])[0]
+        sclSlope, sclInter = struct.unpack(endian + "2d", headerBytes[176:192])
+        qformCode, sformCode = struct.unpack(endian + "2i", headerBytes[344:352])
+        quaternion = struct.unpack(endian + "6d", headerBytes[352:400])
+        srows = struct.unpack(endian + "12d", headerBytes[400:496])
+    else:
+        raise ValueError("Not a NIfTI file: " + fileName)
+
+    numDimensions = dims[0]
+    numSpatialDimensions = min(numDimensions, 3)
+    dimensions = tuple(int(dims[i]) for i in range(1, numSpatialDimensions + 1))
+    spacing = tuple(float(abs(pixdim[i])) for i in range(1, numSpatialDimensions + 1))
+
+    numVolumes = 1
+    for i in range(4, numDimensions + 1):
+        numVolumes *= max(int(dims[i]), 1)
+
+    # Voxel to RAS matrix as done by ITK: sform first, then qform, then spacing only
+    if sformCode > 0:
+        matrix = [list(srows[0:3]), list(srows[4:7]), list(srows[8:11])]
+        offset = [srows[3], srows[7], srows[11]]
+    elif qformCode > 0:
+        b, c, d = quaternion[0:3]
+        a = math.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+        qfac = -1.0 if pixdim[0] < 0 else 1.0
+        rotation = [[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                    [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+                    [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]]
+        scales = [pixdim[1], pixdim[2], pixdim[3] * qfac]
+        matrix = [[rotation[i][j] * scales[j] for j in range(0, 3)] for i in range(0, 3)]
+        offset = list(quaternion[3:6])
+    else:
+        matrix = [[pixdim[j + 1] if i == j else 0.0 for j in range(0, 3)] for i in range(0, 3)]
+        offset = [0.0, 0.0, 0.0]
+
+    # RAS to LPS, one unit vector per image axis
+    flip = [-1.0, -1.0, 1.0]
+    direction = []
+    for j in range(0, numSpatialDimensions):
+        column = [matrix[i][j] * flip[i] for i in range(0, 3)]
+        norm = math.sqrt(sum(value * value for value in column))
+        direction.append(tuple(value / norm if norm > 0 else 0.0 for value in column))
+    origin = tuple(offset[i] * flip[i] for i in range(0, 3))
+
+    fields = {"endian": endian, "header size": headerSize, "vox offset": voxOffset, "data type": dataType,
+              "scl slope": sclSlope, "scl inter": sclInter, "dim": tuple(int(value) for value in dims),
+              "compressed": fileName.endswith(".gz"), "spatial axes": list(range(0, numSpatialDimensions)),
+              "shape": [max(int(dims[i]), 1) for i in range(1, numDimensions + 1)]}
+
+    return ImageHeader(fileName, "nifti", dimensions, spacing, origin, tuple(direction), numVolumes,
+                       niftiDataTypes.get(dataType, str(dataType)), fields)
+
+
+def imagePrefix(fileName):
+    # File name without its image extension (.nrrd, .nii, .nii.gz...), to which output suffixes are appended
+    prefix = os.path.splitext(fileName)[0]
+    if os.path.splitext(fileName)[1] == '.gz':
+        prefix = os.path.splitext(prefix)[0]
+
+    return prefix
+
+
+def isLargeImage(header, threshold=256):
+    return any(size >= threshold for size in header.dimensions)
+
+
+# Voxel data is returned as a numpy array of shape header.fields["shape"] (file axes order, first axis fastest)
+
+def readImage(fileName):
+    import numpy as np
+
+    header = readImageHeader(fileName)
+    shape = header.fields["shape"]
+    numValues = 1
+    for size in shape:
+        numValues *= size
+
+    if header.fileFormat == "nrrd":
+        fields = header.fields
+        byteOrder = ">" if fields.get("endian", "little").lower() == "big" else "<"
+        dataType = np.dtype(header.pixelType).newbyteorder(byteOrder)
+        encoding = fields.get("encoding", "raw").lower()
+
+        dataFile = fileName
+        offset = fields["header size"]
+        if "data file" in fields:
+            if fields["data file"].split()[0] == "LIST" or len(fields["data file"].split()) > 1:
+                raise ValueError("Multiple NRRD data files are not supported: " + fileName)
+            dataFile = os.path.join(os.path.dirname(fileName), fields["data file"])
+            offset = 0
+
+        with open(dataFile, 'rb') as f:
+            f.seek(offset)
+            rawData = f.read()
+
+        if encoding in ["gzip", "gz"]:
+            rawData = zlib.decompress(rawData, 16 + zlib.MAX_WBITS)
+        elif encoding in ["bzip2", "bz2"]:
+            rawData = bz2.decompress(rawData)
+        elif encoding in ["ascii", "text", "txt"]:
+            return header, np.array(rawData.split(), dtype=dataType).reshape(shape, order='F')
+
+        byteSkip = int(fields.get("byte skip", "0"))
+        if byteSkip == -1:
+            rawData = rawData[len(rawData) - numValues * dataType.itemsize:]
+        elif byteSkip > 0:
+            rawData = rawData[byteSkip:]
+
+        data = np.frombuffer(rawData, dtype=dataType, count=numValues).reshape(shape, order='F')
+        return header, data
+
+    fields = header.fields
+    dataType = np.dtype(header.pixelType).newbyteorder(fields["endian"])
+    with _openMaybeCompressed(fileName) as f:
+        rawData = f.read()
+
+    data = np.frombuffer(rawData, dtype=dataType, count=numValues,
+                         offset=fields["vox offset"]).reshape(shape, order='F')
+    if fields["scl slope"] not in [0.0, 1.0] or fields["scl inter"] != 0.0:
+        data = data * fields["scl slope"] + fields["scl inter"]
+
+    return header, data
+
+
+nrrdTypeNames = {"int8": "int8", "uint8": "uint8", "int16": "short", "uint16": "ushort", "int32": "int",
+                 "uint32": "uint", "int64": "longlong", "uint64": "ulonglong", "float32": "float", "float64": "double"}
+
+niftiTypeCodes = dict((pixelType, code) for code, pixelType in niftiDataTypes.items())
+
+
+def writeImage(fileName, data, templateHeader, compressionLevel=6):
+    # Writes data with the geometry (and any other header information) of a template image of the same shape and
+    # format. NRRD files are written with attached data, gzip encoded unless compressionLevel is 0
+    import numpy as np
+
+    data = np.asarray(data)
+    if list(data.shape) != list(templateHeader.fields["shape"]):
+        raise ValueError("Image shape " + str(data.shape) + " does not match template " + templateHeader.fileName)
+
+    pixelType = data.dtype.name
+    if pixelType not in nrrdTypeNames:
+        raise ValueError("Unsupported pixel type: " + pixelType)
+
+    rawData = data.astype(data.dtype.newbyteorder("<")).tobytes(order='F')
+
+    if templateHeader.fileFormat == "nrrd":
+        if not fileName.endswith(".nrrd"):
+            raise ValueError("NRRD template images are written as .nrrd files: " + fileName)
+
+        fields = templateHeader.fields
+        lines = ["NRRD0004", "type: " + nrrdTypeNames[pixelType], "dimension: " + fields["dimension"]]
+        for key in ["space", "space dimension"]:
+            if key in fields:
+                lines.append(key + ": " + fields[key])
+        lines.append("sizes: " + fields["sizes"])
+
+        skippedKeys = ["type", "dimension", "space", "space dimension", "sizes", "endian", "encoding", "data file",
+                       "datafile", "byte skip", "byteskip", "line skip", "lineskip", "header size", "spatial axes",
+                       "shape", "content"]
+        keyValues = []
+        for key in sorted(fields.keys()):
+            if key in skippedKeys:
+                continue
+            if key.startswith("keyvalue:"):
+                keyValues.append(key[len("keyvalue:"):] + ":=" + fields[key])
+            else:
+                lines.append(key + ": " + fields[key])
+
+        lines.append("endian: little")
+        if compressionLevel > 0:
+            lines.append("encoding: gzip")
+            rawData = _gzipCompress(rawData, compressionLevel)
+        else:
+            lines.append("encoding: raw")
+
+        with open(fileName, 'wb') as f:
+            f.write(("\n".join(lines + keyValues) + "\n\n").encode('latin-1'))
+            f.write(rawData)
+        return
+
+    if not (fileName.endswith(".nii") or fileName.endswith(".nii.gz")):
+        raise ValueError("NIfTI template images are written as .nii or .nii.gz files: " + templateHeader.fileName)
+
+    fields = templateHeader.fields
+    with _openMaybeCompressed(templateHeader.fileName) as f:
+        headerBytes = bytearray(f.read(fields["vox offset"]))
+
+    # Data is written little endian without scaling, whatever the template
+    endian = fields["endian"]
+    if fields["header size"] == 348:
+        struct.pack_into(endian + "2h", headerBytes, 70, niftiTypeCodes[pixelType], data.dtype.itemsize * 8)
+        struct.pack_into(endian + "2f", headerBytes, 112, 1.0, 0.0)
+    else:
+        struct.pack_into(endian + "2h", headerBytes, 12, niftiTypeCodes[pixelType], data.dtype.itemsize * 8)
+        struct.pack_into(endian + "2d", headerBytes, 176, 1.0, 0.0)
+
+    if endian != "<":
+        rawData = data.astype(data.dtype.newbyteorder(endian)).tobytes(order='F')
+
+    if fileName.endswith(".gz"):
+        with gzip.open(fileName, 'wb', compressionLevel if compressionLevel > 0 else 1) as f:
+            f.write(bytes(headerBytes))
+            f.write(rawData)
+    else:
+        with open(fileName, 'wb') as f:
+            f.write(bytes(headerBytes))
+            f.write(rawData)
+
+
+def compressImage(fileName, outputFile, compressionLevel=6):
+    # Copy of an image in the same format, its data compressed at compressionLevel (0 for none)
+    header, data = readImage(fileName)
+    writeImage(outputFile, data, header, compressionLevel)
+
+
+def _gzipCompress(rawData, compressionLevel):
+    compressor = zlib.compressobj(compressionLevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(rawData) + compressor.flush()
@@ -0,0 +1,375 @@
+# Local job queue: jobs (brain extraction, DWI preprocessing, MCM estimation, MS exam preparation) are submitted to a
+# daemon over a unix socket and kept in an SQLite database, so that they survive restarts. The daemon runs them in this
+# process on a fixed pool of workers, highest priority first, each job reserving its cores in the daemon budget.
+# Identical submissions (same kind, parameters and input files) are answered with the existing job
+
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    stringTypes = basestring
+except NameError:
+    stringTypes = str
+
+from anima_scripts.brain_extraction import extractBrain
+from anima_scripts.cache import getCacheFromConfig
+from anima_scripts.dwi_preprocessing import preprocessDWI
+from anima_scripts.mcm_estimation import estimateMCM
+from anima_scripts.ms_exam import prepareExam
+
+# Job kinds: API function, required parameters (keyword arguments of the function) and whether it uses the results cache
+jobKinds = {
+    "brainExtraction": (extractBrain, ["brainImage"], True),
+    "dwiPreprocessing": (preprocessDWI, ["dwiImage", "bval"], True),
+    "mcmEstimation": (estimateMCM, ["dwiImage", "bval", "bvec"], False),
+    "msExam": (prepareExam, ["reference", "flair", "t1", "t1Gd"], True),
+}
+
+jobStatuses = ["queued", "running", "done", "failed"]
+
+
+def getQueuePaths(configParser):
+    # Optional keys of the anima-scripts section: queue-socket and queue-database (default: in ~/.anima)
+    socketPath = os.path.expanduser("~") + "/.anima/jobqueue.sock"
+    if configParser.has_option("anima-scripts", "queue-socket"):
+        socketPath = configParser.get("anima-scripts", "queue-socket")
+
+    databaseFile = os.path.expanduser("~") + "/.anima/jobqueue.db"
+    if configParser.has_option("anima-scripts", "queue-database"):
+        databaseFile = configParser.get("anima-scripts", "queue-database")
+
+    return socketPath, databaseFile
+
+
+def jobSignature(kind, parameters):
+    # Kind, parameters and size and modification time of the files they name: resubmitting a job after its inputs
+    # changed creates a new job
+    signatureHash = hashlib.sha256()
+    signatureHash.update(json.dumps([kind, parameters], sort_keys=True).encode('utf-8'))
+    values = list(parameters.values())
+    while len(values) > 0:
+        value = values.pop(0)
+        if isinstance(value, (list, tuple)):
+            values += list(value)
+        elif isinstance(value, stringTypes) and os.path.isfile(value):
+            fileStat = os.stat(value)
+            signatureHash.update((value + ":" + str(fileStat.st_size) + ":" + str(fileStat.st_mtime)).encode('utf-8'))
+
+    return signatureHash.hexdigest()
+
+
+class JobStore(object):
+    # Jobs table of the SQLite database, used from several threads through a single connection
+
+    def __init__(self, databaseFile):
+        self.databaseFile = databaseFile
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(databaseFile, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                    "kind TEXT NOT NULL, parameters TEXT NOT NULL, signature TEXT NOT NULL, "
+                                    "priority INTEGER NOT NULL DEFAULT 0, cores INTEGER NOT NULL DEFAULT 1, "
+                                    "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                                    "submitTime REAL NOT NULL, startTime REAL, endTime REAL, error TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobsSignature ON jobs (signature)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobsStatus ON jobs (status, priority)")
+            self.connection.commit()
+
+    def _jobDict(self, row):
+        job = dict((key, row[key]) for key in row.keys())
+        job["parameters"] = json.loads(job["parameters"])
+        return job
+
+    def requeueInterrupted(self):
+        # Jobs left running by a stopped daemon are run again
+        with self.lock:
+            count = self.connection.execute("UPDATE jobs SET status = 'queued', startTime = NULL "
+                                            "WHERE status = 'running'").rowcount
+            self.connection.commit()
+        return count
+
+    def submit(self, kind, parameters, priority=0, cores=1, maxQueued=0):
+        # Returns the job and whether it was already submitted (queued, running or done). Raises ValueError if the
+        # queue holds maxQueued jobs already (0: no limit)
+        signature = jobSignature(kind, parameters)
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM jobs WHERE signature = ? AND status != 'failed' "
+                                          "ORDER BY id DESC LIMIT 1", (signature,)).fetchone()
+            if row is not None:
+                return self._jobDict(row), True
+
+            if maxQueued > 0:
+                numQueued = self.connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+                if numQueued >= maxQueued:
+                    raise ValueError("Queue full (" + str(numQueued) + " queued jobs), submit again later")
+
+            jobId = self.connection.execute("INSERT INTO jobs (kind, parameters, signature, priority, cores, status, "
+                                            "submitTime) VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+                                            (kind, json.dumps(parameters, sort_keys=True), signature, priority,
+                                             cores, time.time())).lastrowid
+            self.connection.commit()
+            row = self.connection.execute("SELECT * FROM jobs WHERE id = ?", (jobId,)).fetchone()
+
+        return self._jobDict(row), False
+
+    def queuedJobs(self):
+        # Highest priority first, then in submission order
+        with self.lock:
+            rows = self.connection.execute("SELECT * FROM jobs WHERE status = 'queued' "
+                                           "ORDER BY priority DESC, id ASC").fetchall()
+        return [self._jobDict(row) for row in rows]
+
+    def markRunning(self, jobId):
+        with self.lock:
+            self.connection.execute("UPDATE jobs SET status = 'running', startTime = ?, attempts = attempts + 1 "
+                                    "WHERE id = ?", (time.time(), jobId))
+            self.connection.commit()
+
+    def finish(self, jobId, error=""):
+        with self.lock:
+            self.connection.execute("UPDATE jobs SET status = ?, endTime = ?, error = ? WHERE id = ?",
+                                    ("done" if error == "" else "failed", time.time(), error, jobId))
+            self.connection.commit()
+
+    def job(self, jobId):
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM jobs WHERE id = ?", (jobId,)).fetchone()
+        return None if row is None else self._jobDict(row)
+
+    def recentJobs(self, limit=20, status=""):
+        query = "SELECT * FROM jobs"
+        arguments = ()
+        if status != "":
+            query += " WHERE status = ?"
+            arguments = (status,)
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY id DESC LIMIT ?", arguments + (limit,)).fetchall()
+        return [self._jobDict(row) for row in rows]
+
+    def stats(self, window=3600.0):
+        # Queue depth per status and priority, and throughput, wait and run times of the jobs ended within window
+        now = time.time()
+        with self.lock:
+            counts = dict((row[0], row[1]) for row in
+                          self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+            queuedByPriority = dict((str(row[0]), row[1]) for row in
+                                    self.connection.execute("SELECT priority, COUNT(*) FROM jobs "
+                                                            "WHERE status = 'queued' GROUP BY priority"))
+            ended = self.connection.execute("SELECT status, submitTime, startTime, endTime FROM jobs "
+                                            "WHERE endTime >= ?", (now - window,)).fetchall()
+
+        doneJobs = [row for row in ended if row["status"] == "done"]
+        stats = {"counts": dict((status, counts.get(status, 0)) for status in jobStatuses),
+                 "queuedByPriority": queuedByPriority, "window": window,
+                 "doneInWindow": len(doneJobs), "failedInWindow": len(ended) - len(doneJobs),
+                 "throughputPerHour": len(doneJobs) * 3600.0 / window, "meanWaitTime": 0.0, "meanRunTime": 0.0}
+        if len(ended) > 0:
+            stats["meanWaitTime"] = sum(row["startTime"] - row["submitTime"] for row in ended) / len(ended)
+            stats["meanRunTime"] = sum(row["endTime"] - row["startTime"] for row in ended) / len(ended)
+
+        return stats
+
+
+class JobQueue(object):
+    # Runs queued jobs on numWorkers worker threads. A job starts once its cores are free in the budget of the runner
+    # resource manager (jobs larger than the budget run alone), its commands then share these cores
+
+    def __init__(self, configParser, store, runner, numWorkers=1, defaultCores=1, maxQueued=0):
+        self.configParser = configParser
+        self.store = store
+        self.runner = runner
+        self.numWorkers = max(1, numWorkers)
+        self.defaultCores = max(1, defaultCores)
+        self.maxQueued = maxQueued
+        self.resultCache = getCacheFromConfig(configParser)
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.runningJobs = {}
+        self.workers = []
+
+    def submit(self, kind, parameters, priority=0, cores=0):
+        if kind not in jobKinds:
+            raise ValueError("Unknown job kind " + str(kind) + " (choose among " + ", ".join(sorted(jobKinds)) + ")")
+        missing = [name for name in jobKinds[kind][1] if name not in parameters]
+        if len(missing) > 0:
+            raise ValueError("Missing " + kind + " parameter(s): " + ", ".join(missing))
+        # Required parameters are input files, the daemon working directory being unrelated to the submitter one
+        for name in jobKinds[kind][1]:
+            if not (isinstance(parameters[name], stringTypes) and os.path.isabs(parameters[name]) and
+                    os.path.isfile(parameters[name])):
+                raise ValueError(kind + " parameter " + name + " is not an existing file given by its absolute path: " +
+                                 str(parameters[name]))
+
+        job, duplicate = self.store.submit(kind, parameters, priority, cores if cores > 0 else self.defaultCores,
+                                           self.maxQueued)
+        with self.condition:
+            self.condition.notify_all()
+
+        return job, duplicate
+
+    def claimJob(self):
+        # Highest priority queued job whose cores are free, smaller ones filling the cores left by larger ones
+        for job in self.store.queuedJobs():
+            cores = self.runner.resources.tryAcquire(job["cores"])
+            if cores > 0:
+                self.store.markRunning(job["id"])
+                self.runningJobs[job["id"]] = cores
+                return job, cores
+
+        return None, 0
+
+    def runJob(self, job, cores):
+        function, requiredParameters, usesCache = jobKinds[job["kind"]]
+        parameters = dict((str(name), value) for name, value in job["parameters"].items())
+        if usesCache:
+            parameters["resultCache"] = self.resultCache
+
+        print("Starting job " + str(job["id"]) + " (" + job["kind"] + ", " + str(cores) + " cores)")
+        error = ""
+        self.runner.resources.setHeld(cores)
+        try:
+            function(self.configParser, runner=self.runner, **parameters)
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            self.runner.resources.setHeld(0)
+            self.runner.resources.release(cores)
+
+        self.store.finish(job["id"], error)
+        print("Job " + str(job["id"]) + (" done" if error == "" else " failed:\n" + error))
+
+    def worker(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopping:
+                        return
+                    job, cores = self.claimJob()
+                    if job is not None:
+                        break
+                    # Cores released by jobs wake workers up, submissions as well
+                    self.condition.wait(1.0)
+
+            try:
+                self.runJob(job, cores)
+            finally:
+                with self.condition:
+                    del self.runningJobs[job["id"]]
+                    self.condition.notify_all()
+
+    def start(self):
+        numRequeued = self.store.requeueInterrupted()
+        if numRequeued > 0:
+            print(str(numRequeued) + " interrupted job(s) queued again")
+
+        for index in range(0, self.numWorkers):
+            thread = threading.Thread(target=self.worker, name="jobWorker" + str(index))
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def stop(self):
+        # Running jobs are not interrupted, they are queued again when the daemon restarts
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+    def stats(self):
+        stats = self.store.stats()
+        with self.condition:
+            stats["runningJobs"] = len(self.runningJobs)
+            stats["reservedCores"] = sum(self.runningJobs.values())
+        stats["workers"] = self.numWorkers
+        stats["maxCores"] = self.runner.resources.maxCores
+        return stats
+
+    def handleRequest(self, request):
+        action = request.get("action", "")
+        if action == "submit":
+            job, duplicate = self.submit(request.get("kind", ""), request.get("parameters", {}),
+                                         int(request.get("priority", 0)), int(request.get("cores", 0)))
+            return {"job": job, "duplicate": duplicate}
+        if action == "status":
+            if request.get("id") is not None:
+                job = self.store.job(int(request["id"]))
+                if job is None:
+                    raise ValueError("No job " + str(request["id"]))
+                return {"jobs": [job]}
+            return {"jobs": self.store.recentJobs(int(request.get("limit", 20)), request.get("status", ""))}
+        if action == "stats":
+            return {"stats": self.stats()}
+
+        raise ValueError("Unknown action " + str(action))
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    # One JSON request per line, answered by one JSON line: the result, or {"error": message}
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                response = self.server.jobQueue.handleRequest(json.loads(line.decode('utf-8')))
+            except Exception as error:
+                response = {"error": str(error)}
+            self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+            self.wfile.flush()
+
+
+class JobQueueServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath, jobQueue):
+        if os.path.exists(socketPath):
+            # Left by a daemon that did not stop cleanly, unless one is still answering on it
+            try:
+                sendRequest(socketPath, {"action": "stats"})
+                raise IOError("A job queue daemon is already listening on " + socketPath)
+            except socket.error:
+                os.remove(socketPath)
+
+        socketserver.UnixStreamServer.__init__(self, socketPath, _RequestHandler)
+        self.socketPath = socketPath
+        self.jobQueue = jobQueue
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+
+def sendRequest(socketPath, request, timeout=30.0):
+    # Sends a request to the daemon and returns its response, raising RuntimeError with the error it reported
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socketPath)
+        client.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        response = b""
+        while not response.endswith(b"\n"):
+            data = client.recv(65536)
+            if len(data) == 0:
+                break
+            response += data
+    finally:
+        client.close()
+
+    response = json.loads(response.decode('utf-8'))
+    if "error" in response:
+        raise RuntimeError(response["error"])
+
+    return response
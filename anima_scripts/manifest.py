@@ -0,0 +1,119 @@
+# Manifest of completed pipeline steps, kept in a persistent work folder so that a new run skips the steps whose
+# command, inputs and outputs did not change since they were last completed
+
+import json
+import os
+import threading
+
+from anima_scripts.cache import hashFile
+
+manifestVersion = 1
+
+
+def fileFingerprint(filePath):
+    if not os.path.isfile(filePath):
+        return None
+
+    return hashFile(filePath)
+
+
+class Manifest(object):
+    # Entries are indexed by step name and hold the exact command line (or any signature for python steps) and the
+    # content fingerprints of the input and output files. The manifest is rewritten after each completed step.
+    # Intermediate files deleted by a scratch manager are released: they keep their last fingerprint
+
+    def __init__(self, manifestFile):
+        self.manifestFile = manifestFile
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.released = {}
+        if os.path.exists(manifestFile):
+            try:
+                with open(manifestFile) as f:
+                    content = json.load(f)
+                if content.get("version") == manifestVersion:
+                    self.entries, self.released = dict(content["steps"]), dict(content["released"])
+                else:
+                    print("Warning: unknown manifest version in " + manifestFile + ", all steps will be run")
+            except (ValueError, KeyError, AttributeError, TypeError):
+                print("Warning: unreadable manifest " + manifestFile + ", all steps will be run")
+
+    def fingerprint(self, filePath):
+        if not os.path.isfile(filePath):
+            with self.lock:
+                return self.released.get(filePath)
+
+        return fileFingerprint(filePath)
+
+    def isReleased(self, filePath):
+        with self.lock:
+            return filePath in self.released and not os.path.isfile(filePath)
+
+    def isUpToDate(self, name, signature, inputs, outputs):
+        with self.lock:
+            entry = self.entries.get(name)
+
+        if entry is None or entry["signature"] != [str(item) for item in signature]:
+            return False
+
+        if sorted(entry["inputs"].keys()) != sorted(inputs) or sorted(entry["outputs"].keys()) != sorted(outputs):
+            return False
+
+        for filePath in inputs:
+            if self.fingerprint(filePath) != entry["inputs"][filePath]:
+                return False
+
+        for filePath in outputs:
+            if self.fingerprint(filePath) != entry["outputs"][filePath]:
+                return False
+
+        return True
+
+    def record(self, name, signature, inputs, outputs):
+        entry = {"signature": [str(item) for item in signature],
+                 "inputs": dict((filePath, fileFingerprint(filePath)) for filePath in inputs),
+                 "outputs": dict((filePath, fileFingerprint(filePath)) for filePath in outputs)}
+
+        with self.lock:
+            self.entries[name] = entry
+            for filePath in outputs:
+                self.released.pop(filePath, None)
+            self._write()
+
+    def release(self, filePath):
+        # Called before deleting an intermediate file, its fingerprint is the one recorded by its last producer
+        fingerprint = None
+        with self.lock:
+            for entry in self.entries.values():
+                if filePath in entry["outputs"]:
+                    fingerprint = entry["outputs"][filePath]
+        if fingerprint is None:
+            fingerprint = fileFingerprint(filePath)
+
+        with self.lock:
+            self.released[filePath] = fingerprint
+            self._write()
+
+    def _write(self):
+        content = {"version": manifestVersion, "steps": self.entries, "released": self.released}
+
+        tmpFile = self.manifestFile + ".tmp"
+        with open(tmpFile, 'w') as f:
+            json.dump(content, f, indent=1, sort_keys=True)
+        os.rename(tmpFile, self.manifestFile)
+
+
+def runStep(runner, manifest, name, command, inputs, outputs):
+    # Runs a command step unless it is up to date in the manifest (if any), for scripts running steps one by one
+    if manifest is None:
+        runner.run(command, name)
+        return
+
+    inputs = [os.path.abspath(inputFile) for inputFile in inputs]
+    outputs = [os.path.abspath(outputFile) for outputFile in outputs]
+    if manifest.isUpToDate(name, command, inputs, outputs):
+        print("Skipping step " + name + " (up to date)")
+        return
+
+    runner.run(command, name)
+    manifest.record(name, command, inputs, outputs)
@@ -0,0 +1,189 @@
+# Multi-compartment models estimation from DWI, with 0 to n fascicle compartments followed by model averaging (or a
+# single estimation with model selection or no simplification). Large masks may be split into tiles estimated
+# separately and stitched back. Outputs are written next to the DWI image
+
+import os
+
+from anima_scripts.images import imagePrefix
+from anima_scripts.pipeline import Pipeline, splitCores
+from anima_scripts.runner import getRunner
+from anima_scripts.scratch import getScratchPolicy
+from anima_scripts.tiling import splitMask, stitchImages, stitchMCM
+
+modelTypes = {"stick": 1, "zeppelin": 2, "tensor": 3, "ddi": 4}
+
+
+def mcmTileFolder(dwiImage):
+    return imagePrefix(dwiImage) + "_MCM_tiles"
+
+
+def estimateMCM(configParser, dwiImage, bval, bvec, mask="", modelType="tensor", numCompartments=3, hcp=False,
+                modelSimplification=True, modelSelection=False, tiles=1, tileIndex=0, stitchOnly=False,
+                runner=None):
+    # modelType is the fascicles compartment model (stick, zeppelin, tensor or DDI), hcp uses models with isotropic
+    # restricted and stationary water. With tiles > 1 (requires a mask), only tileIndex (from 1) is estimated if given,
+    # and stitchOnly stitches already estimated tiles before model averaging. Returns the output prefixes of estimations
+    runner = getRunner(configParser, runner)
+
+    animaDir = configParser.get("anima-scripts", 'anima')
+    scratchPolicy = getScratchPolicy(configParser)
+
+    # Get parameters from arguments parser
+    baseEstimationCommand = [animaDir + "animaMCMEstimator", "-FR"]
+    if modelType.lower() == "ddi":
+        baseEstimationCommand += ["--optimizer", "bobyqa", "--ml-mode", "1"]
+    else:
+        baseEstimationCommand += ["--optimizer", "levenberg", "--ml-mode", "2"]
+
+    if hcp is True:
+        baseEstimationCommand += ["-S"]
+
+    if modelSimplification:
+        if modelSelection is True:
+            baseEstimationCommand += ["-M"]
+
+    # Default model is stick
+    baseEstimationCommand += ["-c", str(modelTypes.get(modelType.lower(), 1))]
+
+    print("Computing MCM for image " + dwiImage)
+    dwiImagePrefix = imagePrefix(dwiImage)
+
+    estimationCommandWithInputs = baseEstimationCommand + ["-i", dwiImage, "-b", bval, "-g", bvec]
+    estimationInputs = [dwiImage, bval, bvec]
+    if not (mask == ""):
+        estimationCommandWithInputs += ["-m", mask]
+        estimationInputs.append(mask)
+
+    pipeline = Pipeline(runner)
+
+    # Estimations to perform: output prefix and number of compartments
+    modelAveraging = modelSimplification and (modelSelection is False)
+    if modelAveraging:
+        estimations = [(dwiImagePrefix + "_MCM_N" + str(estimationCompartments), estimationCompartments)
+                       for estimationCompartments in range(0, numCompartments + 1)]
+    elif modelSimplification is False:
+        estimations = [(dwiImagePrefix + "_MCM_N" + str(numCompartments), numCompartments)]
+    else:
+        estimations = [(dwiImagePrefix + "_MCM_MS" + str(numCompartments), numCompartments)]
+
+    def estimationOutputs(outputPrefix):
+        outputs = [outputPrefix + ".mcm", outputPrefix + "_aic.nrrd", outputPrefix + "_B0.nrrd",
+                   outputPrefix + "_S2.nrrd"]
+        if modelSimplification and modelSelection is True:
+            outputs.append(outputPrefix + "_mose.nrrd")
+
+        return outputs
+
+    def estimationCommand(commandWithInputs, outputPrefix, estimationCompartments, numThreads):
+        command = commandWithInputs + ["-o", outputPrefix + ".mcm", "-a", outputPrefix + "_aic.nrrd", "--out-b0",
+                                       outputPrefix + "_B0.nrrd", "--out-sig", outputPrefix + "_S2.nrrd", "-n",
+                                       str(estimationCompartments), "-T", str(numThreads)]
+        if modelSimplification and modelSelection is True:
+            command += ["--out-mose", outputPrefix + "_mose.nrrd"]
+
+        return command
+
+    if tiles > 1:
+        # Tiled estimation: the mask is split into slabs with balanced voxel counts, each slab is estimated separately
+        # (concurrently, or as cluster array jobs) and results are stitched back before model averaging
+        if mask == "":
+            raise ValueError("Tiled estimation requires a computation mask")
+
+        tileFolder = mcmTileFolder(dwiImage)
+        tileIndices = None
+        if tileIndex > 0:
+            tileIndices = [tileIndex]
+        elif stitchOnly:
+            tileIndices = []
+
+        tileMasks = splitMask(mask, tiles, tileFolder, tileIndices, scratchPolicy.compressionLevel)
+        print("Mask split into " + str(len(tileMasks)) + " tiles")
+
+        # Estimations of all tiles, longest (most compartments) first, cores being split according to their costs
+        tileJobs = [(estimatedTile, outputPrefix, estimationCompartments)
+                    for estimatedTile in range(1, len(tileMasks) + 1)
+                    for outputPrefix, estimationCompartments in estimations
+                    if tileIndex <= 0 or estimatedTile == tileIndex]
+        if stitchOnly:
+            tileJobs = []
+
+        tileCores = splitCores(pipeline.maxCores, [estimationCompartments + 1 for estimatedTile, outputPrefix,
+                                                   estimationCompartments in tileJobs]) if len(tileJobs) > 0 else []
+        for (estimatedTile, outputPrefix, estimationCompartments), numThreads in zip(tileJobs, tileCores):
+            tileMask = tileMasks[estimatedTile - 1]
+            tileCommandWithInputs = baseEstimationCommand + ["-i", dwiImage, "-b", bval, "-g", bvec, "-m", tileMask]
+            tileOutputPrefix = os.path.join(tileFolder, "tile" + str(estimatedTile) + "_" +
+                                            os.path.basename(outputPrefix))
+            pipeline.addStep("estimationN" + str(estimationCompartments) + "_tile" + str(estimatedTile),
+                             estimationCommand(tileCommandWithInputs, tileOutputPrefix, estimationCompartments,
+                                               numThreads),
+                             inputs=[dwiImage, bval, bvec, tileMask], outputs=estimationOutputs(tileOutputPrefix),
+                             cores=numThreads, priority=estimationCompartments)
+
+        if tileIndex > 0:
+            pipeline.run()
+            return []
+
+        for outputPrefix, estimationCompartments in estimations:
+            tileOutputs = [estimationOutputs(os.path.join(tileFolder, "tile" + str(estimatedTile) + "_" +
+                                                          os.path.basename(outputPrefix)))
+                           for estimatedTile in range(1, len(tileMasks) + 1)]
+            outputs = estimationOutputs(outputPrefix)
+
+            def stitchEstimation(tileOutputs=tileOutputs, outputs=outputs):
+                for index, outputFile in enumerate(outputs):
+                    tileFiles = [tileOutput[index] for tileOutput in tileOutputs]
+                    if outputFile.endswith(".mcm"):
+                        stitchMCM(tileFiles, tileMasks, outputFile, scratchPolicy.outputCompressionLevel)
+                    else:
+                        stitchImages(tileFiles, tileMasks, outputFile, scratchPolicy.outputCompressionLevel)
+
+            pipeline.addStep("stitchingN" + str(estimationCompartments), function=stitchEstimation,
+                             inputs=[tileFile for tileOutput in tileOutputs for tileFile in tileOutput] + tileMasks,
+                             outputs=outputs)
+    else:
+        # Estimations are independent, their cost grows with the number of compartments: cores are split
+        # proportionally and the longest ones are started first
+        estimationCores = splitCores(pipeline.maxCores, [estimationCompartments + 1 for outputPrefix,
+                                                         estimationCompartments in estimations])
+        for (outputPrefix, estimationCompartments), numThreads in zip(estimations, estimationCores):
+            pipeline.addStep("estimationN" + str(estimationCompartments),
+                             estimationCommand(estimationCommandWithInputs, outputPrefix, estimationCompartments,
+                                               numThreads),
+                             inputs=estimationInputs, outputs=estimationOutputs(outputPrefix), cores=numThreads,
+                             priority=estimationCompartments)
+
+    if modelAveraging:
+        # Model averaging once all estimations are done
+        mergeDataFile = open(dwiImagePrefix + "_MCM_List.txt", 'w')
+        mergeDataAICFile = open(dwiImagePrefix + "_MCM_AIC_List.txt", 'w')
+        mergeDataB0File = open(dwiImagePrefix + "_MCM_B0_List.txt", 'w')
+        mergeDataS2File = open(dwiImagePrefix + "_MCM_S2_List.txt", 'w')
+
+        averagingInputs = []
+        for outputPrefix, estimationCompartments in estimations:
+            mergeDataFile.write(outputPrefix + ".mcm\n")
+            mergeDataAICFile.write(outputPrefix + "_aic.nrrd\n")
+            mergeDataB0File.write(outputPrefix + "_B0.nrrd\n")
+            mergeDataS2File.write(outputPrefix + "_S2.nrrd\n")
+            averagingInputs += estimationOutputs(outputPrefix)
+
+        mergeDataFile.close()
+        mergeDataAICFile.close()
+        mergeDataB0File.close()
+        mergeDataS2File.close()
+
+        averagingCommand = [animaDir + "animaMCMModelAveraging", "-i", dwiImagePrefix + "_MCM_List.txt", "-b",
+                            dwiImagePrefix + "_MCM_B0_List.txt", "-n", dwiImagePrefix + "_MCM_S2_List.txt", "-a",
+                            dwiImagePrefix + "_MCM_AIC_List.txt", "-o",
+                            dwiImagePrefix + "_MCM_avg.mcm", "-O", dwiImagePrefix + "_MCM_B0_avg.nrrd", "-N",
+                            dwiImagePrefix + "_MCM_S2_avg.nrrd", "-m",
+                            dwiImagePrefix + "_MCM_mose_avg.nrrd", "-C"]
+        pipeline.addStep("modelAveraging", averagingCommand, inputs=averagingInputs,
+                         outputs=[dwiImagePrefix + "_MCM_avg.mcm", dwiImagePrefix + "_MCM_B0_avg.nrrd",
+                                  dwiImagePrefix + "_MCM_S2_avg.nrrd", dwiImagePrefix + "_MCM_mose_avg.nrrd"],
+                         cores=pipeline.maxCores)
+
+    pipeline.run()
+
+    return [outputPrefix for outputPrefix, estimationCompartments in estimations]
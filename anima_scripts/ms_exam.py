@@ -0,0 +1,97 @@
+# MS exam preparation: FLAIR, T1, T1-Gd (and T2) images are rigidly registered on a reference image, bias corrected,
+# denoised and masked by the reference brain mask. Outputs are <prefix>_preprocessed.nrrd next to each image
+
+import os
+import shutil
+
+from anima_scripts.brain_extraction import brainExtractionOutputs, extractBrain
+from anima_scripts.images import imagePrefix, readImageHeader
+from anima_scripts.manifest import Manifest
+from anima_scripts.pipeline import Pipeline
+from anima_scripts.runner import getRunner
+from anima_scripts.scratch import getScratchPolicy
+
+
+def examOutputs(images):
+    return [imagePrefix(image) + "_preprocessed.nrrd" for image in images]
+
+
+def prepareExam(configParser, reference, flair, t1, t1Gd, t2="", brainMask="", workDir="", runner=None,
+                resultCache=None):
+    # brainMask is the reference brain mask if already computed (e.g. shared by all time points), or else it is
+    # computed in this process (using resultCache if given). With a persistent workDir, intermediate files are kept
+    # there and a new call resumes from them. Returns the preprocessed images
+    runner = getRunner(configParser, runner)
+
+    animaDir = configParser.get("anima-scripts", 'anima')
+    scratchPolicy = getScratchPolicy(configParser)
+    imgExt = scratchPolicy.intermediateExtension
+
+    manifest = None
+    if workDir != "":
+        tmpFolder = os.path.abspath(workDir)
+        if not os.path.isdir(tmpFolder):
+            os.makedirs(tmpFolder)
+        manifest = Manifest(os.path.join(tmpFolder, "pipelineManifest.json"))
+    else:
+        # Three float intermediates per modality, on the reference grid
+        tmpFolder = scratchPolicy.makeWorkDir("animaMSExamPreparation_",
+                                              12 * readImageHeader(reference).numVoxels() * 4)
+
+    # Anima commands
+    animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
+    animaMaskImage = os.path.join(animaDir, "animaMaskImage")
+    animaNLMeans = os.path.join(animaDir, "animaNLMeans")
+    animaN4BiasCorrection = os.path.join(animaDir, "animaN4BiasCorrection")
+
+    refImage = reference
+    listImages = [flair, t1, t1Gd]
+    if t2 != "":
+        listImages.append(t2)
+
+    pipeline = Pipeline(runner, 0, manifest, scratch=scratchPolicy.manager(tmpFolder))
+    chainCores = max(1, pipeline.maxCores // len(listImages))
+
+    # The reference brain mask is only needed for masking: modalities are registered, bias corrected and denoised
+    # while it is computed, each chain running concurrently in its own scratch folder
+    if brainMask == "":
+        brainMask = brainExtractionOutputs(refImage)[0]
+        pipeline.addStep("brainExtraction", function=lambda: extractBrain(configParser, refImage, runner, resultCache),
+                         inputs=[refImage], outputs=brainExtractionOutputs(refImage), cores=chainCores, priority=1)
+
+    for i in range(0, len(listImages)):
+        inputPrefix = imagePrefix(listImages[i])
+
+        # Intermediate names are specific to each image so that they are kept for resuming
+        imageFolder = os.path.join(tmpFolder, "Image" + str(i) + "_" + os.path.basename(inputPrefix))
+        if not os.path.isdir(imageFolder):
+            os.makedirs(imageFolder)
+
+        registeredDataFile = os.path.join(imageFolder, "registered" + imgExt)
+        rigidRegistrationCommand = [animaPyramidalBMRegistration, "-r", refImage, "-m", listImages[i], "-o",
+                                    registeredDataFile, "-p", "4", "-l", "1"]
+        pipeline.addStep("registration" + str(i), rigidRegistrationCommand, inputs=[refImage, listImages[i]],
+                         outputs=[registeredDataFile], cores=chainCores)
+
+        unbiasedSecondImage = os.path.join(imageFolder, "unbiased" + imgExt)
+        biasCorrectionCommand = [animaN4BiasCorrection, "-i", registeredDataFile, "-o", unbiasedSecondImage, "-B",
+                                 "0.3"]
+        pipeline.addStep("biasCorrection" + str(i), biasCorrectionCommand, inputs=[registeredDataFile],
+                         outputs=[unbiasedSecondImage], cores=chainCores)
+
+        nlmSecondImage = os.path.join(imageFolder, "unbiased_nlm" + imgExt)
+        nlmCommand = [animaNLMeans, "-i", unbiasedSecondImage, "-o", nlmSecondImage, "-n", "3"]
+        pipeline.addStep("denoising" + str(i), nlmCommand, inputs=[unbiasedSecondImage], outputs=[nlmSecondImage],
+                         cores=chainCores)
+
+        outputPreprocessedFile = inputPrefix + "_preprocessed.nrrd"
+        secondMaskCommand = [animaMaskImage, "-i", nlmSecondImage, "-m", brainMask, "-o", outputPreprocessedFile]
+        pipeline.addStep("masking" + str(i), secondMaskCommand, inputs=[nlmSecondImage, brainMask],
+                         outputs=[outputPreprocessedFile])
+
+    pipeline.run()
+
+    if workDir == "":
+        shutil.rmtree(tmpFolder)
+
+    return examOutputs(listImages)
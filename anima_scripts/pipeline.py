@@ -0,0 +1,248 @@
+# Dependency graph execution of pipeline steps: a step runs as soon as the steps producing its inputs are done, as
+# long as the cores (and memory) it declares fit in the pipeline budget. Its commands are run with that many threads
+
+import os
+import sys
+import threading
+import time
+import traceback
+
+from anima_scripts.resources import ResourceManager
+
+
+def splitCores(numCores, weights):
+    # Splits a number of cores proportionally to weights (e.g. expected costs), each share being at least one core
+    totalWeight = float(sum(weights))
+    shares = [max(1, int(numCores * weight / totalWeight)) for weight in weights]
+
+    # Cores lost to rounding go to the largest weights first
+    order = sorted(range(0, len(weights)), key=lambda index: -weights[index])
+    index = 0
+    while sum(shares) < numCores:
+        shares[order[index % len(order)]] += 1
+        index += 1
+
+    return shares
+
+
+class Step(object):
+    # A step either runs a command (list, through the pipeline runner) or calls a python function without arguments.
+    # inputs and outputs are file paths, used to order steps. after lists names of steps to wait for in addition.
+    # A failing step is run again up to retries times. memory is its expected peak memory in bytes. key lists what the
+    # result of a function step depends on besides its input files (e.g. options, tools), part of its signature
+
+    def __init__(self, name, command=None, function=None, inputs=(), outputs=(), cores=1, priority=0, after=(),
+                 retries=0, memory=0, key=()):
+        if (command is None) == (function is None):
+            raise ValueError("Step " + name + " needs either a command or a function")
+
+        self.name = name
+        self.command = command
+        self.function = function
+        self.inputs = [os.path.abspath(inputFile) for inputFile in inputs]
+        self.outputs = [os.path.abspath(outputFile) for outputFile in outputs]
+        self.cores = max(1, cores)
+        self.priority = priority
+        self.after = list(after)
+        self.retries = max(0, retries)
+        self.memory = max(0, memory)
+        self.key = list(key)
+        self.dependencies = set()
+
+        # Filled in when running: pending, skipped (up to date), done, failed or blocked (by a failed dependency)
+        self.status = "pending"
+        self.forceRun = False
+        self.attempts = 0
+        self.wallTime = 0.0
+        self.error = ""
+
+    def signature(self):
+        if self.command is not None:
+            return self.command
+
+        return ["function", self.name] + self.key
+
+    def execute(self, runner, cores):
+        if self.command is not None:
+            runner.run(self.command, self.name, cores)
+        else:
+            self.function()
+
+
+class Pipeline(object):
+
+    # If a manifest is given, steps whose command and files did not change since their last completion are skipped,
+    # which recomputes only steps downstream of a change when re-running in the same work folder. With keepGoing, a
+    # failure only blocks the steps depending on it, others still run (e.g. independent exams of a cohort). Steps
+    # share the resource manager of the runner if it has one (e.g. with other pipelines), or else their own budget.
+    # With a scratch manager (see ScratchPolicy.manager), intermediates are deleted once their last user is done
+    def __init__(self, runner, maxCores=0, manifest=None, keepGoing=False, maxMemory=0, scratch=None):
+        self.runner = runner
+        self.manifest = manifest
+        self.keepGoing = keepGoing
+        self.scratch = scratch
+        self.resources = getattr(runner, "resources", None)
+        if self.resources is None:
+            self.resources = ResourceManager(maxCores, maxMemory)
+        self.maxCores = maxCores if maxCores > 0 else self.resources.maxCores
+        self.steps = []
+        self.stepsByName = {}
+
+    def addStep(self, name, command=None, function=None, inputs=(), outputs=(), cores=1, priority=0, after=(),
+                retries=0, memory=0, key=()):
+        if name in self.stepsByName:
+            raise ValueError("Duplicate pipeline step name: " + name)
+
+        step = Step(name, command, function, inputs, outputs, cores, priority, after, retries, memory, key)
+        self.steps.append(step)
+        self.stepsByName[name] = step
+        return step
+
+    def resolveDependencies(self):
+        # The last step declared before a consumer and writing one of its inputs is its producer. A step overwriting a
+        # file also waits for the steps declared before it that read or write that file
+        producers = {}
+        readers = {}
+        for step in self.steps:
+            step.dependencies = set()
+            for inputFile in step.inputs:
+                if inputFile in producers:
+                    step.dependencies.add(producers[inputFile])
+            for stepName in step.after:
+                step.dependencies.add(self.stepsByName[stepName])
+            for outputFile in step.outputs:
+                if outputFile in producers:
+                    step.dependencies.add(producers[outputFile])
+                step.dependencies.update(readers.get(outputFile, []))
+
+            step.dependencies.discard(step)
+            for inputFile in step.inputs:
+                readers.setdefault(inputFile, []).append(step)
+            for outputFile in step.outputs:
+                producers[outputFile] = step
+                readers[outputFile] = []
+
+    def planReruns(self):
+        # A step to run reading intermediates released by a previous run needs their producers to run again, even if
+        # they are up to date, and so on upstream
+        for step in self.steps:
+            step.forceRun = False
+
+        if self.manifest is None or not any(self.manifest.isReleased(inputFile) for step in self.steps
+                                            for inputFile in step.inputs):
+            return
+
+        toRun = set(step for step in self.steps if not self.manifest.isUpToDate(step.name, step.signature(),
+                                                                                step.inputs, step.outputs))
+        for step in reversed(self.steps):
+            if step not in toRun:
+                continue
+            for dependency in step.dependencies:
+                if any(self.manifest.isReleased(inputFile) for inputFile in step.inputs
+                       if inputFile in dependency.outputs):
+                    dependency.forceRun = True
+                    toRun.add(dependency)
+
+    def run(self):
+        self.resolveDependencies()
+        self.planReruns()
+        if self.scratch is not None:
+            self.scratch.plan(self.steps)
+
+        condition = threading.Condition()
+        pending = list(self.steps)
+        done = set()
+        state = {"running": 0, "errors": []}
+
+        def runStep(step, cores):
+            error = None
+            self.resources.setHeld(cores)
+            try:
+                if self.manifest is not None and not step.forceRun and \
+                        self.manifest.isUpToDate(step.name, step.signature(), step.inputs, step.outputs):
+                    print("Skipping step " + step.name + " (up to date)")
+                    step.status = "skipped"
+                else:
+                    startTime = time.time()
+                    while True:
+                        step.attempts += 1
+                        print("Starting step " + step.name + ("" if step.attempts == 1 else
+                                                              " (attempt " + str(step.attempts) + ")"))
+                        sys.stdout.flush()
+                        try:
+                            step.execute(self.runner, cores)
+                            break
+                        except Exception:
+                            if step.attempts > step.retries:
+                                raise
+                            sys.stderr.write("Step " + step.name + " failed, retrying:\n" + traceback.format_exc())
+
+                    step.wallTime = time.time() - startTime
+                    step.status = "done"
+                    if self.manifest is not None:
+                        self.manifest.record(step.name, step.signature(), step.inputs, step.outputs)
+
+                if self.scratch is not None:
+                    self.scratch.stepFinished(step, self.manifest)
+            except Exception:
+                step.status = "failed"
+                step.error = traceback.format_exc()
+                error = (step, step.error)
+
+            self.resources.setHeld(0)
+            self.resources.release(cores, step.memory)
+            with condition:
+                state["running"] -= 1
+                if error is None:
+                    done.add(step)
+                else:
+                    state["errors"].append(error)
+                condition.notify_all()
+
+        with condition:
+            while True:
+                waitingForResources = False
+                if len(state["errors"]) == 0 or self.keepGoing:
+                    readySteps = [step for step in pending if step.dependencies.issubset(done)]
+                    readySteps.sort(key=lambda step: -step.priority)
+                    for step in readySteps:
+                        # Over the scratch quota, steps writing intermediates wait for running ones to free space
+                        if self.scratch is not None and state["running"] > 0 and self.scratch.overQuota() and \
+                                self.scratch.writesScratch(step):
+                            waitingForResources = True
+                            continue
+
+                        # Steps larger than the budget are run alone
+                        cores = self.resources.tryAcquire(min(step.cores, self.maxCores), step.memory)
+                        if cores == 0:
+                            waitingForResources = True
+                            continue
+
+                        pending.remove(step)
+                        state["running"] += 1
+                        thread = threading.Thread(target=runStep, args=(step, cores))
+                        thread.daemon = True
+                        thread.start()
+
+                if state["running"] == 0 and not waitingForResources:
+                    break
+
+                # Resources shared with other users may be released without notifying this pipeline
+                if waitingForResources:
+                    condition.wait(1.0)
+                else:
+                    condition.wait()
+
+        for step in pending:
+            step.status = "blocked"
+
+        if self.scratch is not None:
+            print(self.scratch.report())
+
+        if len(state["errors"]) > 0:
+            for step, error in state["errors"]:
+                sys.stderr.write("Step " + step.name + " failed:\n" + error)
+            raise RuntimeError("Pipeline step(s) failed: " + ", ".join(step.name for step, error in state["errors"]))
+
+        if len(pending) > 0:
+            raise RuntimeError("Pipeline steps never became ready: " + ", ".join(step.name for step in pending))
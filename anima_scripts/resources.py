@@ -0,0 +1,96 @@
+# Shared cores (and optionally memory) budget of the commands run by a script: each Anima tool is given an explicit
+# number of threads and waits for them to be free, so that concurrent steps or images do not oversubscribe the machine
+
+import os
+import threading
+from multiprocessing import cpu_count
+
+# Thread count option of Anima tools (tools not listed use all cores and are only throttled)
+threadOptions = {
+    "animaPyramidalBMRegistration": "-T",
+    "animaDenseSVFBMRegistration": "-T",
+    "animaDenseTensorSVFBMRegistration": "-T",
+    "animaBMDistortionCorrection": "-T",
+    "animaN4BiasCorrection": "-T",
+    "animaNLMeans": "-T",
+    "animaNLMeansTemporal": "-T",
+    "animaDTIEstimator": "-T",
+    "animaMCMEstimator": "-T",
+    "animaMCMModelAveraging": "-T",
+    "animaApplyTransformSerie": "-p",
+    "animaTensorApplyTransformSerie": "-p",
+    "animaMCMApplyTransformSerie": "-p",
+    "animaComputeDTIScalarMaps": "-p",
+}
+
+
+def withThreads(command, numThreads):
+    # Adds the thread count option of the tool to command, unless already given
+    threadOption = threadOptions.get(os.path.basename(command[0]))
+    if threadOption is None or numThreads <= 0 or threadOption in command[1:]:
+        return command
+
+    return list(command) + [threadOption, str(numThreads)]
+
+
+class ResourceManager(object):
+
+    # maxMemory is in bytes, 0 for no memory limit. Requests larger than the budget are granted alone
+    def __init__(self, maxCores=0, maxMemory=0):
+        self.maxCores = maxCores if maxCores > 0 else cpu_count()
+        self.maxMemory = maxMemory
+        self.freeCores = self.maxCores
+        self.freeMemory = maxMemory
+        self.condition = threading.Condition()
+        self.local = threading.local()
+
+    def _fits(self, cores, memory):
+        if self.freeCores == self.maxCores and (self.maxMemory <= 0 or self.freeMemory == self.maxMemory):
+            return True
+
+        return cores <= self.freeCores and (self.maxMemory <= 0 or memory <= self.freeMemory)
+
+    def tryAcquire(self, cores=1, memory=0):
+        # Returns the number of granted cores (cores clipped to the budget), 0 if they are not free
+        cores = max(1, min(cores, self.maxCores))
+        with self.condition:
+            if not self._fits(cores, memory):
+                return 0
+            self.freeCores -= cores
+            self.freeMemory -= memory
+            return cores
+
+    def acquire(self, cores=1, memory=0):
+        cores = max(1, min(cores, self.maxCores))
+        with self.condition:
+            while not self._fits(cores, memory):
+                self.condition.wait()
+            self.freeCores -= cores
+            self.freeMemory -= memory
+            return cores
+
+    def release(self, cores, memory=0):
+        with self.condition:
+            self.freeCores += cores
+            self.freeMemory += memory
+            self.condition.notify_all()
+
+    def setHeld(self, cores):
+        # Cores held by the calling thread (e.g. for a pipeline step): commands it runs use them without acquiring
+        self.local.cores = cores
+
+    def heldCores(self):
+        return getattr(self.local, "cores", 0)
+
+
+def getResourceManager(configParser, maxCores=0, maxMemoryGB=None):
+    # Budget given on the command line, or else by the configuration file (max-cores, max-memory in GB)
+    if maxCores <= 0 and configParser.has_option("anima-scripts", "max-cores"):
+        maxCores = int(configParser.get("anima-scripts", "max-cores"))
+
+    if maxMemoryGB is None:
+        maxMemoryGB = 0
+        if configParser.has_option("anima-scripts", "max-memory"):
+            maxMemoryGB = float(configParser.get("anima-scripts", "max-memory"))
+
+    return ResourceManager(maxCores, int(maxMemoryGB * (1 << 30)))
@@ -0,0 +1,155 @@
+# Runs pipeline commands, checking their exit status and recording their cost (wall and CPU time, peak memory, I/O)
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from anima_scripts.resources import ResourceManager, getResourceManager, withThreads
+
+
+def _fileSize(filePath):
+    try:
+        if os.path.isfile(filePath):
+            fileStat = os.stat(filePath)
+            return fileStat.st_size, fileStat.st_mtime
+    except (OSError, TypeError, ValueError):
+        pass
+
+    return None
+
+
+def _formatBytes(numBytes):
+    return "%.1f" % (numBytes / float(1 << 20))
+
+
+# Each run command is waited for with wait4, which gives the resource usage of that child (and of its own waited
+# children) only, so that records stay exact when several commands run concurrently from different threads.
+# Records are kept in memory for the summary and appended as JSON lines to traceFile if given.
+# Known Anima tools are given an explicit thread count: the cores asked for the command, or else the default cores of
+# the runner. With a resource manager, commands wait for their cores to be free in its budget
+class CommandRunner(object):
+
+    def __init__(self, traceFile="", resources=None, cores=0):
+        self.traceFile = traceFile
+        self.resources = resources
+        self.cores = cores
+        self.records = []
+        self.lock = threading.Lock()
+        self.startTime = time.time()
+
+    def run(self, command, stepName="", cores=0):
+        if stepName == "":
+            stepName = os.path.basename(command[0])
+
+        numThreads = cores if cores > 0 else self.cores
+        reservedCores = 0
+        if self.resources is not None:
+            # Cores already held by the calling thread (pipeline step) are not acquired again
+            heldCores = self.resources.heldCores()
+            if heldCores > 0:
+                numThreads = min(numThreads, heldCores) if numThreads > 0 else heldCores
+            else:
+                reservedCores = self.resources.acquire(numThreads if numThreads > 0 else 1)
+                numThreads = reservedCores
+
+        try:
+            self.runCommand(withThreads(command, numThreads), stepName, numThreads)
+        finally:
+            if reservedCores > 0:
+                self.resources.release(reservedCores)
+
+    def forCallingThread(self):
+        # Runner for the commands and pipelines of an API function called by a thread already holding cores (e.g. a
+        # pipeline step): they share those cores instead of acquiring them again, records and trace staying common
+        heldCores = self.resources.heldCores() if self.resources is not None else 0
+        if self.resources is not None and heldCores <= 0:
+            return self
+
+        nestedRunner = CommandRunner(self.traceFile, ResourceManager(heldCores), heldCores if heldCores > 0 else
+                                     self.cores)
+        nestedRunner.records = self.records
+        nestedRunner.lock = self.lock
+        nestedRunner.startTime = self.startTime
+        return nestedRunner
+
+    def runCommand(self, command, stepName, numThreads):
+
+        inputFiles = {}
+        for argument in command[1:]:
+            fileInfo = _fileSize(argument)
+            if fileInfo is not None:
+                inputFiles[argument] = fileInfo
+
+        startTime = time.time()
+        process = subprocess.Popen(command)
+        pid, status, usage = os.wait4(process.pid, 0)
+        wallTime = time.time() - startTime
+
+        if os.WIFSIGNALED(status):
+            exitStatus = -os.WTERMSIG(status)
+        else:
+            exitStatus = os.WEXITSTATUS(status)
+        process.returncode = exitStatus
+
+        outputBytes = 0
+        for argument in command[1:]:
+            fileInfo = _fileSize(argument)
+            if fileInfo is not None and inputFiles.get(argument) != fileInfo:
+                outputBytes += fileInfo[0]
+
+        # ru_maxrss is in kilobytes on Linux
+        record = {"step": stepName, "command": command, "start": startTime, "wallTime": wallTime,
+                  "cpuTime": usage.ru_utime + usage.ru_stime, "userTime": usage.ru_utime,
+                  "systemTime": usage.ru_stime, "maxRSS": usage.ru_maxrss * 1024,
+                  "inputBytes": sum(fileInfo[0] for fileInfo in inputFiles.values()), "outputBytes": outputBytes,
+                  "threads": numThreads, "exitStatus": exitStatus}
+
+        with self.lock:
+            self.records.append(record)
+            if self.traceFile != "":
+                with open(self.traceFile, 'a') as f:
+                    f.write(json.dumps(record) + "\n")
+
+        if exitStatus != 0:
+            raise subprocess.CalledProcessError(exitStatus, command)
+
+    def printSummary(self, output=sys.stdout):
+        with self.lock:
+            records = list(self.records)
+
+        if len(records) == 0:
+            return
+
+        lines = [["Step", "Wall (s)", "CPU (s)", "Peak RSS (MB)", "Input (MB)", "Output (MB)", "Status"]]
+        for record in records:
+            lines.append([record["step"], "%.1f" % record["wallTime"], "%.1f" % record["cpuTime"],
+                          _formatBytes(record["maxRSS"]), _formatBytes(record["inputBytes"]),
+                          _formatBytes(record["outputBytes"]), str(record["exitStatus"])])
+
+        lines.append(["Total (" + str(len(records)) + " commands)", "%.1f" % (time.time() - self.startTime),
+                      "%.1f" % sum(record["cpuTime"] for record in records),
+                      _formatBytes(max(record["maxRSS"] for record in records)),
+                      _formatBytes(sum(record["inputBytes"] for record in records)),
+                      _formatBytes(sum(record["outputBytes"] for record in records)),
+                      str(sum(1 for record in records if record["exitStatus"] != 0)) + " failed"])
+
+        widths = [max(len(line[i]) for line in lines) for i in range(0, len(lines[0]))]
+        for index, line in enumerate(lines):
+            if index == len(lines) - 1:
+                output.write("-" * (sum(widths) + 2 * (len(widths) - 1)) + "\n")
+            output.write(line[0].ljust(widths[0]) + "  " +
+                         "  ".join(line[i].rjust(widths[i]) for i in range(1, len(line))) + "\n")
+            if index == 0:
+                output.write("-" * (sum(widths) + 2 * (len(widths) - 1)) + "\n")
+        output.flush()
+
+
+def getRunner(configParser, runner=None):
+    # Runner of an API function: the one of its caller if given, or else one with the configured cores budget
+    if runner is None:
+        return CommandRunner("", getResourceManager(configParser))
+
+    return runner.forCallingThread()
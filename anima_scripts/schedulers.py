@@ -0,0 +1,164 @@
+# Job schedulers used by the atlas building driver: jobs are bash scripts, possibly job arrays, depending on other jobs.
+# Each backend exports the index of an array task as ANIMA_ARRAY_INDEX (1 to the array size) so that job scripts do not
+# depend on the batch system
+
+import os
+import re
+import stat
+import subprocess
+
+from anima_scripts.pipeline import Pipeline
+
+arrayIndexVariable = "ANIMA_ARRAY_INDEX"
+
+
+class Scheduler(object):
+    # submit returns a list of job ids, to be given as dependencies of later jobs. wait returns once all submitted jobs
+    # are done for local execution, right after submission for batch systems. cancel deletes queued or running jobs of
+    # a batch system, given their ids
+
+    nativeArrayIndexVariable = ""
+
+    def __init__(self, workDir):
+        self.workDir = os.path.abspath(workDir)
+
+    def directives(self, name, cores, walltime, arraySize):
+        return []
+
+    def writeJobScript(self, scriptName, name, commands, cores, walltime, arraySize):
+        scriptFile = os.path.join(self.workDir, scriptName)
+        with open(scriptFile, 'w') as f:
+            f.write("#!/bin/bash\n")
+            for line in self.directives(name, cores, walltime, arraySize):
+                f.write(line + "\n")
+            f.write("\n")
+            if self.nativeArrayIndexVariable != "":
+                f.write("export " + arrayIndexVariable + "=${" + self.nativeArrayIndexVariable + "}\n")
+            for command in commands:
+                f.write(command + "\n")
+
+        os.chmod(scriptFile, os.stat(scriptFile).st_mode | stat.S_IXUSR)
+        return scriptFile
+
+    def submit(self, name, scriptName, commands, cores=1, walltime="03:59:00", arraySize=0, dependencies=()):
+        raise NotImplementedError
+
+    def wait(self):
+        pass
+
+    def cancel(self, jobIds):
+        pass
+
+
+class LocalScheduler(Scheduler):
+    # Runs jobs on this machine: array tasks are independent pipeline steps, run as soon as the jobs they depend on are
+    # done and their cores fit in the machine budget
+
+    def __init__(self, workDir, runner, maxCores=0):
+        super(LocalScheduler, self).__init__(workDir)
+        self.pipeline = Pipeline(runner, maxCores)
+        self.jobTasks = {}
+
+    def submit(self, name, scriptName, commands, cores=1, walltime="03:59:00", arraySize=0, dependencies=()):
+        scriptFile = self.writeJobScript(scriptName, name, commands, cores, walltime, arraySize)
+
+        after = []
+        for jobId in dependencies:
+            after += self.jobTasks[jobId]
+
+        taskNames = []
+        for index in range(1, max(arraySize, 1) + 1):
+            taskName = name if arraySize == 0 else name + "." + str(index)
+            command = ["bash", scriptFile]
+            if arraySize > 0:
+                command = ["env", arrayIndexVariable + "=" + str(index)] + command
+            self.pipeline.addStep(taskName, command, cores=cores, after=after)
+            taskNames.append(taskName)
+
+        self.jobTasks[name] = taskNames
+        return [name]
+
+    def wait(self):
+        self.pipeline.run()
+
+
+class OARScheduler(Scheduler):
+    nativeArrayIndexVariable = "OAR_ARRAY_INDEX"
+
+    def directives(self, name, cores, walltime, arraySize):
+        lines = ["#OAR -l /nodes=1/core=" + str(cores) + ",walltime=" + walltime]
+        if arraySize > 0:
+            lines.append("#OAR --array " + str(arraySize))
+        lines += ["#OAR -O " + os.path.join(self.workDir, name + ".%jobid%.output"),
+                  "#OAR -E " + os.path.join(self.workDir, name + ".%jobid%.error")]
+        return lines
+
+    def submit(self, name, scriptName, commands, cores=1, walltime="03:59:00", arraySize=0, dependencies=()):
+        scriptFile = self.writeJobScript(scriptName, name, commands, cores, walltime, arraySize)
+
+        command = ["oarsub", "-n", name]
+        for jobId in dependencies:
+            command += ["-a", jobId]
+        command += ["-S", scriptFile]
+
+        # Job arrays get one job id per task
+        output = subprocess.check_output(command, cwd=self.workDir).decode('utf-8', 'replace')
+        jobIds = re.findall(r"OAR_JOB_ID\s*=\s*(\d+)", output)
+        if len(jobIds) == 0:
+            raise RuntimeError("No job id in oarsub output for " + name + ":\n" + output)
+
+        return jobIds
+
+    def cancel(self, jobIds):
+        # Jobs already done are reported by oardel, which does not matter here
+        if len(jobIds) > 0:
+            subprocess.call(["oardel"] + list(jobIds), cwd=self.workDir)
+
+
+class SLURMScheduler(Scheduler):
+    # dependencyType is afterok (dependent jobs are cancelled when a dependency fails) or afterany (dependent jobs
+    # start once dependencies end, whatever their exit status, as OAR does)
+    nativeArrayIndexVariable = "SLURM_ARRAY_TASK_ID"
+
+    def __init__(self, workDir, dependencyType="afterok"):
+        super(SLURMScheduler, self).__init__(workDir)
+        self.dependencyType = dependencyType
+
+    def directives(self, name, cores, walltime, arraySize):
+        outputPattern = os.path.join(self.workDir, name + (".%A_%a" if arraySize > 0 else ".%j"))
+        lines = ["#SBATCH --job-name=" + name, "#SBATCH --nodes=1", "#SBATCH --cpus-per-task=" + str(cores),
+                 "#SBATCH --time=" + walltime]
+        if arraySize > 0:
+            lines.append("#SBATCH --array=1-" + str(arraySize))
+        lines += ["#SBATCH --output=" + outputPattern + ".output", "#SBATCH --error=" + outputPattern + ".error"]
+        return lines
+
+    def submit(self, name, scriptName, commands, cores=1, walltime="03:59:00", arraySize=0, dependencies=()):
+        scriptFile = self.writeJobScript(scriptName, name, commands, cores, walltime, arraySize)
+
+        # Dependencies on an array job id wait for all its tasks
+        command = ["sbatch", "--parsable"]
+        if len(dependencies) > 0:
+            command.append("--dependency=" + self.dependencyType + ":" + ":".join(dependencies))
+        command.append(scriptFile)
+
+        output = subprocess.check_output(command, cwd=self.workDir).decode('utf-8', 'replace').strip()
+        if output == "":
+            raise RuntimeError("No job id in sbatch output for " + name)
+
+        return [output.split(";")[0]]
+
+    def cancel(self, jobIds):
+        if len(jobIds) > 0:
+            subprocess.call(["scancel"] + list(jobIds), cwd=self.workDir)
+
+
+def getScheduler(schedulerName, workDir, runner, maxCores=0, slurmDependencyType="afterok"):
+    if schedulerName == "local":
+        return LocalScheduler(workDir, runner, maxCores)
+    elif schedulerName == "oar":
+        return OARScheduler(workDir)
+    elif schedulerName == "slurm":
+        return SLURMScheduler(workDir, slurmDependencyType)
+
+    raise ValueError("Unknown scheduler " + schedulerName + " (choose local, oar or slurm)")
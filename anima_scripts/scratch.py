@@ -0,0 +1,175 @@
+# Scratch policy for intermediate files: work folders go to the first configured scratch root (e.g. /dev/shm or a
+# local SSD) with enough free space, falling back to the next ones and finally to the system temporary folder.
+# Intermediates use a configurable format and compression (e.g. uncompressed nii) while final outputs are written
+# compressed next to the inputs.
+# Within a work folder, a scratch manager deletes each intermediate once the last pipeline step using it is done
+
+import os
+import tempfile
+import threading
+
+intermediateFormats = ["nrrd", "nii", "nii.gz"]
+
+
+def freeSpace(folder):
+    # Bytes available to the user in the file system holding folder
+    fileSystemStats = os.statvfs(folder)
+    return fileSystemStats.f_bavail * fileSystemStats.f_frsize
+
+
+class ScratchPolicy(object):
+
+    def __init__(self, scratchDirs=(), minFreeGB=1.0, intermediateFormat="nrrd", compressionLevel=6, quotaGB=0.0,
+                 outputCompressionLevel=6):
+        if intermediateFormat not in intermediateFormats:
+            raise ValueError("Unknown intermediate format " + intermediateFormat + " (choose among " +
+                             ", ".join(intermediateFormats) + ")")
+
+        self.scratchDirs = [scratchDir for scratchDir in scratchDirs if scratchDir != ""]
+        self.minFreeBytes = int(minFreeGB * 1024 ** 3)
+        self.intermediateFormat = intermediateFormat
+        self.intermediateExtension = "." + intermediateFormat
+        self.compressionLevel = compressionLevel
+        self.quotaBytes = int(quotaGB * 1024 ** 3)
+        self.outputCompressionLevel = max(1, outputCompressionLevel)
+
+    def scratchRoot(self, requiredBytes=0):
+        # First scratch root with the minimum free space left once requiredBytes (estimated size of the intermediate
+        # files) are written
+        for scratchDir in self.scratchDirs:
+            if not os.path.isdir(scratchDir):
+                continue
+            available = freeSpace(scratchDir)
+            if available >= requiredBytes + self.minFreeBytes:
+                return scratchDir
+            print("Scratch folder " + scratchDir + " has only " + "%.1f" % (available / 1024.0 ** 3) +
+                  " GB free, trying the next one")
+
+        return tempfile.gettempdir()
+
+    def makeWorkDir(self, prefix="anima_", requiredBytes=0):
+        return tempfile.mkdtemp(prefix=prefix, dir=self.scratchRoot(requiredBytes))
+
+    def intermediate(self, filePrefix):
+        return filePrefix + self.intermediateExtension
+
+    def manager(self, workDir, keep=()):
+        return ScratchManager(workDir, self.quotaBytes, keep)
+
+
+def _formatMB(numBytes):
+    return "%.1f" % (numBytes / 1024.0 ** 2) + " MB"
+
+
+class ScratchManager(object):
+    # Lifecycle of the intermediate files of a pipeline, i.e. its step inputs and outputs within workDir (files in keep
+    # excepted): each one is deleted as soon as all the steps reading or writing it are done, and steps writing to
+    # workDir wait while it holds more than quotaBytes (0: no limit) until others finish and free space. Deleted files
+    # are recorded in the pipeline manifest if any, so that a new run in a persistent work folder still skips the
+    # steps that produced or read them
+
+    def __init__(self, workDir, quotaBytes=0, keep=()):
+        self.workDir = os.path.abspath(workDir)
+        self.quotaBytes = quotaBytes
+        self.keep = set(os.path.abspath(keptFile) for keptFile in keep)
+        self.lock = threading.Lock()
+        self.users = {}
+        self.usage = 0
+        self.peakUsage = 0
+        self.releasedBytes = 0
+
+    def isIntermediate(self, filePath):
+        return filePath.startswith(self.workDir + os.sep) and filePath not in self.keep
+
+    def plan(self, steps):
+        # Number of steps reading or writing each intermediate
+        with self.lock:
+            self.users = {}
+            for step in steps:
+                for filePath in set(step.inputs + step.outputs):
+                    if self.isIntermediate(filePath):
+                        self.users[filePath] = self.users.get(filePath, 0) + 1
+        self.measure()
+
+    def writesScratch(self, step):
+        return any(self.isIntermediate(outputFile) for outputFile in step.outputs)
+
+    def overQuota(self):
+        with self.lock:
+            return self.quotaBytes > 0 and self.usage >= self.quotaBytes
+
+    def measure(self):
+        usage = 0
+        for folder, subFolders, fileNames in os.walk(self.workDir):
+            for fileName in fileNames:
+                try:
+                    usage += os.path.getsize(os.path.join(folder, fileName))
+                except OSError:
+                    pass
+
+        with self.lock:
+            self.usage = usage
+            self.peakUsage = max(self.peakUsage, usage)
+
+    def stepFinished(self, step, manifest=None):
+        # Called once a step is done or skipped: the footprint is measured before deleting the files it was the last
+        # user of
+        self.measure()
+
+        releasedFiles = []
+        with self.lock:
+            for filePath in set(step.inputs + step.outputs):
+                if filePath in self.users:
+                    self.users[filePath] -= 1
+                    if self.users[filePath] == 0:
+                        del self.users[filePath]
+                        releasedFiles.append(filePath)
+
+        for filePath in releasedFiles:
+            if not os.path.isfile(filePath):
+                continue
+            if manifest is not None:
+                manifest.release(filePath)
+            fileSize = os.path.getsize(filePath)
+            os.remove(filePath)
+            with self.lock:
+                self.usage -= fileSize
+                self.releasedBytes += fileSize
+
+    def report(self):
+        line = "Scratch peak " + _formatMB(self.peakUsage)
+        if self.quotaBytes > 0:
+            line += " (quota " + _formatMB(self.quotaBytes) + ")"
+        return line + ", " + _formatMB(self.releasedBytes) + " of intermediates deleted early in " + self.workDir
+
+
+def getScratchPolicy(configParser):
+    # Optional keys of the anima-scripts section: scratch-dirs (comma separated, in order of preference),
+    # scratch-min-free (GB), intermediate-format (nrrd, nii or nii.gz), intermediate-compression (0 to 9) and
+    # scratch-quota (GB of intermediates per pipeline run, 0: no limit). output-compression (1 to 9) is the compression
+    # level of the final outputs written by the scripts
+    scratchDirs = []
+    if configParser.has_option("anima-scripts", "scratch-dirs"):
+        scratchDirs = [scratchDir.strip() for scratchDir in configParser.get("anima-scripts", "scratch-dirs").split(",")]
+
+    minFreeGB = 1.0
+    if configParser.has_option("anima-scripts", "scratch-min-free"):
+        minFreeGB = float(configParser.get("anima-scripts", "scratch-min-free"))
+
+    intermediateFormat = "nrrd"
+    if configParser.has_option("anima-scripts", "intermediate-format"):
+        intermediateFormat = configParser.get("anima-scripts", "intermediate-format").strip()
+
+    compressionLevel = 6
+    if configParser.has_option("anima-scripts", "intermediate-compression"):
+        compressionLevel = int(configParser.get("anima-scripts", "intermediate-compression"))
+
+    quotaGB = 0.0
+    if configParser.has_option("anima-scripts", "scratch-quota"):
+        quotaGB = float(configParser.get("anima-scripts", "scratch-quota"))
+
+    outputCompressionLevel = 6
+    if configParser.has_option("anima-scripts", "output-compression"):
+        outputCompressionLevel = int(configParser.get("anima-scripts", "output-compression"))
+
+    return ScratchPolicy(scratchDirs, minFreeGB, intermediateFormat, compressionLevel, quotaGB, outputCompressionLevel)
@@ -0,0 +1,151 @@
+# Splitting of a computation mask into slabs with balanced voxel counts, and stitching of the images computed on each
+# of them back into full volumes. Used to distribute voxel-independent estimations over several jobs (requires numpy)
+
+import os
+import xml.etree.ElementTree as ElementTree
+
+from anima_scripts.images import readImage, writeImage
+
+imageExtensions = (".nrrd", ".nhdr", ".nii", ".nii.gz")
+
+
+def _spatialMask(header, data):
+    # Boolean mask over the spatial axes only (any non zero value along other axes)
+    import numpy as np
+
+    spatialAxes = header.fields["spatial axes"]
+    otherAxes = tuple(axis for axis in range(0, data.ndim) if axis not in spatialAxes)
+    mask = data != 0
+    if len(otherAxes) > 0:
+        mask = np.any(mask, axis=otherAxes)
+
+    return mask
+
+
+def computeSlabs(mask, numTiles):
+    # Cuts the last spatial axis into at most numTiles slabs holding about the same number of mask voxels
+    import numpy as np
+
+    sliceCounts = mask.reshape(-1, mask.shape[-1], order='F').sum(axis=0)
+    nonEmptySlices = np.nonzero(sliceCounts)[0]
+    numTiles = max(1, min(numTiles, len(nonEmptySlices)))
+    if len(nonEmptySlices) == 0:
+        return [(0, mask.shape[-1])]
+
+    cumulativeCounts = np.cumsum(sliceCounts)
+    totalCount = cumulativeCounts[-1]
+
+    slabs = []
+    start = 0
+    for tile in range(1, numTiles):
+        end = int(np.searchsorted(cumulativeCounts, totalCount * tile / float(numTiles))) + 1
+        # Each slab keeps at least one non empty slice
+        end = max(end, int(nonEmptySlices[np.searchsorted(nonEmptySlices, start)]) + 1)
+        end = min(end, int(nonEmptySlices[len(nonEmptySlices) - numTiles + tile]))
+        slabs.append((start, end))
+        start = end
+    slabs.append((start, mask.shape[-1]))
+
+    return slabs
+
+
+def tileMaskName(tileFolder, maskFile, tileIndex):
+    extension = ".nii.gz" if maskFile.endswith(".nii.gz") else os.path.splitext(maskFile)[1]
+    if extension == ".nhdr":
+        extension = ".nrrd"
+
+    return os.path.join(tileFolder, "tile" + str(tileIndex) + "_mask" + extension)
+
+
+def splitMask(maskFile, numTiles, tileFolder, tileIndices=None, compressionLevel=6):
+    # Writes tile masks (tiles are numbered from 1, only those in tileIndices if given) and returns the names of all
+    # of them, whose number may be lower than numTiles for masks spanning few slices
+    import numpy as np
+
+    header, data = readImage(maskFile)
+    mask = _spatialMask(header, data)
+    slabs = computeSlabs(mask, numTiles)
+
+    if not os.path.isdir(tileFolder):
+        try:
+            os.makedirs(tileFolder)
+        except OSError:
+            if not os.path.isdir(tileFolder):
+                raise
+
+    tileMasks = []
+    for tileIndex, (start, end) in enumerate(slabs, 1):
+        tileMaskFile = tileMaskName(tileFolder, maskFile, tileIndex)
+        tileMasks.append(tileMaskFile)
+        if tileIndices is not None and tileIndex not in tileIndices:
+            continue
+
+        tileMask = np.zeros(mask.shape, dtype=np.uint8)
+        tileMask[..., start:end] = mask[..., start:end]
+        tileData = tileMask.reshape([size if axis in header.fields["spatial axes"] else 1
+                                     for axis, size in enumerate(header.fields["shape"])], order='F')
+        writeImage(tileMaskFile, tileData, header, compressionLevel)
+
+    return tileMasks
+
+
+def stitchImages(tileFiles, tileMaskFiles, outputFile, compressionLevel=6):
+    # Each output voxel comes from the tile whose mask contains it, other voxels are those of the first tile
+    import numpy as np
+
+    header, output = readImage(tileFiles[0])
+    output = np.array(output)
+    shape = header.fields["shape"]
+    spatialAxes = header.fields["spatial axes"]
+    broadcastShape = [size if axis in spatialAxes else 1 for axis, size in enumerate(shape)]
+
+    for tileFile, tileMaskFile in zip(tileFiles, tileMaskFiles):
+        tileHeader, tileData = readImage(tileFile)
+        maskHeader, maskData = readImage(tileMaskFile)
+        tileMask = _spatialMask(maskHeader, maskData).reshape(broadcastShape, order='F')
+        output = np.where(tileMask, tileData, output)
+
+    writeImage(outputFile, output.astype(header.pixelType), header, compressionLevel)
+
+
+def _mcmImageReferences(mcmFile):
+    tree = ElementTree.parse(mcmFile)
+    references = [element for element in tree.iter()
+                  if element.text is not None and element.text.strip().endswith(imageExtensions)]
+    return tree, references
+
+
+def stitchMCM(tileMCMFiles, tileMaskFiles, outputMCMFile, compressionLevel=6):
+    # MCM files are XML descriptions referencing one image per compartment (and weights): each referenced image is
+    # stitched and the description of the first tile is written with references to the stitched images
+    tileName = os.path.splitext(os.path.basename(tileMCMFiles[0]))[0]
+    outputName = os.path.splitext(os.path.basename(outputMCMFile))[0]
+    outputFolder = os.path.dirname(os.path.abspath(outputMCMFile))
+
+    tree, references = _mcmImageReferences(tileMCMFiles[0])
+    tileReferences = [_mcmImageReferences(tileMCMFile)[1] for tileMCMFile in tileMCMFiles]
+
+    for index, element in enumerate(references):
+        reference = element.text.strip()
+        tileFiles = []
+        for tileMCMFile, elements in zip(tileMCMFiles, tileReferences):
+            tileReference = elements[index].text.strip()
+            if not os.path.isabs(tileReference):
+                tileReference = os.path.join(os.path.dirname(os.path.abspath(tileMCMFile)), tileReference)
+            tileFiles.append(tileReference)
+
+        if os.path.isabs(reference):
+            reference = os.path.basename(reference)
+        if tileName in reference:
+            outputReference = reference.replace(tileName, outputName)
+        else:
+            outputReference = outputName + "_" + reference
+
+        outputFile = os.path.join(outputFolder, outputReference)
+        if not os.path.isdir(os.path.dirname(outputFile)):
+            os.makedirs(os.path.dirname(outputFile))
+
+        stitchImages(tileFiles, tileMaskFiles, outputFile, compressionLevel)
+        element.text = outputReference
+
+    tree.write(outputMCMFile, encoding="UTF-8", xml_declaration=True)
@@ -1,10 +1,28 @@
 #! /bin/bash
 # Computes an atlas of scalar images using Anima registration tools and Guimond method slightly modified to use the log-Euclidean framework
 # Has to be run on an OAR cluster
+# ANIMA_ATLAS_* environment variables (e.g. ANIMA_ATLAS_STREAMING_MERGE=1) are passed on to the jobs
+# With ANIMA_ATLAS_TOLERANCE set, iterations stop once the average image changes less than this (relative L2 change)
+# With ANIMA_ATLAS_WARM_START=1, affine registrations start from the previous iteration ones
+# ANIMA_ATLAS_INTERMEDIATE_FORMAT (e.g. nii for uncompressed files) sets the format of tempDir and residualDir files
 
 # Get local variables
 . ~/.anima/configParser.sh
 
+# Intermediate files format and compression of the configuration file, unless already given to the jobs
+if [ "${ANIMA_ATLAS_INTERMEDIATE_FORMAT}" == "" ] && [ "${ANIMA_INTERMEDIATE_FORMAT}" != "" ]; then
+	export ANIMA_ATLAS_INTERMEDIATE_FORMAT=${ANIMA_INTERMEDIATE_FORMAT}
+fi
+
+if [ "${ANIMA_ATLAS_INTERMEDIATE_COMPRESSION}" == "" ] && [ "${ANIMA_INTERMEDIATE_COMPRESSION}" != "" ]; then
+	export ANIMA_ATLAS_INTERMEDIATE_COMPRESSION=${ANIMA_INTERMEDIATE_COMPRESSION}
+fi
+
+ext=.${ANIMA_ATLAS_INTERMEDIATE_FORMAT:-nii.gz}
+
+# Merges start once registration jobs ended, their missing flags are only waited for during a short grace period
+export ANIMA_ATLAS_MERGE_TIMEOUT=${ANIMA_ATLAS_MERGE_TIMEOUT:-60}
+
 prefix=$1
 nimages=$2
 niter=$3
@@ -13,6 +31,9 @@ ncores=$4
 mkdir tempDir
 mkdir residualDir
 
+# Submitted jobs, cancelled by the convergence check of an earlier iteration
+rm -f atlasJobs.txt
+
 ref=${prefix}_1
 prefixBase=`dirname ${prefix}`
 prefix=`basename ${prefix}`
@@ -23,6 +44,11 @@ previousMergeId=0
 
 for((k=1;k<=$niter;k++))
 do
+  if [ -e converged ]; then
+      echo "Atlas already converged (`cat converged`), no more iterations"
+      break
+  fi
+
   if [ -e it_${k}_done ]; then
       ref=averageForm${k}
       firstImage=1
@@ -34,9 +60,14 @@ do
   	echo " "
   	echo "*************Iteration $k Processing Reference: $ref "
 
+	# Affines kept for warm starts are only valid within one atlas construction
+	if [ ${k} -eq 1 ]; then
+		rm -rf affineDir
+	fi
+
 	for ((a=$firstImage;a<=$nimages;a++))
 	do
-		rm -f residualDir/${prefix}_${a}_{bal_tr.nii.gz,flag}
+		rm -f residualDir/${prefix}_${a}_{bal_tr${ext},flag,failed}
 	done
 
 	let nrun=${nimages}-${firstImage}+1
@@ -49,8 +80,12 @@ do
 	echo "#OAR -O ${PWD}/reg-${k}.%jobid%.output" >> tmpRun_${k}
 	echo "#OAR -E ${PWD}/reg-${k}.%jobid%.error" >> tmpRun_${k}
 
-	echo "export PATH=${PATH}:${ANIMA_DIR}:" >> tmpRun_${k}
-	echo "cd ${PWD}" >> tmpRun_${k}
+	# Values quoted for the job shell, whatever their spaces or special characters
+	printf 'export PATH=%q\n' "${PATH}:${ANIMA_DIR}:" >> tmpRun_${k}
+	for variable in $(compgen -e | grep '^ANIMA_ATLAS_'); do
+		printf 'export %s=%q\n' "${variable}" "${!variable}" >> tmpRun_${k}
+	done
+	printf 'cd %q\n' "${PWD}" >> tmpRun_${k}
 
 	if [ ${k} -eq 1 ]; then
 		echo "let index=\${OAR_ARRAY_INDEX}+1" >> tmpRun_${k}
@@ -77,6 +112,7 @@ do
 
 		tmpid=`echo $tmpstr | awk -F 'OAR_JOB_ID' '{print $2;exit}' | sed "s/\=//g"`
 		jobsId="${jobsId} -a ${tmpid}"
+		echo "oar ${k} ${tmpid}" >> atlasJobs.txt
 	done
 
 	echo "#!/bin/bash" > mergeRun_${k}
@@ -84,13 +120,18 @@ do
 	echo "#OAR -O ${PWD}/merge-${k}.%jobid%.output" >> mergeRun_${k}
 	echo "#OAR -E ${PWD}/merge-${k}.%jobid%.error" >> mergeRun_${k}
 
-	echo "export PATH=${PATH}:${ANIMA_DIR}:" >> mergeRun_${k}
-	echo "cd ${PWD}" >> mergeRun_${k}
+	# Values quoted for the job shell, whatever their spaces or special characters
+	printf 'export PATH=%q\n' "${PATH}:${ANIMA_DIR}:" >> mergeRun_${k}
+	for variable in $(compgen -e | grep '^ANIMA_ATLAS_'); do
+		printf 'export %s=%q\n' "${variable}" "${!variable}" >> mergeRun_${k}
+	done
+	printf 'cd %q\n' "${PWD}" >> mergeRun_${k}
 	echo "${ROOT_PUBLIC_DIR}/atlasing/anatomical/animaMergeImages.sh ${PWD} ${prefixBase} ${prefix} ${k} ${nimages} ${ref} ${ncores}" >> mergeRun_${k}
 
 	chmod u+x mergeRun_${k}
 	a=`oarsub -n merge-${k} -S ${PWD}/mergeRun_${k} ${jobsId}`
 	previousMergeId=`echo $a | awk -F 'OAR_JOB_ID' '{print $2;exit}' | sed "s/\=//g"`
+	echo "oar ${k} ${previousMergeId}" >> atlasJobs.txt
 
  	ref=averageForm${k}
  	firstImage=1
@@ -2,6 +2,15 @@
 
 cd ${1}
 
+# The atlas converged at a previous iteration: nothing left to do
+if [ -e converged ]; then
+	exit 0
+fi
+
+# Intermediate files format (ANIMA_ATLAS_INTERMEDIATE_FORMAT: nii.gz, nii or nrrd), nii avoids compressing files that
+# are removed at the end of the iteration
+ext=.${ANIMA_ATLAS_INTERMEDIATE_FORMAT:-nii.gz}
+
 prefixBase=${2}
 prefix=${3}
 k=${4}
@@ -10,63 +19,96 @@ ref=${6}
 ncores=${7}
 
 # test if all images are here
-nimTest=$nimages
+firstIndex=1
 if [ $k -eq 1 ]; then
-	let nimTest=nimTest-1
+	firstIndex=2
 fi
 
-numData=`ls -l residualDir/${prefix}_*_flag | wc -l`
-while (($numData < $nimTest))
-do
-	echo Missing data $numData $nimTest
-	sleep 600
-	numData=`ls -l residualDir/${prefix}_*_flag | wc -l`
-done
+# Returns as soon as all registrations are done, fails if some failed or did not finish in time
+`dirname $0`/../animaWaitForRegistrations.sh residualDir ${prefix} ${firstIndex} ${nimages}
+if [ $? -ne 0 ]; then
+	echo "Merge of iteration ${k} aborted" >&2
+	exit 1
+fi
 
 # if ok proceed
 
-if [ $k -eq 1 ]; then
-	cp ${prefixBase}/${prefix}_1.nii.gz tempDir/${prefix}_1_bal.nii.gz 
+if [ "${ANIMA_ATLAS_STREAMING_MERGE}" == "1" ]; then
+	# Registrations already added their results to running averages, only the first image is missing at iteration 1
+	accumulateScript=`dirname $0`/../animaAccumulateImages.py
+	if [ $k -eq 1 ]; then
+		maskOption=''
+		if [ -e Masks/Mask_1.nii.gz ]; then
+			maskOption="-m Masks/Mask_1.nii.gz"
+		fi
+		python ${accumulateScript} add -a tempDir/intensityAccumulator -i ${prefixBase}/${prefix}_1.nii.gz ${maskOption} -k ${ref} --id 1
+
+		animaCreateImage -o tempDir/${prefix}_1_bal_tr${ext} -b 0 -g ${prefixBase}/${prefix}_1.nii.gz -v 3
+		python ${accumulateScript} add -a tempDir/residualAccumulator -i tempDir/${prefix}_1_bal_tr${ext} -k ${ref} --id 1
+		\rm -f tempDir/${prefix}_1_bal_tr${ext}
+	fi
 
-	if [ -e Masks/Mask_1.nii.gz ]; then
-		cp Masks/Mask_1.nii.gz tempDir/${prefix}_1_mask.nii.gz
+	python ${accumulateScript} finalize -a tempDir/intensityAccumulator -o tempDir/IntensityAverageDiv${ext} -c ${ANIMA_ATLAS_INTERMEDIATE_COMPRESSION:-6}
+	python ${accumulateScript} finalize -a tempDir/residualAccumulator -o tempDir/sum${ext} -c ${ANIMA_ATLAS_INTERMEDIATE_COMPRESSION:-6}
+else
+	if [ $k -eq 1 ]; then
+		if [ "${ext}" == ".nii.gz" ]; then
+			cp ${prefixBase}/${prefix}_1.nii.gz tempDir/${prefix}_1_bal${ext}
+		else
+			animaConvertImage -i ${prefixBase}/${prefix}_1.nii.gz -o tempDir/${prefix}_1_bal${ext}
+		fi
+
+		if [ -e Masks/Mask_1.nii.gz ]; then
+			if [ "${ext}" == ".nii.gz" ]; then
+				cp Masks/Mask_1.nii.gz tempDir/${prefix}_1_mask${ext}
+			else
+				animaConvertImage -i Masks/Mask_1.nii.gz -o tempDir/${prefix}_1_mask${ext}
+			fi
+		fi
+
+		animaCreateImage -o residualDir/${prefix}_1_bal_tr${ext} -b 0 -g ${prefixBase}/${prefix}_1.nii.gz -v 3
 	fi
 
-	animaCreateImage -o residualDir/${prefix}_1_bal_tr.nii.gz -b 0 -g ${prefixBase}/${prefix}_1.nii.gz -v 3
-fi
+	rm -f refIms.txt masksIms.txt sum.txt
+	for ((a=1;${a}<=${nimages};a++))
+	do
+		echo tempDir/${prefix}_${a}_bal${ext} >> refIms.txt
 
-rm -f refIms.txt masksIms.txt sum.txt
-for ((a=1;${a}<=${nimages};a++))
-do
-	echo tempDir/${prefix}_${a}_bal.nii.gz >> refIms.txt
+		if [ -e Masks/Mask_1.nii.gz ]; then
+			echo tempDir/${prefix}_${a}_mask${ext} >> masksIms.txt
+		fi
+
+		echo residualDir/${prefix}_${a}_bal_tr${ext} >> sum.txt
+	done
 
 	if [ -e Masks/Mask_1.nii.gz ]; then
-		echo tempDir/${prefix}_${a}_mask.nii.gz >> masksIms.txt
+		animaAverageImages -i refIms.txt -o tempDir/IntensityAverageDiv${ext} -m masksIms.txt
+	else
+		animaAverageImages -i refIms.txt -o tempDir/IntensityAverageDiv${ext}
 	fi
 
-	echo residualDir/${prefix}_${a}_bal_tr.nii.gz >> sum.txt
-done
-
-if [ -e Masks/Mask_1.nii.gz ]; then
-	animaAverageImages -i refIms.txt -o tempDir/IntensityAverageDiv.nii.gz -m masksIms.txt
-else
-	animaAverageImages -i refIms.txt -o tempDir/IntensityAverageDiv.nii.gz
+	animaAverageImages -i sum.txt -o tempDir/sum${ext}
 fi
 
-animaAverageImages -i sum.txt -o tempDir/sum.nii.gz
-
-animaTransformSerieXmlGenerator -i tempDir/sum.nii.gz -I 1 -o tempDir/trsf.xml
+animaTransformSerieXmlGenerator -i tempDir/sum${ext} -I 1 -o tempDir/trsf.xml
 
 for ((a=1;${a}<=$nimages;a++))
 do
-	\rm -f residualDir/${prefix}_${a}_bal_tr.nii.gz
+	\rm -f residualDir/${prefix}_${a}_bal_tr${ext}
 done
 
 # the averaged transform is used in the intensity averaged image
-animaApplyTransformSerie -i tempDir/IntensityAverageDiv.nii.gz -o averageForm${k}.nii.gz -t tempDir/trsf.xml -g ${ref}.nii.gz -p ${ncores}
+animaApplyTransformSerie -i tempDir/IntensityAverageDiv${ext} -o averageForm${k}.nii.gz -t tempDir/trsf.xml -g ${ref}.nii.gz -p ${ncores}
 
 if [ -e averageForm${k}.nii.gz ]; then
 	touch it_${k}_done
+
+	# Convergence check, enabled by a tolerance on the relative change of the average image
+	if [ "${ANIMA_ATLAS_TOLERANCE}" != "" ]; then
+		python `dirname $0`/../animaAtlasConvergence.py -s tempDir/sum${ext} -p ${ref}.nii.gz -c averageForm${k}.nii.gz -k ${k} -t ${ANIMA_ATLAS_TOLERANCE} -T ${ANIMA_ATLAS_SVF_TOLERANCE:--1}
+	fi
+
+	\rm -rf tempDir/intensityAccumulator tempDir/residualAccumulator
 	let t=${k}+1
 	if [ -e tmpRun_${t} ]; then
 		\rm -f tmpRun_${k} residualDir/* tempDir/*
@@ -1,6 +1,16 @@
 #!/bin/bash
 
 cd ${1}
+
+# The atlas converged at a previous iteration: nothing left to do
+if [ -e converged ]; then
+	exit 0
+fi
+
+# Intermediate files format (ANIMA_ATLAS_INTERMEDIATE_FORMAT: nii.gz, nii or nrrd), nii avoids compressing files that
+# are removed at the end of the iteration
+ext=.${ANIMA_ATLAS_INTERMEDIATE_FORMAT:-nii.gz}
+
 ref=${2}
 prefixBase=${3}
 basePrefBase=`dirname ${3}`
@@ -8,25 +18,62 @@ prefix=${4}
 numIm=${5}
 ncores=${6}
 
+# Any failing command stops the registration and flags it as failed, so that the merge does not wait for it
+failedFlag=${basePrefBase}/residualDir/${prefix}_${numIm}_failed
+rm -f ${failedFlag}
+
+registrationFailed() {
+	touch ${failedFlag}
+	exit 1
+}
+
+set -e
+trap registrationFailed ERR TERM INT
+
 # Rigid / affine registration
+# With ANIMA_ATLAS_WARM_START=1, it starts from the affine of the previous iteration (kept in affineDir), the new
+# reference being close to the previous one, and skips the coarsest pyramid levels (ANIMA_ATLAS_WARM_START_LEVELS
+# levels are used, default 2)
+mkdir -p ${basePrefBase}/affineDir
+previousAffine=${basePrefBase}/affineDir/${prefix}_${numIm}_aff_tr.txt
+affineOptions="-p 4 -l 0"
+if [ "${ANIMA_ATLAS_WARM_START}" == "1" ] && [ -e ${previousAffine} ]; then
+	affineOptions="-i ${previousAffine} -p ${ANIMA_ATLAS_WARM_START_LEVELS:-2} -l 0"
+fi
 
-animaPyramidalBMRegistration -r ${ref} -m ${prefixBase}/${prefix}_${numIm}.nii.gz -o ${basePrefBase}/tempDir/${prefix}_${numIm}_aff.nii.gz -O ${basePrefBase}/tempDir/${prefix}_${numIm}_aff_tr.txt --ot 2 -p 4 -l 0 -T ${ncores} --sym-reg 2
+animaPyramidalBMRegistration -r ${ref} -m ${prefixBase}/${prefix}_${numIm}.nii.gz -o ${basePrefBase}/tempDir/${prefix}_${numIm}_aff${ext} -O ${basePrefBase}/tempDir/${prefix}_${numIm}_aff_tr.txt --ot 2 ${affineOptions} -T ${ncores} --sym-reg 2
+cp ${basePrefBase}/tempDir/${prefix}_${numIm}_aff_tr.txt ${previousAffine}
 
 # Non-Rigid registration
 
 # For basic atlases
-animaDenseSVFBMRegistration -r ${ref} -m ${basePrefBase}/tempDir/${prefix}_${numIm}_aff.nii.gz -o ${basePrefBase}/tempDir/${prefix}_${numIm}_bal.nii.gz -O ${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr.nii.gz --sr 1 --es 3 --fs 2 -T ${ncores} --sym-reg 2 --metric 1
+animaDenseSVFBMRegistration -r ${ref} -m ${basePrefBase}/tempDir/${prefix}_${numIm}_aff${ext} -o ${basePrefBase}/tempDir/${prefix}_${numIm}_bal${ext} -O ${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr${ext} --sr 1 --es 3 --fs 2 -T ${ncores} --sym-reg 2 --metric 1
 
-animaTransformSerieXmlGenerator -i ${basePrefBase}/tempDir/${prefix}_${numIm}_aff_tr.txt -i ${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr.nii.gz -o ${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr.xml
+animaTransformSerieXmlGenerator -i ${basePrefBase}/tempDir/${prefix}_${numIm}_aff_tr.txt -i ${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr${ext} -o ${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr.xml
 
-animaApplyTransformSerie -i ${prefixBase}/${prefix}_${numIm}.nii.gz -t ${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr.xml -o ${basePrefBase}/tempDir/${prefix}_${numIm}_bal.nii.gz -g ${ref} -p ${ncores}
+animaApplyTransformSerie -i ${prefixBase}/${prefix}_${numIm}.nii.gz -t ${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr.xml -o ${basePrefBase}/tempDir/${prefix}_${numIm}_bal${ext} -g ${ref} -p ${ncores}
 
 if [ -e ${basePrefBase}/Masks/Mask_${numIm}.nii.gz ]; then
-	animaApplyTransformSerie -i ${basePrefBase}/Masks/Mask_${numIm}.nii.gz -t ${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr.xml -o ${basePrefBase}/tempDir/${prefix}_${numIm}_mask.nii.gz -n nearest -g ${ref} -p ${ncores}
+	animaApplyTransformSerie -i ${basePrefBase}/Masks/Mask_${numIm}.nii.gz -t ${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr.xml -o ${basePrefBase}/tempDir/${prefix}_${numIm}_mask${ext} -n nearest -g ${ref} -p ${ncores}
 fi
 
-ln -s ${PWD}/${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr.nii.gz ${basePrefBase}/residualDir/${prefix}_${numIm}_bal_tr.nii.gz
+if [ "${ANIMA_ATLAS_STREAMING_MERGE}" == "1" ]; then
+	# Residual field and registered image go to the running averages of the iteration and are then removed
+	accumulateScript=`dirname $0`/../animaAccumulateImages.py
+	python ${accumulateScript} add -a ${basePrefBase}/tempDir/residualAccumulator -i ${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr${ext} -k ${ref%.nii.gz} --id ${numIm}
+
+	maskOption=''
+	if [ -e ${basePrefBase}/tempDir/${prefix}_${numIm}_mask${ext} ]; then
+		maskOption="-m ${basePrefBase}/tempDir/${prefix}_${numIm}_mask${ext}"
+	fi
+	python ${accumulateScript} add -a ${basePrefBase}/tempDir/intensityAccumulator -i ${basePrefBase}/tempDir/${prefix}_${numIm}_bal${ext} ${maskOption} -k ${ref%.nii.gz} --id ${numIm}
+
+	\rm -f ${basePrefBase}/tempDir/${prefix}_${numIm}_{bal_tr,bal,mask}${ext}
+	touch ${basePrefBase}/residualDir/${prefix}_${numIm}_flag
+else
+	ln -sf ${PWD}/${basePrefBase}/tempDir/${prefix}_${numIm}_bal_tr${ext} ${basePrefBase}/residualDir/${prefix}_${numIm}_bal_tr${ext}
 
-if [ -e ${basePrefBase}/residualDir/${prefix}_${numIm}_bal_tr.nii.gz ]; then
-    touch ${basePrefBase}/residualDir/${prefix}_${numIm}_flag
+	if [ -e ${basePrefBase}/residualDir/${prefix}_${numIm}_bal_tr${ext} ]; then
+		touch ${basePrefBase}/residualDir/${prefix}_${numIm}_flag
+	fi
 fi
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# Running (optionally mask weighted) average of images, updated as each atlas registration finishes so that residual
+# fields and registered images do not all have to be kept on disk until the merge. Sums are kept uncompressed in
+# memory-mapped files of an accumulator folder, shared by concurrent jobs through a file lock
+
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.images import readImage, readImageHeader, writeImage
+
+
+def _weightsShape(header, maskShape):
+    # Masks only have the spatial axes of the image, other axes (vector components, volumes) get weight broadcast
+    spatialAxes = header.fields["spatial axes"]
+    shape = []
+    maskAxis = 0
+    for axis in range(0, len(header.fields["shape"])):
+        if axis in spatialAxes and maskAxis < len(maskShape):
+            shape.append(maskShape[maskAxis])
+            maskAxis += 1
+        else:
+            shape.append(1)
+    return shape
+
+
+def _writeTemplate(imageFile, accumulatorDir):
+    # Header only copy of the first image, used as geometry template for the average (the image itself may be deleted)
+    header = readImageHeader(imageFile)
+    if header.fileFormat == "nrrd":
+        templateFile = os.path.join(accumulatorDir, "template.nrrd")
+        headerSize = header.fields["header size"]
+        with open(imageFile, 'rb') as f:
+            headerBytes = f.read(headerSize)
+    else:
+        templateFile = os.path.join(accumulatorDir, "template.nii")
+        if imageFile.endswith(".gz"):
+            import gzip
+            with gzip.open(imageFile, 'rb') as f:
+                headerBytes = f.read(header.fields["vox offset"])
+        else:
+            with open(imageFile, 'rb') as f:
+                headerBytes = f.read(header.fields["vox offset"])
+
+    with open(templateFile, 'wb') as f:
+        f.write(headerBytes)
+
+    return templateFile
+
+
+class Accumulator(object):
+
+    def __init__(self, accumulatorDir):
+        self.accumulatorDir = accumulatorDir
+        self.metadataFile = os.path.join(accumulatorDir, "accumulator.json")
+        self.sumFile = os.path.join(accumulatorDir, "sum.raw")
+        self.weightsFile = os.path.join(accumulatorDir, "weights.raw")
+
+    def __enter__(self):
+        if not os.path.isdir(self.accumulatorDir):
+            try:
+                os.makedirs(self.accumulatorDir)
+            except OSError:
+                if not os.path.isdir(self.accumulatorDir):
+                    raise
+
+        self.lockFile = open(os.path.join(self.accumulatorDir, "lock"), 'a')
+        fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+        self.metadata = None
+        if os.path.exists(self.metadataFile):
+            with open(self.metadataFile) as f:
+                self.metadata = json.load(f)
+        return self
+
+    def __exit__(self, excType, excValue, excTraceback):
+        fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+        self.lockFile.close()
+
+    def saveMetadata(self):
+        with open(self.metadataFile + ".tmp", 'w') as f:
+            json.dump(self.metadata, f)
+        os.rename(self.metadataFile + ".tmp", self.metadataFile)
+
+    def reset(self, key, imageFile, data, weightsShape):
+        for fileName in [self.sumFile, self.weightsFile, self.metadataFile]:
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+        self.metadata = {"key": key, "shape": list(data.shape), "weightsShape": weightsShape,
+                         "dtype": data.dtype.name if data.dtype.kind == 'f' else "float32",
+                         "template": _writeTemplate(imageFile, self.accumulatorDir), "members": [], "count": 0}
+        np.memmap(self.sumFile, dtype=np.float64, mode='w+', shape=tuple(data.shape)).flush()
+        if weightsShape is not None:
+            np.memmap(self.weightsFile, dtype=np.float64, mode='w+', shape=tuple(weightsShape)).flush()
+        self.saveMetadata()
+
+    def add(self, key, memberId, imageFile, data, weights):
+        weightsShape = None if weights is None else list(weights.shape)
+        if self.metadata is None or self.metadata["key"] != key:
+            self.reset(key, imageFile, data, weightsShape)
+
+        if list(data.shape) != self.metadata["shape"] or weightsShape != self.metadata["weightsShape"]:
+            raise ValueError("Image " + imageFile + " does not match accumulator " + self.accumulatorDir)
+
+        # Re-run jobs do not count twice
+        if memberId in self.metadata["members"]:
+            print("Image " + memberId + " already accumulated in " + self.accumulatorDir)
+            return
+
+        sumData = np.memmap(self.sumFile, dtype=np.float64, mode='r+', shape=tuple(data.shape))
+        if weights is None:
+            sumData += data
+        else:
+            sumData += data * weights
+            weightsData = np.memmap(self.weightsFile, dtype=np.float64, mode='r+', shape=tuple(weightsShape))
+            weightsData += weights
+            weightsData.flush()
+            del weightsData
+        sumData.flush()
+        del sumData
+
+        self.metadata["members"].append(memberId)
+        self.metadata["count"] += 1
+        self.saveMetadata()
+
+    def average(self):
+        if self.metadata is None or self.metadata["count"] == 0:
+            raise ValueError("Empty accumulator " + self.accumulatorDir)
+
+        shape = tuple(self.metadata["shape"])
+        sumData = np.array(np.memmap(self.sumFile, dtype=np.float64, mode='r', shape=shape))
+        if self.metadata["weightsShape"] is None:
+            return sumData / self.metadata["count"]
+
+        weights = np.memmap(self.weightsFile, dtype=np.float64, mode='r', shape=tuple(self.metadata["weightsShape"]))
+        weights = np.broadcast_to(weights, shape)
+        average = np.zeros(shape)
+        np.divide(sumData, weights, out=average, where=weights > 0)
+        return average
+
+
+def addImage(args):
+    # Images are read before taking the lock, only the in-place update is serialized
+    header, data = readImage(args.input)
+    weights = None
+    if args.mask != "":
+        maskHeader, mask = readImage(args.mask)
+        weights = (mask > 0).astype(np.float64).reshape(_weightsShape(header, mask.shape), order='F')
+
+    with Accumulator(args.accumulator) as accumulator:
+        accumulator.add(args.key, args.id if args.id != "" else os.path.abspath(args.input), args.input, data,
+                        weights)
+
+
+def finalizeAverage(args):
+    with Accumulator(args.accumulator) as accumulator:
+        average = accumulator.average()
+        templateHeader = readImageHeader(accumulator.metadata["template"])
+        print("Average of " + str(accumulator.metadata["count"]) + " images written to " + args.output)
+        writeImage(args.output, average.astype(accumulator.metadata["dtype"]), templateHeader,
+                   args.compression_level)
+
+    if args.clear:
+        shutil.rmtree(args.accumulator)
+
+
+parser = argparse.ArgumentParser(
+    prog='animaAccumulateImages',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="Streaming average of images: each 'add' updates the running sums of an accumulator folder, "
+                "'finalize' writes their average.")
+subparsers = parser.add_subparsers(dest="action")
+
+addParser = subparsers.add_parser("add", help="Add an image to an accumulator")
+addParser.add_argument('-a', '--accumulator', required=True, help='Accumulator folder (created if needed)')
+addParser.add_argument('-i', '--input', required=True, help='Image to add')
+addParser.add_argument('-m', '--mask', default="", help='Mask of the image: the average is then weighted by masks')
+addParser.add_argument('-k', '--key', default="",
+                       help='Accumulation key (e.g. the reference image): an accumulator with another key is reset')
+addParser.add_argument('--id', default="", help='Image identifier, an image is only added once (default: its path)')
+
+finalizeParser = subparsers.add_parser("finalize", help="Write the average of an accumulator")
+finalizeParser.add_argument('-a', '--accumulator', required=True, help='Accumulator folder')
+finalizeParser.add_argument('-o', '--output', required=True, help='Output average image')
+finalizeParser.add_argument('-c', '--compression-level', type=int, default=6,
+                            help='Output compression level, 0 for none (default: 6)')
+finalizeParser.add_argument('--clear', action='store_true', help='Remove the accumulator once the average is written')
+
+args = parser.parse_args()
+
+if args.action == "add":
+    addImage(args)
+elif args.action == "finalize":
+    finalizeAverage(args)
+else:
+    parser.print_help()
+    sys.exit(1)
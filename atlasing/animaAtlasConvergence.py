@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# Convergence metrics of an atlas iteration: RMS norm of the mean residual SVF (how much the template still moves) and
+# relative L2 change between the previous and new average images. Metrics are appended to a log and a flag file is
+# created once the change is below tolerance, so that the remaining iterations are skipped. Jobs of the remaining
+# iterations listed in the jobs file (written by the atlas drivers for batch systems) are cancelled
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.images import readImage
+from anima_scripts.schedulers import getScheduler
+
+parser = argparse.ArgumentParser(
+    prog='animaAtlasConvergence',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="Computes convergence metrics of an atlas iteration and flags convergence.")
+
+parser.add_argument('-s', '--svf', required=True, help='Mean residual SVF of the iteration (tempDir/sum.nii.gz)')
+parser.add_argument('-p', '--previous', required=True, help='Reference image of the iteration (previous average)')
+parser.add_argument('-c', '--current', required=True, help='Average image computed by the iteration')
+parser.add_argument('-k', '--iteration', type=int, required=True, help='Iteration number')
+parser.add_argument('-t', '--tolerance', type=float, required=True,
+                    help='Relative intensity change below which the atlas is converged')
+parser.add_argument('-T', '--svf-tolerance', type=float, default=-1,
+                    help='If positive, the mean SVF RMS norm (in mm) has to be below it as well')
+parser.add_argument('-l', '--log', default="convergence.txt", help='Metrics log (default: convergence.txt)')
+parser.add_argument('-f', '--flag', default="converged", help='Convergence flag file (default: converged)')
+parser.add_argument('-j', '--jobs', default="atlasJobs.txt",
+                    help='Submitted jobs, as "scheduler iteration jobId" lines (default: atlasJobs.txt)')
+
+args = parser.parse_args()
+
+svfHeader, svf = readImage(args.svf)
+spatialAxes = svfHeader.fields["spatial axes"]
+componentAxes = tuple(axis for axis in range(0, svf.ndim) if axis not in spatialAxes)
+squaredNorms = np.sum(np.square(svf.astype(np.float64)), axis=componentAxes) if len(componentAxes) > 0 else \
+    np.square(svf.astype(np.float64))
+svfRMS = float(np.sqrt(np.mean(squaredNorms)))
+
+previousHeader, previousImage = readImage(args.previous)
+currentHeader, currentImage = readImage(args.current)
+if previousImage.shape != currentImage.shape:
+    raise ValueError("Average images " + args.previous + " and " + args.current + " do not have the same size")
+
+previousNorm = np.linalg.norm(previousImage.astype(np.float64).ravel())
+intensityChange = float(np.linalg.norm((currentImage.astype(np.float64) - previousImage).ravel()) /
+                        max(previousNorm, np.finfo(np.float64).tiny))
+
+converged = intensityChange < args.tolerance and (args.svf_tolerance <= 0 or svfRMS < args.svf_tolerance)
+
+writeHeader = not os.path.exists(args.log)
+with open(args.log, 'a') as f:
+    if writeHeader:
+        f.write("iteration\tsvfRMS\tintensityChange\tconverged\n")
+    f.write(str(args.iteration) + "\t" + "%.6g" % svfRMS + "\t" + "%.6g" % intensityChange + "\t" +
+            str(int(converged)) + "\n")
+
+print("Iteration " + str(args.iteration) + ": mean SVF RMS " + "%.6g" % svfRMS + " mm, relative intensity change " +
+      "%.6g" % intensityChange)
+
+if converged:
+    print("Atlas converged at iteration " + str(args.iteration) + ", remaining iterations are skipped")
+    with open(args.flag, 'w') as f:
+        f.write(os.path.basename(args.current) + "\n")
+
+    remainingJobs = {}
+    if os.path.exists(args.jobs):
+        with open(args.jobs) as f:
+            for line in f:
+                items = line.split()
+                if len(items) == 3 and int(items[1]) > args.iteration:
+                    remainingJobs.setdefault(items[0], []).append(items[2])
+
+    for schedulerName, jobIds in sorted(remainingJobs.items()):
+        print("Cancelling jobs of the remaining iterations: " + " ".join(jobIds))
+        getScheduler(schedulerName, os.getcwd(), None).cancel(jobIds)
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+import argparse
+import sys
+
+import atexit
+import os
+import shutil
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.config import readConfig
+from anima_scripts.runner import CommandRunner
+from anima_scripts.schedulers import arrayIndexVariable, getScheduler
+
+try:
+    configParser = readConfig()
+except IOError as error:
+    print(str(error))
+    quit()
+
+animaDir = configParser.get("anima-scripts", 'anima')
+animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
+
+parser = argparse.ArgumentParser(
+    prog='animaBuildAtlas',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="Computes an atlas of scalar or DTI images using Anima registration tools and Guimond method "
+                "slightly modified to use the log-Euclidean framework. Images are <prefix>_1.nii.gz to "
+                "<prefix>_<n>.nii.gz, the atlas being built in the current folder. Registrations are run on this "
+                "machine or submitted to an OAR or SLURM cluster.")
+
+parser.add_argument('-p', '--prefix', required=True, help='Images prefix, relative to the current folder')
+parser.add_argument('-n', '--num-images', type=int, required=True, help='Number of images')
+parser.add_argument('-i', '--iterations', type=int, default=10, help='Number of atlas iterations (default: 10)')
+parser.add_argument('-c', '--cores', type=int, default=8, help='Number of cores of each job (default: 8)')
+parser.add_argument('-t', '--type', default="anatomical", choices=["anatomical", "dti"],
+                    help='Type of images (default: anatomical)')
+parser.add_argument('-s', '--scheduler', default="local", choices=["local", "oar", "slurm"],
+                    help='Where jobs are run: on this machine, or submitted to OAR or SLURM (default: local)')
+parser.add_argument('-j', '--max-cores', type=int, default=0,
+                    help='Number of cores shared by local jobs (default: all available cores)')
+parser.add_argument('--tolerance', type=float, default=0,
+                    help='Stop iterating once the relative change of the average image is below it (default: no check)')
+parser.add_argument('--svf-tolerance', type=float, default=0,
+                    help='With --tolerance, also require the mean residual SVF RMS norm (mm) to be below it')
+parser.add_argument('--warm-start', action='store_true',
+                    help='Start affine registrations from those of the previous iteration, with fewer pyramid levels')
+parser.add_argument('--walltime', default="",
+                    help='Registration and merge jobs walltime (default: 03:59:00 for anatomical, 07:59:00 for DTI '
+                         'registrations, 03:59:00 for merges)')
+parser.add_argument('--trace', type=str, default="",
+                    help="JSON lines file recording each local job (time, CPU, memory, I/O), summarized at the end")
+
+args = parser.parse_args()
+
+runner = CommandRunner(args.trace)
+if args.trace != "":
+    atexit.register(runner.printSummary)
+
+workDir = os.getcwd()
+# Merges start once registrations end, even failed ones: they report failures from the registration flags, on OAR and
+# SLURM alike
+scheduler = getScheduler(args.scheduler, workDir, runner, args.max_cores, "afterany")
+
+if args.type == "dti":
+    registerScript = os.path.join(animaScriptsDir, "atlasing", "dti", "animaRegisterDTImage.sh")
+    mergeScript = os.path.join(animaScriptsDir, "atlasing", "dti", "animaMergeDTImages.sh")
+    averagePrefix = "averageDTI"
+    registrationWalltime = "07:59:00"
+else:
+    registerScript = os.path.join(animaScriptsDir, "atlasing", "anatomical", "animaRegisterImage.sh")
+    mergeScript = os.path.join(animaScriptsDir, "atlasing", "anatomical", "animaMergeImages.sh")
+    averagePrefix = "averageForm"
+    registrationWalltime = "03:59:00"
+
+mergeWalltime = "03:59:00"
+if args.walltime != "":
+    registrationWalltime = args.walltime
+    mergeWalltime = args.walltime
+
+# Merges start once registration jobs ended: registration flags still missing are only waited for during a short grace
+# period (network file system lag), a registration killed by the scheduler never creating its flag
+os.environ.setdefault("ANIMA_ATLAS_MERGE_TIMEOUT", "60")
+
+for folder in ["tempDir", "residualDir"]:
+    if not os.path.isdir(folder):
+        os.mkdir(folder)
+
+ref = args.prefix + "_1"
+# Current folder as given by dirname in the shell scripts, the job scripts reading prefixBase/prefix_index
+prefixBase = os.path.dirname(args.prefix) or "."
+prefix = os.path.basename(args.prefix)
+environmentCommands = ["export PATH=" + quote(os.environ.get("PATH", "") + ":" + animaDir + ":"),
+                       "cd " + quote(workDir)]
+
+if args.tolerance > 0:
+    os.environ["ANIMA_ATLAS_TOLERANCE"] = str(args.tolerance)
+    if args.svf_tolerance > 0:
+        os.environ["ANIMA_ATLAS_SVF_TOLERANCE"] = str(args.svf_tolerance)
+
+if args.warm_start:
+    os.environ["ANIMA_ATLAS_WARM_START"] = "1"
+
+# Intermediate files format and compression of the configuration file, unless already set for the jobs
+if configParser.has_option("anima-scripts", "intermediate-format"):
+    os.environ.setdefault("ANIMA_ATLAS_INTERMEDIATE_FORMAT", configParser.get("anima-scripts", "intermediate-format"))
+if configParser.has_option("anima-scripts", "intermediate-compression"):
+    os.environ.setdefault("ANIMA_ATLAS_INTERMEDIATE_COMPRESSION",
+                          configParser.get("anima-scripts", "intermediate-compression"))
+intermediateExtension = "." + os.environ.get("ANIMA_ATLAS_INTERMEDIATE_FORMAT", "nii.gz")
+
+# Atlas options given as ANIMA_ATLAS_* environment variables (e.g. ANIMA_ATLAS_STREAMING_MERGE=1) are passed to jobs
+for variable in sorted(os.environ.keys()):
+    if variable.startswith("ANIMA_ATLAS_"):
+        environmentCommands.append("export " + variable + "=" + quote(os.environ[variable]))
+
+# In the first iteration we take the first image as reference, then it is used in the dataset
+firstImage = 2
+previousMergeIds = []
+
+# Jobs submitted to a batch system, cancelled by the convergence check of an earlier iteration
+jobsFile = "atlasJobs.txt"
+if os.path.exists(jobsFile):
+    os.remove(jobsFile)
+
+# Iterations stop once the average image does not change anymore, args.iterations being an upper bound
+for k in range(1, args.iterations + 1):
+    if os.path.exists("converged"):
+        print("Atlas already converged, no more iterations")
+        break
+
+    if os.path.exists("it_" + str(k) + "_done"):
+        ref = averagePrefix + str(k)
+        firstImage = 1
+        continue
+
+    print("*************Iteration " + str(k) + " Processing Reference: " + ref)
+
+    # Affines kept for warm starts are only valid within one atlas construction
+    if k == 1 and os.path.isdir("affineDir"):
+        shutil.rmtree("affineDir")
+
+    for a in range(firstImage, args.num_images + 1):
+        for suffix in ["_bal_tr" + intermediateExtension, "_flag", "_failed"]:
+            residualFile = os.path.join("residualDir", prefix + "_" + str(a) + suffix)
+            if os.path.lexists(residualFile):
+                os.remove(residualFile)
+
+    registrationCommands = environmentCommands + [
+        "let index=${" + arrayIndexVariable + "}+" + str(firstImage - 1),
+        " ".join([quote(registerScript), quote(workDir), quote(ref + ".nii.gz"), quote(prefixBase), quote(prefix),
+                  "$index", str(args.cores)])]
+    registrationIds = scheduler.submit("reg-" + str(k), "tmpRun_" + str(k), registrationCommands, args.cores,
+                                       registrationWalltime, args.num_images - firstImage + 1, previousMergeIds)
+
+    mergeCommands = environmentCommands + [
+        " ".join([quote(mergeScript), quote(workDir), quote(prefixBase), quote(prefix), str(k), str(args.num_images),
+                  quote(ref), str(args.cores)])]
+    previousMergeIds = scheduler.submit("merge-" + str(k), "mergeRun_" + str(k), mergeCommands, args.cores,
+                                        mergeWalltime, 0, registrationIds)
+    if args.scheduler != "local":
+        with open(jobsFile, 'a') as f:
+            for jobId in registrationIds + previousMergeIds:
+                f.write(args.scheduler + " " + str(k) + " " + jobId + "\n")
+
+    ref = averagePrefix + str(k)
+    firstImage = 1
+
+scheduler.wait()
@@ -0,0 +1,71 @@
+#!/bin/bash
+# Waits for the registrations of images firstIndex to nimages of an atlas iteration: each one ends by creating
+# residualDir/prefix_index_flag, or residualDir/prefix_index_failed if it failed
+# Wakes up on file creation in residualDir when inotifywait is available, otherwise checks every few seconds
+# Exits with 1 as soon as a registration failed, with 2 if some are still missing after the timeout (in seconds,
+# ANIMA_ATLAS_MERGE_TIMEOUT environment variable, 0 to wait without limit). Merges start once registration jobs ended,
+# so the default timeout is only a grace period for flags not yet visible on network file systems: a registration
+# killed by the scheduler never creates its flag
+
+residualDir=${1}
+prefix=${2}
+firstIndex=${3}
+nimages=${4}
+
+timeout=${ANIMA_ATLAS_MERGE_TIMEOUT:-60}
+pollInterval=${ANIMA_ATLAS_POLL_INTERVAL:-10}
+
+useInotify=0
+if command -v inotifywait > /dev/null 2>&1; then
+	useInotify=1
+fi
+
+startTime=`date +%s`
+while true
+do
+	missing=''
+	failed=''
+	for ((a=${firstIndex};a<=${nimages};a++))
+	do
+		if [ -e ${residualDir}/${prefix}_${a}_failed ]; then
+			failed="${failed} ${a}"
+		elif [ ! -e ${residualDir}/${prefix}_${a}_flag ]; then
+			missing="${missing} ${a}"
+		fi
+	done
+
+	if [ "${failed}" != "" ]; then
+		echo "Failed registrations of images:${failed}" >&2
+		if [ "${missing}" != "" ]; then
+			echo "Registrations not finished for images:${missing}" >&2
+		fi
+		exit 1
+	fi
+
+	if [ "${missing}" == "" ]; then
+		exit 0
+	fi
+
+	let elapsed=`date +%s`-${startTime}
+	if [ ${timeout} -gt 0 ] && [ ${elapsed} -ge ${timeout} ]; then
+		echo "Registrations still missing after ${timeout}s for images:${missing}" >&2
+		exit 2
+	fi
+
+	waitTime=60
+	if [ ${timeout} -gt 0 ]; then
+		let waitTime=${timeout}-${elapsed}
+	fi
+	if [ ${useInotify} -eq 1 ]; then
+		# Bounded wait in case a flag was created between the check above and the start of inotifywait
+		if [ ${waitTime} -gt 60 ]; then
+			waitTime=60
+		fi
+		inotifywait -qq -t ${waitTime} -e create -e moved_to -e attrib ${residualDir} > /dev/null 2>&1
+	else
+		if [ ${waitTime} -gt ${pollInterval} ]; then
+			waitTime=${pollInterval}
+		fi
+		sleep ${waitTime}
+	fi
+done
@@ -1,10 +1,28 @@
 #! /bin/bash
 # Computes an atlas of DTI images using Anima registration tools and Guimond method slightly modified to use the log-Euclidean framework
 # Has to be run on an OAR cluster
+# ANIMA_ATLAS_* environment variables (e.g. ANIMA_ATLAS_STREAMING_MERGE=1) are passed on to the jobs
+# With ANIMA_ATLAS_TOLERANCE set, iterations stop once the average image changes less than this (relative L2 change)
+# With ANIMA_ATLAS_WARM_START=1, affine registrations start from the previous iteration ones
+# ANIMA_ATLAS_INTERMEDIATE_FORMAT (e.g. nii for uncompressed files) sets the format of tempDir and residualDir files
 
 # Get local variables
 . ~/.anima/configParser.sh
 
+# Intermediate files format and compression of the configuration file, unless already given to the jobs
+if [ "${ANIMA_ATLAS_INTERMEDIATE_FORMAT}" == "" ] && [ "${ANIMA_INTERMEDIATE_FORMAT}" != "" ]; then
+	export ANIMA_ATLAS_INTERMEDIATE_FORMAT=${ANIMA_INTERMEDIATE_FORMAT}
+fi
+
+if [ "${ANIMA_ATLAS_INTERMEDIATE_COMPRESSION}" == "" ] && [ "${ANIMA_INTERMEDIATE_COMPRESSION}" != "" ]; then
+	export ANIMA_ATLAS_INTERMEDIATE_COMPRESSION=${ANIMA_INTERMEDIATE_COMPRESSION}
+fi
+
+ext=.${ANIMA_ATLAS_INTERMEDIATE_FORMAT:-nii.gz}
+
+# Merges start once registration jobs ended, their missing flags are only waited for during a short grace period
+export ANIMA_ATLAS_MERGE_TIMEOUT=${ANIMA_ATLAS_MERGE_TIMEOUT:-60}
+
 prefixDTI=$1
 nimages=$2
 niter=$3
@@ -13,6 +31,9 @@ ncores=$4
 mkdir tempDir
 mkdir residualDir
 
+# Submitted jobs, cancelled by the convergence check of an earlier iteration
+rm -f atlasJobs.txt
+
 refDTI=${prefixDTI}_1
 
 prefixDTIBase=`dirname ${prefixDTI}`
@@ -24,6 +45,11 @@ previousMergeId=0
 
 for((k=1;k<=$niter;k++))
 do
+  if [ -e converged ]; then
+      echo "Atlas already converged (`cat converged`), no more iterations"
+      break
+  fi
+
   if [ -e it_${k}_done ]; then
       refDTI=averageDTI${k}
       firstImage=1
@@ -35,9 +61,14 @@ do
   echo " "
   echo "*************Iteration $k Processing Reference: $refDTI "
 
+	# Affines kept for warm starts are only valid within one atlas construction
+	if [ ${k} -eq 1 ]; then
+		rm -rf affineDir
+	fi
+
 	for ((a=$firstImage;a<=$nimages;a++))
 	do
-		rm -f residualDir/${prefixDTI}_${a}_{bal_tr.nii.gz,flag}
+		rm -f residualDir/${prefixDTI}_${a}_{bal_tr${ext},flag,failed}
 	done
 
 	let nrun=${nimages}-${firstImage}+1
@@ -50,8 +81,12 @@ do
 	echo "#OAR -O ${PWD}/reg-${k}.%jobid%.output" >> tmpRun_${k}
 	echo "#OAR -E ${PWD}/reg-${k}.%jobid%.error" >> tmpRun_${k}
 
-	echo "export PATH=${PATH}:${ANIMA_DIR}:" >> tmpRun_${k}
-	echo "cd ${PWD}" >> tmpRun_${k}
+	# Values quoted for the job shell, whatever their spaces or special characters
+	printf 'export PATH=%q\n' "${PATH}:${ANIMA_DIR}:" >> tmpRun_${k}
+	for variable in $(compgen -e | grep '^ANIMA_ATLAS_'); do
+		printf 'export %s=%q\n' "${variable}" "${!variable}" >> tmpRun_${k}
+	done
+	printf 'cd %q\n' "${PWD}" >> tmpRun_${k}
 
 	if [ ${k} -eq 1 ]; then
 		echo "let index=\${OAR_ARRAY_INDEX}+1" >> tmpRun_${k}
@@ -78,6 +113,7 @@ do
 
 		tmpid=`echo $tmpstr | awk -F 'OAR_JOB_ID' '{print $2;exit}' | sed "s/\=//g"`
 		jobsId="${jobsId} -a ${tmpid}"
+		echo "oar ${k} ${tmpid}" >> atlasJobs.txt
 	done
 
 	echo "#!/bin/bash" > mergeRun_${k}
@@ -85,14 +121,19 @@ do
 	echo "#OAR -O ${PWD}/merge-${k}.%jobid%.output" >> mergeRun_${k}
 	echo "#OAR -E ${PWD}/merge-${k}.%jobid%.error" >> mergeRun_${k}
 
-	echo "export PATH=${PATH}:${ANIMA_DIR}:" >> mergeRun_${k}
-	echo "cd ${PWD}" >> mergeRun_${k}
+	# Values quoted for the job shell, whatever their spaces or special characters
+	printf 'export PATH=%q\n' "${PATH}:${ANIMA_DIR}:" >> mergeRun_${k}
+	for variable in $(compgen -e | grep '^ANIMA_ATLAS_'); do
+		printf 'export %s=%q\n' "${variable}" "${!variable}" >> mergeRun_${k}
+	done
+	printf 'cd %q\n' "${PWD}" >> mergeRun_${k}
 	echo "${ROOT_PUBLIC_DIR}/atlasing/dti/animaMergeDTImages.sh ${PWD} ${prefixDTIBase} ${prefixDTI} ${k} ${nimages} ${refDTI} ${ncores}" >> mergeRun_${k}
 
 	chmod u+x mergeRun_${k}
 
 	a=`oarsub -n merge-${k} -S ${PWD}/mergeRun_${k} ${jobsId}`
 	previousMergeId=`echo $a | awk -F 'OAR_JOB_ID' '{print $2;exit}' | sed "s/\=//g"`
+	echo "oar ${k} ${previousMergeId}" >> atlasJobs.txt
 
     refDTI=averageDTI${k}
     firstImage=1
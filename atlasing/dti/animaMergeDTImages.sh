@@ -1,6 +1,16 @@
 #!/bin/bash
 
 cd ${1}
+
+# The atlas converged at a previous iteration: nothing left to do
+if [ -e converged ]; then
+	exit 0
+fi
+
+# Intermediate files format (ANIMA_ATLAS_INTERMEDIATE_FORMAT: nii.gz, nii or nrrd), nii avoids compressing files that
+# are removed at the end of the iteration
+ext=.${ANIMA_ATLAS_INTERMEDIATE_FORMAT:-nii.gz}
+
 prefixDTIBase=${2}
 prefixDTI=${3}
 k=${4}
@@ -11,59 +21,82 @@ ncores=${7}
 
 # test if all images are here
 
-nimTest=$nimages
+firstIndex=1
 if [ $k -eq 1 ]; then
-	let nimTest=nimTest-1
+	firstIndex=2
 fi
 
-numData=`ls -l residualDir/${prefixDTI}_*_flag | wc -l`
-while (($numData < $nimTest))
-do
-	echo Missing data $numData $nimTest
-	sleep 600
-	numData=`ls -l residualDir/${prefixDTI}_*_flag | wc -l`
-done
+# Returns as soon as all registrations are done, fails if some failed or did not finish in time
+`dirname $0`/../animaWaitForRegistrations.sh residualDir ${prefixDTI} ${firstIndex} ${nimages}
+if [ $? -ne 0 ]; then
+	echo "Merge of iteration ${k} aborted" >&2
+	exit 1
+fi
 
 # if ok proceed
 if [ $k -eq 1 ]; then
-	cp ${prefixDTIBase}/${prefixDTI}_1.nii.gz tempDir/${prefixDTI}_1_bal.nii.gz 
+	if [ "${ext}" == ".nii.gz" ]; then
+		cp ${prefixDTIBase}/${prefixDTI}_1.nii.gz tempDir/${prefixDTI}_1_bal${ext}
+	else
+		animaConvertImage -i ${prefixDTIBase}/${prefixDTI}_1.nii.gz -o tempDir/${prefixDTI}_1_bal${ext}
+	fi
 	
-	animaComputeDTIScalarMaps -i tempDir/${prefixDTI}_1_bal.nii.gz -a tempDir/${prefixDTI}_1_bal_ADC.nii.gz -p ${ncores}
-	animaThrImage -i tempDir/${prefixDTI}_1_bal_ADC.nii.gz -t 0 -o tempDir/${prefixDTI}_1_tensMask.nii.gz
-	\rm -f tempDir/${prefixDTI}_1_bal_ADC.nii.gz
+	animaComputeDTIScalarMaps -i tempDir/${prefixDTI}_1_bal${ext} -a tempDir/${prefixDTI}_1_bal_ADC${ext} -p ${ncores}
+	animaThrImage -i tempDir/${prefixDTI}_1_bal_ADC${ext} -t 0 -o tempDir/${prefixDTI}_1_tensMask${ext}
+	\rm -f tempDir/${prefixDTI}_1_bal_ADC${ext}
 	
-	animaCreateImage -o residualDir/${prefixDTI}_1_bal_tr.nii.gz -b 0 -g ${prefixDTIBase}/${prefixDTI}_1.nii.gz -v 3
+	animaCreateImage -o residualDir/${prefixDTI}_1_bal_tr${ext} -b 0 -g ${prefixDTIBase}/${prefixDTI}_1.nii.gz -v 3
+
+	if [ "${ANIMA_ATLAS_STREAMING_MERGE}" == "1" ]; then
+		python `dirname $0`/../animaAccumulateImages.py add -a tempDir/residualAccumulator -i residualDir/${prefixDTI}_1_bal_tr${ext} -k ${refDTI} --id 1
+	fi
 fi
 
 rm -f refDTIs.txt masksTens.txt sum.txt
 for ((a=1;a<=$nimages;a++))
 do
-	echo tempDir/${prefixDTI}_${a}_bal.nii.gz >> refDTIs.txt
-	echo tempDir/${prefixDTI}_${a}_tensMask.nii.gz >> masksTens.txt
-	echo residualDir/${prefixDTI}_${a}_bal_tr.nii.gz >> sum.txt
+	echo tempDir/${prefixDTI}_${a}_bal${ext} >> refDTIs.txt
+	echo tempDir/${prefixDTI}_${a}_tensMask${ext} >> masksTens.txt
 done
 
-animaAverageImages -i refDTIs.txt -o tempDir/DTIAverageDiv.nii.gz -m masksTens.txt
-animaAverageImages -i masksTens.txt -o tempDir/meanMasks_${k}.nii.gz
-animaThrImage -i tempDir/meanMasks_${k}.nii.gz -o tempDir/thrMasks_${k}.nii.gz -t 0.25
-animaMaskImage -i tempDir/DTIAverageDiv.nii.gz -m tempDir/thrMasks_${k}.nii.gz -o tempDir/DTIAverageDiv.nii.gz
+animaAverageImages -i refDTIs.txt -o tempDir/DTIAverageDiv${ext} -m masksTens.txt
+animaAverageImages -i masksTens.txt -o tempDir/meanMasks_${k}${ext}
+animaThrImage -i tempDir/meanMasks_${k}${ext} -o tempDir/thrMasks_${k}${ext} -t 0.25
+animaMaskImage -i tempDir/DTIAverageDiv${ext} -m tempDir/thrMasks_${k}${ext} -o tempDir/DTIAverageDiv${ext}
 
-animaAverageImages -i sum.txt -o tempDir/sum.nii.gz
+# Residual fields are either averaged as registrations finish (streaming merge) or all at once here
+if [ "${ANIMA_ATLAS_STREAMING_MERGE}" == "1" ]; then
+	python `dirname $0`/../animaAccumulateImages.py finalize -a tempDir/residualAccumulator -o tempDir/sum${ext} -c ${ANIMA_ATLAS_INTERMEDIATE_COMPRESSION:-6}
+else
+	for ((a=1;a<=$nimages;a++))
+	do
+		echo residualDir/${prefixDTI}_${a}_bal_tr${ext} >> sum.txt
+	done
+
+	animaAverageImages -i sum.txt -o tempDir/sum${ext}
+fi
 
-animaTransformSerieXmlGenerator -i tempDir/sum.nii.gz -I 1 -o tempDir/trsf.xml
+animaTransformSerieXmlGenerator -i tempDir/sum${ext} -I 1 -o tempDir/trsf.xml
 
 for ((a=1;${a}<=$nimages;a++))
 do
-	\rm -f residualDir/${prefixDTI}_${a}_bal_tr.nii.gz
+	\rm -f residualDir/${prefixDTI}_${a}_bal_tr${ext}
 done
 
 # the averaged transform is used in the intensity averaged image
 
-animaTensorApplyTransformSerie -i tempDir/DTIAverageDiv.nii.gz -o averageDTI${k}.nii.gz -t tempDir/trsf.xml -g ${refDTI}.nii.gz -p ${ncores}
+animaTensorApplyTransformSerie -i tempDir/DTIAverageDiv${ext} -o averageDTI${k}.nii.gz -t tempDir/trsf.xml -g ${refDTI}.nii.gz -p ${ncores}
 animaComputeDTIScalarMaps -i averageDTI${k}.nii.gz -a averageDTI${k}_ADC.nii.gz -p ${ncores}
 
 if [ -e averageDTI${k}.nii.gz ]; then
 	touch it_${k}_done
+
+	# Convergence check, enabled by a tolerance on the relative change of the average image
+	if [ "${ANIMA_ATLAS_TOLERANCE}" != "" ]; then
+		python `dirname $0`/../animaAtlasConvergence.py -s tempDir/sum${ext} -p ${refDTI}.nii.gz -c averageDTI${k}.nii.gz -k ${k} -t ${ANIMA_ATLAS_TOLERANCE} -T ${ANIMA_ATLAS_SVF_TOLERANCE:--1}
+	fi
+
+	\rm -rf tempDir/residualAccumulator
 	let t=k+1
 	if [ -e tmpRun_${t} ]; then
 		\rm -f tmpRun_${k} reg-DTI-${k}-* residualDir/* tempDir/*
@@ -1,6 +1,16 @@
 #!/bin/bash
 
 cd ${1}
+
+# The atlas converged at a previous iteration: nothing left to do
+if [ -e converged ]; then
+	exit 0
+fi
+
+# Intermediate files format (ANIMA_ATLAS_INTERMEDIATE_FORMAT: nii.gz, nii or nrrd), nii avoids compressing files that
+# are removed at the end of the iteration
+ext=.${ANIMA_ATLAS_INTERMEDIATE_FORMAT:-nii.gz}
+
 dtiRef=${2}
 prefixDTIBase=${3}
 prefixDTI=${4}
@@ -9,41 +19,72 @@ ncores=${6}
 
 basePrefBase=`dirname ${prefixDTIBase}`
 
+# Any failing command stops the registration and flags it as failed, so that the merge does not wait for it
+failedFlag=${basePrefBase}/residualDir/${prefixDTI}_${numIm}_failed
+rm -f ${failedFlag}
+
+registrationFailed() {
+	touch ${failedFlag}
+	exit 1
+}
+
+set -e
+trap registrationFailed ERR TERM INT
+
 # Rigid / affine registration
 animaComputeDTIScalarMaps -i ${prefixDTIBase}/${prefixDTI}_${numIm}.nii.gz -a ${prefixDTIBase}/${prefixDTI}_ADC_${numIm}.nii.gz -p ${ncores}
 
-animaPyramidalBMRegistration -r ${dtiRef%.nii.gz}_ADC.nii.gz -m ${prefixDTIBase}/${prefixDTI}_ADC_${numIm}.nii.gz -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_rig.nii.gz -O ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_rig_tr.txt --sp 3 -s 0 --opt 1 --fr 0.01 -a 2 --at 0.8 -p 4 -l 0 -T ${ncores} --sym-reg 2
+# With ANIMA_ATLAS_WARM_START=1, the affine registration starts from the affine of the previous iteration (kept in
+# affineDir) instead of a new rigid registration, with ANIMA_ATLAS_WARM_START_LEVELS pyramid levels (default 2)
+mkdir -p ${basePrefBase}/affineDir
+previousAffine=${basePrefBase}/affineDir/${prefixDTI}_${numIm}_aff_tr.txt
+if [ "${ANIMA_ATLAS_WARM_START}" == "1" ] && [ -e ${previousAffine} ]; then
+	initialTransform=${previousAffine}
+	affinePyramid="-p ${ANIMA_ATLAS_WARM_START_LEVELS:-2} -l 0"
+else
+	animaPyramidalBMRegistration -r ${dtiRef%.nii.gz}_ADC.nii.gz -m ${prefixDTIBase}/${prefixDTI}_ADC_${numIm}.nii.gz -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_rig${ext} -O ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_rig_tr.txt --sp 3 -s 0 --opt 1 --fr 0.01 -a 2 --at 0.8 -p 4 -l 0 -T ${ncores} --sym-reg 2
+	initialTransform=${basePrefBase}/tempDir/${prefixDTI}_${numIm}_rig_tr.txt
+	affinePyramid="-p 4 -l 0"
+fi
 
-animaPyramidalBMRegistration -r ${dtiRef%.nii.gz}_ADC.nii.gz -m ${prefixDTIBase}/${prefixDTI}_ADC_${numIm}.nii.gz -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff.nii.gz -i ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_rig_tr.txt -O ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff_tr.txt --sp 3 -s 0 --opt 1 --ot 2 --fr 0.01 -a 2 --at 0.8 -p 4 -l 0 -T ${ncores} --sym-reg 2
+animaPyramidalBMRegistration -r ${dtiRef%.nii.gz}_ADC.nii.gz -m ${prefixDTIBase}/${prefixDTI}_ADC_${numIm}.nii.gz -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff${ext} -i ${initialTransform} -O ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff_tr.txt --sp 3 -s 0 --opt 1 --ot 2 --fr 0.01 -a 2 --at 0.8 ${affinePyramid} -T ${ncores} --sym-reg 2
+cp ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff_tr.txt ${previousAffine}
 
 # Cropping ref since acquisitions may not cover the whole brain
 dtiRefCr=${dtiRef%.nii.gz}_${numIm}_c.nii.gz
 
 animaTransformSerieXmlGenerator -i ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff_tr.txt -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff_tr.xml
 
-animaCreateImage -b 1 -v 1 -g ${prefixDTIBase}/${prefixDTI}_${numIm}.nii.gz -o ${basePrefBase}/tempDir/tmpFullMask_${numIm}.nii.gz
-animaApplyTransformSerie -g ${dtiRef%.nii.gz}_ADC.nii.gz -i ${basePrefBase}/tempDir/tmpFullMask_${numIm}.nii.gz -t ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff_tr.xml -o ${basePrefBase}/tempDir/tmpMask_${numIm}.nii.gz -p ${ncores}
-animaMaskImage -i ${dtiRef} -m ${basePrefBase}/tempDir/tmpMask_${numIm}.nii.gz -o ${dtiRefCr}
+animaCreateImage -b 1 -v 1 -g ${prefixDTIBase}/${prefixDTI}_${numIm}.nii.gz -o ${basePrefBase}/tempDir/tmpFullMask_${numIm}${ext}
+animaApplyTransformSerie -g ${dtiRef%.nii.gz}_ADC.nii.gz -i ${basePrefBase}/tempDir/tmpFullMask_${numIm}${ext} -t ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff_tr.xml -o ${basePrefBase}/tempDir/tmpMask_${numIm}${ext} -p ${ncores}
+animaMaskImage -i ${dtiRef} -m ${basePrefBase}/tempDir/tmpMask_${numIm}${ext} -o ${dtiRefCr}
 
-animaTensorApplyTransformSerie -i ${prefixDTIBase}/${prefixDTI}_${numIm}.nii.gz -g ${dtiRef} -t ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff_tr.xml -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff.nii.gz -p ${ncores}
+animaTensorApplyTransformSerie -i ${prefixDTIBase}/${prefixDTI}_${numIm}.nii.gz -g ${dtiRef} -t ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff_tr.xml -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff${ext} -p ${ncores}
 
 # Non-Rigid registration
 
 # For basic atlases
-animaDenseTensorSVFBMRegistration -r ${dtiRefCr} -m ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff.nii.gz -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal.nii.gz -O ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr.nii.gz --sp 2 -s 0.001 --opt 1 --sr 1 --fr 0.01 -a 0 -p 4 -l 0 --metric 3 -T ${ncores} --sym-reg 2
+animaDenseTensorSVFBMRegistration -r ${dtiRefCr} -m ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff${ext} -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal${ext} -O ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr${ext} --sp 2 -s 0.001 --opt 1 --sr 1 --fr 0.01 -a 0 -p 4 -l 0 --metric 3 -T ${ncores} --sym-reg 2
 
 \rm -f ${dtiRefCr}
 
-animaTransformSerieXmlGenerator -i ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff_tr.txt -i ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr.nii.gz -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr.xml
+animaTransformSerieXmlGenerator -i ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_aff_tr.txt -i ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr${ext} -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr.xml
 
-animaTensorApplyTransformSerie -i ${prefixDTIBase}/${prefixDTI}_${numIm}.nii.gz -t ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr.xml -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal.nii.gz -g ${dtiRef} -p ${ncores}
+animaTensorApplyTransformSerie -i ${prefixDTIBase}/${prefixDTI}_${numIm}.nii.gz -t ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr.xml -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal${ext} -g ${dtiRef} -p ${ncores}
 
-animaComputeDTIScalarMaps -i ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal.nii.gz -a ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_ADC.nii.gz -p ${ncores}
-animaThrImage -i ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_ADC.nii.gz -t 0 -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_tensMask.nii.gz
-\rm -f ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_ADC.nii.gz
+animaComputeDTIScalarMaps -i ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal${ext} -a ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_ADC${ext} -p ${ncores}
+animaThrImage -i ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_ADC${ext} -t 0 -o ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_tensMask${ext}
+\rm -f ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_ADC${ext}
 
-ln -s ${PWD}/${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr.nii.gz ${basePrefBase}/residualDir/${prefixDTI}_${numIm}_bal_tr.nii.gz
+if [ "${ANIMA_ATLAS_STREAMING_MERGE}" == "1" ]; then
+	# Residual field goes to the running average of the iteration and is then removed
+	python `dirname $0`/../animaAccumulateImages.py add -a ${basePrefBase}/tempDir/residualAccumulator -i ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr${ext} -k ${dtiRef%.nii.gz} --id ${numIm}
+	\rm -f ${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr${ext}
+	touch ${basePrefBase}/residualDir/${prefixDTI}_${numIm}_flag
+else
+	ln -sf ${PWD}/${basePrefBase}/tempDir/${prefixDTI}_${numIm}_bal_tr${ext} ${basePrefBase}/residualDir/${prefixDTI}_${numIm}_bal_tr${ext}
 
-if [ -e ${basePrefBase}/residualDir/${prefixDTI}_${numIm}_bal_tr.nii.gz ]; then
-    touch ${basePrefBase}/residualDir/${prefixDTI}_${numIm}_flag
+	if [ -e ${basePrefBase}/residualDir/${prefixDTI}_${numIm}_bal_tr${ext} ]; then
+		touch ${basePrefBase}/residualDir/${prefixDTI}_${numIm}_flag
+	fi
 fi
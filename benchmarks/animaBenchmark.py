@@ -0,0 +1,290 @@
+#!/usr/bin/python
+# Benchmark of the scripts orchestration (scheduling, caching, scratch usage) without Anima nor real data: the scripts
+# are run on synthetic images with fake Anima tools (see fakeTools.py) spending a modeled time, for several cores
+# budgets. Reports end-to-end latency, total and critical path tool times, speedup and scratch disk high-water mark
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.images import ImageHeader
+from anima_scripts.resources import threadOptions
+from fakeTools import syntheticData, toolContracts, writeFakeImage
+
+benchmarkDir = os.path.dirname(os.path.realpath(__file__))
+scriptsDir = os.path.join(benchmarkDir, os.pardir)
+scenarios = ["brainExtraction", "dwiPreprocessing", "mcmEstimation", "msExam", "atlas"]
+
+parser = argparse.ArgumentParser(
+    prog='animaBenchmark',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="Runs the Anima scripts with fake Anima tools on synthetic images and reports end-to-end latency, "
+                "total and critical path tool times, parallel speedup and scratch disk high-water mark for each "
+                "cores budget. Tools sleep (or burn CPU) for scale seconds per 1e5 voxels times their relative cost.")
+
+parser.add_argument('-w', '--work-dir', default="animaBenchmark",
+                    help="Folder of the generated data and runs (default: animaBenchmark)")
+parser.add_argument('-s', '--scenarios', nargs='+', default=scenarios, choices=scenarios,
+                    help="Scenarios to run (default: all)")
+parser.add_argument('-c', '--cores', default="1,2,4", help="Comma separated cores budgets (default: 1,2,4)")
+parser.add_argument('--mode', default="sleep", choices=["sleep", "burn"],
+                    help="Fake tools sleep, or burn CPU on as many processes as threads (default: sleep)")
+parser.add_argument('--scale', type=float, default=1.0,
+                    help="Seconds per 1e5 voxels (times volumes) of a tool of unit cost (default: 1)")
+parser.add_argument('--parallel-fraction', type=float, default=0.9,
+                    help="Part of the tools time that scales with their threads (default: 0.9)")
+parser.add_argument('--size', type=int, default=48, help="Size of the synthetic images along each axis (default: 48)")
+parser.add_argument('--volumes', type=int, default=31, help="Number of DWI volumes (default: 31)")
+parser.add_argument('--images', type=int, default=4,
+                    help="Number of images of the brain extraction and atlas scenarios (default: 4)")
+parser.add_argument('--iterations', type=int, default=2, help="Number of atlas iterations (default: 2)")
+parser.add_argument('-o', '--report', default="", help="JSON report of all runs")
+parser.add_argument('--keep', action='store_true', help="Keep the runs folders (outputs, tool logs)")
+
+args = parser.parse_args()
+
+coresList = sorted(set(int(cores) for cores in args.cores.split(",")))
+workDir = os.path.abspath(args.work_dir)
+fakeBinDir = os.path.join(workDir, "bin")
+extraDataDir = os.path.join(workDir, "data")
+for folder in [fakeBinDir, os.path.join(extraDataDir, "icc_atlas")]:
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+# Fake toolset: one wrapper per tool running the fake tool script with this interpreter
+for toolName in toolContracts:
+    toolWrapper = os.path.join(fakeBinDir, toolName)
+    with open(toolWrapper, 'w') as f:
+        f.write("#!/bin/sh\nexec \"" + sys.executable + "\" \"" + os.path.join(benchmarkDir, "animaFakeTool.py") +
+                "\" " + toolName + " \"$@\"\n")
+    os.chmod(toolWrapper, 0o755)
+
+
+def syntheticHeader(size, spacing=1.0):
+    return ImageHeader("", "", [size] * 3, [spacing] * 3, [-size * spacing / 2.0] * 3,
+                       ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0)), 1, "float32", {})
+
+
+def writeSyntheticImage(fileName, size, numVolumes=1, kind="scalar"):
+    if os.path.exists(fileName):
+        return
+    writeFakeImage(fileName, syntheticHeader(size), 1, numVolumes,
+                   syntheticData([size] * 3, 1, numVolumes, kind, len(fileName) + numVolumes), 6)
+
+
+def writeGradients(prefix, numVolumes):
+    # One b=0 volume, then directions spread on the sphere
+    import numpy as np
+
+    directions = [[0.0, 0.0, 0.0]]
+    for index in range(1, numVolumes):
+        z = 1.0 - 2.0 * (index - 0.5) / max(numVolumes - 1, 1)
+        angle = index * np.pi * (3.0 - np.sqrt(5.0))
+        radius = np.sqrt(max(0.0, 1.0 - z * z))
+        directions.append([radius * np.cos(angle), radius * np.sin(angle), z])
+    np.savetxt(prefix + ".bvec", np.array(directions).transpose(), fmt="%.6f")
+    with open(prefix + ".bval", 'w') as f:
+        f.write(" ".join(["0"] + ["1000"] * (numVolumes - 1)) + "\n")
+
+
+# Shared extra data: brain extraction atlas and identity transform
+writeSyntheticImage(os.path.join(extraDataDir, "icc_atlas", "Reference_T1.nrrd"), args.size)
+writeSyntheticImage(os.path.join(extraDataDir, "icc_atlas", "Reference_T1_masked.nrrd"), args.size)
+writeSyntheticImage(os.path.join(extraDataDir, "icc_atlas", "BrainMask.nrrd"), args.size, 1, "mask")
+with open(os.path.join(extraDataDir, "id.txt"), 'w') as f:
+    f.write("#Insight Transform File V1.0\n#Transform 0\nTransform: AffineTransform_double_3_3\n"
+            "Parameters: 1 0 0 0 1 0 0 0 1 0 0 0\nFixedParameters: 0 0 0\n")
+
+
+def prepareScenario(scenario, inputDir, cores):
+    # Writes the scenario inputs to inputDir, returns its command (run from inputDir) and scratch folders
+    if scenario == "brainExtraction":
+        images = ["T1_" + str(index) + ".nrrd" for index in range(1, args.images + 1)]
+        for image in images:
+            writeSyntheticImage(os.path.join(inputDir, image), args.size)
+        command = [os.path.join(scriptsDir, "brain_extraction", "animaAtlasBasedBrainExtraction.py"), "--no-cache",
+                   "-j", str(min(cores, len(images))), "-c", str(cores)] + images
+        return command, []
+
+    if scenario in ["dwiPreprocessing", "mcmEstimation"]:
+        writeSyntheticImage(os.path.join(inputDir, "dwi.nrrd"), args.size, args.volumes)
+        writeGradients(os.path.join(inputDir, "dwi"), args.volumes)
+        if scenario == "mcmEstimation":
+            writeSyntheticImage(os.path.join(inputDir, "mask.nrrd"), args.size, 1, "mask")
+            command = [os.path.join(scriptsDir, "diffusion", "animaMultiCompartmentModelEstimation.py"), "-i",
+                       "dwi.nrrd", "-b", "dwi.bval", "-g", "dwi.bvec", "-m", "mask.nrrd", "-c", str(cores)]
+            return command, []
+
+        writeSyntheticImage(os.path.join(inputDir, "reverseB0.nrrd"), args.size)
+        writeSyntheticImage(os.path.join(inputDir, "t1.nrrd"), args.size)
+        command = [os.path.join(scriptsDir, "diffusion", "animaDiffusionImagePreprocessing.py"), "-i", "dwi.nrrd",
+                   "-b", "dwi.bval", "-g", "dwi.bvec", "-r", "reverseB0.nrrd", "-t", "t1.nrrd", "-c", str(cores)]
+        return command, []
+
+    if scenario == "msExam":
+        for image in ["reference", "flair", "t1", "t1gd", "t2"]:
+            writeSyntheticImage(os.path.join(inputDir, image + ".nrrd"), args.size)
+        command = [os.path.join(scriptsDir, "ms_lesion_segmentation", "animaMSExamPreparation.py"), "-r",
+                   "reference.nrrd", "-f", "flair.nrrd", "-t", "t1.nrrd", "-g", "t1gd.nrrd", "-T", "t2.nrrd", "-c",
+                   str(cores)]
+        return command, []
+
+    # Atlas: one registration job per image but the reference, each given its share of the cores
+    os.makedirs(os.path.join(inputDir, "Images"))
+    for index in range(1, args.images + 1):
+        writeSyntheticImage(os.path.join(inputDir, "Images", "T1_" + str(index) + ".nii.gz"), args.size)
+    command = [os.path.join(scriptsDir, "atlasing", "animaBuildAtlas.py"), "-p", "Images/T1", "-n", str(args.images),
+               "-i", str(args.iterations), "-c", str(max(1, cores // max(1, args.images - 1))), "-j", str(cores),
+               "-s", "local"]
+    return command, [os.path.join(inputDir, "tempDir"), os.path.join(inputDir, "residualDir")]
+
+
+def folderSize(folder):
+    totalSize = 0
+    for root, dirs, files in os.walk(folder):
+        for fileName in files:
+            try:
+                totalSize += os.lstat(os.path.join(root, fileName)).st_size
+            except OSError:
+                # Removed while walking
+                pass
+    return totalSize
+
+
+class DiskMonitor(threading.Thread):
+
+    # Samples the size of the scratch folders and of the whole run folder, keeping their peaks
+    def __init__(self, scratchDirs, runDir, interval=0.05):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scratchDirs = scratchDirs
+        self.runDir = runDir
+        self.interval = interval
+        self.initialSize = folderSize(runDir)
+        self.scratchPeak = 0
+        self.footprintPeak = 0
+        self.stopEvent = threading.Event()
+
+    def sample(self):
+        self.scratchPeak = max(self.scratchPeak, sum(folderSize(scratchDir) for scratchDir in self.scratchDirs))
+        self.footprintPeak = max(self.footprintPeak, folderSize(self.runDir) - self.initialSize)
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            self.sample()
+            self.stopEvent.wait(self.interval)
+        self.sample()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
+
+
+def toolTimes(logFile):
+    # Total tool time, and longest chain of tools each using a file written by the previous one
+    if not os.path.exists(logFile):
+        return 0, 0.0, 0.0
+
+    with open(logFile) as f:
+        records = sorted([json.loads(line) for line in f if line.strip() != ""], key=lambda record: record["start"])
+
+    producers = {}
+    pathEnds = []
+    for record in records:
+        duration = record["end"] - record["start"]
+        pathEnd = duration
+        for inputFile in record["inputs"]:
+            producer = producers.get(inputFile)
+            if producer is not None and producer[0] <= record["start"]:
+                pathEnd = max(pathEnd, producer[1] + duration)
+        pathEnds.append(pathEnd)
+        for outputFile in record["outputs"]:
+            producers[outputFile] = (record["end"], pathEnd)
+
+    totalTime = sum(record["end"] - record["start"] for record in records)
+    return len(records), totalTime, max(pathEnds) if len(pathEnds) > 0 else 0.0
+
+
+def runScenario(scenario, cores):
+    runDir = os.path.join(workDir, scenario + "_c" + str(cores))
+    if os.path.isdir(runDir):
+        shutil.rmtree(runDir)
+    inputDir = os.path.join(runDir, "inputs")
+    homeDir = os.path.join(runDir, "home")
+    scratchDir = os.path.join(runDir, "scratch")
+    for folder in [inputDir, os.path.join(homeDir, ".anima"), scratchDir]:
+        os.makedirs(folder)
+
+    with open(os.path.join(homeDir, ".anima", "config.txt"), 'w') as f:
+        f.write("[anima-scripts]\nanima-scripts-public-root = " + os.path.realpath(scriptsDir) + "/\n" +
+                "anima = " + fakeBinDir + "/\nextra-data-root = " + extraDataDir + "/\n" +
+                "scratch-dirs = " + scratchDir + "\nscratch-min-free = 0\n")
+
+    command, scratchDirs = prepareScenario(scenario, inputDir, cores)
+    command = [sys.executable] + command
+    logFile = os.path.join(runDir, "tools.jsonl")
+    environment = dict(os.environ)
+    environment.update({"HOME": homeDir, "PATH": fakeBinDir + os.pathsep + environment.get("PATH", ""),
+                        "ANIMA_FAKE_LOG": logFile, "ANIMA_FAKE_SCALE": str(args.scale),
+                        "ANIMA_FAKE_MODE": args.mode, "ANIMA_FAKE_PARALLEL_FRACTION": str(args.parallel_fraction),
+                        "ANIMA_ATLAS_POLL_INTERVAL": "1"})
+
+    monitor = DiskMonitor([scratchDir] + scratchDirs, runDir)
+    monitor.start()
+    startTime = time.time()
+    with open(os.path.join(runDir, "output.log"), 'w') as outputFile:
+        returnCode = subprocess.call(command, cwd=inputDir, env=environment, stdout=outputFile,
+                                     stderr=subprocess.STDOUT)
+    latency = time.time() - startTime
+    monitor.stop()
+
+    numTools, totalTime, criticalPath = toolTimes(logFile)
+    result = {"scenario": scenario, "cores": cores, "returnCode": returnCode, "latency": latency,
+              "tools": numTools, "toolTime": totalTime, "criticalPath": criticalPath,
+              "parallelism": totalTime / latency if latency > 0 else 0.0,
+              "overhead": latency - criticalPath, "scratchPeak": monitor.scratchPeak,
+              "footprintPeak": monitor.footprintPeak}
+
+    if returnCode != 0:
+        print("Warning: " + scenario + " with " + str(cores) + " cores failed, see " +
+              os.path.join(runDir, "output.log"))
+    elif not args.keep:
+        shutil.rmtree(runDir)
+
+    return result
+
+
+print("Fake tools with thread options: " + ", ".join(sorted(tool for tool in toolContracts if tool in threadOptions)))
+
+results = []
+for scenario in args.scenarios:
+    for cores in coresList:
+        print("Running " + scenario + " with " + str(cores) + " cores")
+        results.append(runScenario(scenario, cores))
+
+# Speedup against the smallest cores budget of the same scenario
+for result in results:
+    baseline = [other for other in results if other["scenario"] == result["scenario"] and
+                other["cores"] == coresList[0]][0]
+    result["speedup"] = baseline["latency"] / result["latency"] if result["latency"] > 0 else 0.0
+
+print("")
+print("%-17s %5s %6s %9s %9s %9s %8s %8s %7s %11s %11s" %
+      ("scenario", "cores", "tools", "latency", "toolTime", "critPath", "overhead", "parallel", "speedup",
+       "scratchMB", "footprintMB"))
+for result in results:
+    print("%-17s %5d %6d %9.2f %9.2f %9.2f %8.2f %8.2f %7.2f %11.1f %11.1f%s" %
+          (result["scenario"], result["cores"], result["tools"], result["latency"], result["toolTime"],
+           result["criticalPath"], result["overhead"], result["parallelism"], result["speedup"],
+           result["scratchPeak"] / 1024.0 ** 2, result["footprintPeak"] / 1024.0 ** 2,
+           "" if result["returnCode"] == 0 else "  (failed)"))
+
+if args.report != "":
+    with open(args.report, 'w') as f:
+        json.dump({"settings": vars(args), "results": results}, f, indent=2)
@@ -0,0 +1,14 @@
+#!/usr/bin/python
+# Fake Anima tool, called as animaFakeTool.py <anima tool name> <tool arguments>. The benchmark installs one wrapper per
+# Anima tool calling it, see fakeTools.py for the environment variables it uses
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fakeTools import runTool
+
+if len(sys.argv) < 2:
+    sys.exit("Usage: animaFakeTool.py <anima tool name> <tool arguments>")
+
+runTool(sys.argv[1], sys.argv[2:])
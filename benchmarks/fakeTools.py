@@ -0,0 +1,454 @@
+# Stand-ins for the Anima tools used by the scripts, to benchmark orchestration without Anima nor real data.
+# A fake tool follows the command line of the real one: it reads the geometry of its reference input, spends a modeled
+# time (sleeping, or burning CPU on as many processes as threads it was given) and writes outputs of the right kind and
+# size (images, vector fields, transforms, MCM models...). Each run is appended to the JSON lines log given by the
+# ANIMA_FAKE_LOG environment variable, times excluding the start of the Python interpreter. Requires numpy
+#
+# Environment variables:
+#   ANIMA_FAKE_SCALE             seconds per 1e5 voxels (times volumes) for a tool of unit cost (default: 1)
+#   ANIMA_FAKE_MODE              sleep (default) or burn
+#   ANIMA_FAKE_PARALLEL_FRACTION part of the tool time that scales with threads (default: 0.9)
+#   ANIMA_FAKE_COMPRESSION       compression level of .nrrd and .nii.gz outputs (default: 6)
+
+import hashlib
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+from multiprocessing import Process, cpu_count
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.images import readImageHeader
+from anima_scripts.resources import threadOptions
+
+imageExtensions = (".nrrd", ".nii", ".nii.gz")
+
+# Output kinds: same (volumes of the data input), scalar, vector (3D displacement or SVF), tensor (6 components), mask,
+# transform (affine text file, or vector field for image names), xml (transform serie), bvec (copy of gradients),
+# mcm (model description and compartment images), components (-v option of animaCreateImage), like (first listed image)
+# Cost is in seconds per 1e5 voxels of the data input (times its volumes) at scale 1
+toolContracts = {
+    "animaPyramidalBMRegistration": {"cost": 0.5, "reference": ["-r"], "data": "-m",
+                                     "outputs": {"-o": "scalar", "-O": "transform"}},
+    "animaDenseSVFBMRegistration": {"cost": 1.0, "reference": ["-r"], "data": "-m",
+                                    "outputs": {"-o": "scalar", "-O": "transform"}},
+    "animaDenseTensorSVFBMRegistration": {"cost": 2.0, "reference": ["-r"], "data": "-m",
+                                          "outputs": {"-o": "tensor", "-O": "transform"}},
+    "animaTransformSerieXmlGenerator": {"cost": 0.0, "reference": [], "data": "", "outputs": {"-o": "xml"}},
+    "animaApplyTransformSerie": {"cost": 0.05, "reference": ["-g", "-i"], "data": "-i", "outputs": {"-o": "same"}},
+    "animaTensorApplyTransformSerie": {"cost": 0.1, "reference": ["-g", "-i"], "data": "-i",
+                                       "outputs": {"-o": "tensor"}},
+    "animaMCMApplyTransformSerie": {"cost": 0.2, "reference": ["-g"], "data": "-g", "outputs": {"-o": "mcm"}},
+    "animaMaskImage": {"cost": 0.01, "reference": ["-i"], "data": "-i", "outputs": {"-o": "same"}},
+    "animaThrImage": {"cost": 0.01, "reference": ["-i"], "data": "-i", "outputs": {"-o": "mask"}},
+    "animaCreateImage": {"cost": 0.01, "reference": ["-g"], "data": "-g", "outputs": {"-o": "components"}},
+    "animaConvertImage": {"cost": 0.01, "reference": ["-i"], "data": "-i", "outputs": {"-o": "same"}},
+    "animaCropImage": {"cost": 0.01, "reference": ["-i"], "data": "-i", "outputs": {"-o": "same"}},
+    "animaAverageImages": {"cost": 0.02, "reference": [], "data": "", "outputs": {"-o": "like"}},
+    "animaN4BiasCorrection": {"cost": 0.3, "reference": ["-i"], "data": "-i", "outputs": {"-o": "same"}},
+    "animaNLMeans": {"cost": 0.5, "reference": ["-i"], "data": "-i", "outputs": {"-o": "same"}},
+    "animaNLMeansTemporal": {"cost": 0.1, "reference": ["-i"], "data": "-i", "outputs": {"-o": "same"}},
+    "animaEddyCurrentCorrection": {"cost": 0.1, "reference": ["-i"], "data": "-i",
+                                   "outputs": {"-o": "same", "-O": "bvec"}},
+    "animaDistortionCorrection": {"cost": 0.2, "reference": ["-f"], "data": "-f", "outputs": {"-o": "vector"}},
+    "animaBMDistortionCorrection": {"cost": 0.5, "reference": ["-f"], "data": "-f",
+                                    "outputs": {"-o": "scalar", "-O": "vector"}},
+    "animaApplyDistortionCorrection": {"cost": 0.02, "reference": ["-f"], "data": "-f", "outputs": {"-o": "same"}},
+    "animaDTIEstimator": {"cost": 0.02, "reference": ["-i"], "data": "-i",
+                          "outputs": {"-o": "tensor", "-O": "scalar", "-N": "scalar"}},
+    "animaComputeDTIScalarMaps": {"cost": 0.05, "reference": ["-i"], "data": "-i",
+                                  "outputs": {"-a": "scalar", "-f": "scalar", "-c": "scalar", "-r": "scalar",
+                                              "-l": "scalar"}},
+    "animaMCMEstimator": {"cost": 0.05, "reference": ["-i"], "data": "-i",
+                          "outputs": {"-o": "mcm", "-a": "scalar", "--out-b0": "scalar", "--out-sig": "scalar",
+                                      "--out-mose": "scalar"}},
+    "animaMCMModelAveraging": {"cost": 0.2, "reference": [], "data": "",
+                               "outputs": {"-o": "mcm", "-O": "scalar", "-N": "scalar", "-m": "scalar"}},
+}
+
+niftiTypeCodes = {"uint8": 2, "int16": 4, "float32": 16}
+nrrdTypeNames = {"uint8": "uchar", "int16": "short", "float32": "float"}
+
+
+def parseArguments(arguments):
+    # Options with their values (a list, options may be repeated), flags get an empty value
+    options = {}
+    index = 0
+    while index < len(arguments):
+        argument = arguments[index]
+        if argument.startswith("-") and len(argument) > 1 and not _isNumber(argument):
+            if index + 1 < len(arguments) and (not arguments[index + 1].startswith("-") or
+                                               _isNumber(arguments[index + 1])):
+                options.setdefault(argument, []).append(arguments[index + 1])
+                index += 2
+                continue
+            options.setdefault(argument, []).append("")
+        index += 1
+
+    return options
+
+
+def _isNumber(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def isImage(fileName):
+    return fileName.endswith(imageExtensions)
+
+
+def listedFiles(fileName):
+    # Files referenced by a list file (one path per line) or a transform serie / MCM XML file
+    if not os.path.isfile(fileName) or isImage(fileName):
+        return []
+
+    files = []
+    with open(fileName) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("<") and ">" in line and "</" in line:
+                line = line[line.index(">") + 1:line.rindex("</")]
+            if line == "":
+                continue
+            # Relative paths are taken from the working directory, as Anima tools do, or else from the list folder
+            if not os.path.isfile(line) and not os.path.isabs(line):
+                line = os.path.join(os.path.dirname(fileName), line)
+            if os.path.isfile(line):
+                files.append(line)
+
+    return files
+
+
+def imageLayout(header):
+    # Number of vector components and of volumes of an image, as written by writeFakeImage
+    if header.numVolumes == 1:
+        return 1, 1
+
+    if header.fileFormat == "nifti":
+        dims = header.fields["dim"]
+        numComponents = dims[5] if dims[0] >= 5 else 1
+        return numComponents, header.numVolumes // numComponents
+
+    if 0 not in header.fields["spatial axes"]:
+        return header.fields["shape"][0], header.numVolumes // header.fields["shape"][0]
+
+    return 1, header.numVolumes
+
+
+def syntheticData(dimensions, numComponents, numVolumes, kind, seed):
+    # Ellipsoid of tissue-like intensities with some noise (rounded so that compression behaves as on real images),
+    # small random values for fields. Returned in file order: components, x, y, z, volumes (first axis fastest)
+    randomState = np.random.RandomState(seed)
+    grid = np.meshgrid(*[np.linspace(-1.0, 1.0, size) for size in dimensions], indexing='ij')
+    inside = sum(np.square(axis / 0.8) for axis in grid) <= 1.0
+
+    if kind == "mask":
+        return inside.astype(np.uint8).reshape((1,) + tuple(dimensions) + (1,), order='F')
+
+    shape = (numComponents,) + tuple(dimensions) + (numVolumes,)
+    if kind in ["vector", "transform"]:
+        return np.round(randomState.normal(0.0, 0.5, shape), 2).astype(np.float32)
+
+    base = np.where(inside, 100.0, 5.0)[np.newaxis, ..., np.newaxis]
+    return np.round(base + randomState.normal(0.0, 2.0, shape), 1).astype(np.float32)
+
+
+def _lpsToRas(vector):
+    return [-vector[0], -vector[1]] + list(vector[2:])
+
+
+def writeFakeImage(fileName, header, numComponents, numVolumes, data, compressionLevel=6):
+    # Writes data (components, x, y, z, volumes) with the spatial geometry of header. Components are the first NRRD axis
+    # (kind vector) or the fifth NIfTI dimension, volumes the last NRRD axis (kind list) or the fourth NIfTI dimension
+    dimensions = list(header.dimensions)
+    spacing = list(header.spacing)
+    origin = list(header.origin)
+    direction = [list(axisDirection) for axisDirection in header.direction]
+    while len(dimensions) < 3:
+        dimensions.append(1)
+        spacing.append(1.0)
+        origin.append(0.0)
+    for axisDirection in direction:
+        while len(axisDirection) < 3:
+            axisDirection.append(0.0)
+    while len(direction) < 3:
+        direction.append([1.0 if i == len(direction) else 0.0 for i in range(0, 3)])
+
+    pixelType = data.dtype.name
+    if fileName.endswith(".nrrd"):
+        sizes = dimensions[:]
+        kinds = ["domain"] * 3
+        spaceDirections = ["(" + ",".join("%.10g" % (value * spacing[axis]) for value in direction[axis][0:3]) + ")"
+                           for axis in range(0, 3)]
+        fileData = data
+        if numComponents > 1:
+            sizes = [numComponents] + sizes
+            kinds = ["vector"] + kinds
+            spaceDirections = ["none"] + spaceDirections
+        else:
+            fileData = fileData[0]
+        if numVolumes > 1:
+            sizes.append(numVolumes)
+            kinds.append("list")
+            spaceDirections.append("none")
+        else:
+            fileData = fileData[..., 0]
+
+        lines = ["NRRD0004", "type: " + nrrdTypeNames[pixelType], "dimension: " + str(len(sizes)),
+                 "space: left-posterior-superior", "sizes: " + " ".join(str(size) for size in sizes),
+                 "space directions: " + " ".join(spaceDirections), "kinds: " + " ".join(kinds), "endian: little",
+                 "encoding: " + ("gzip" if compressionLevel > 0 else "raw"),
+                 "space origin: (" + ",".join("%.10g" % value for value in origin[0:3]) + ")"]
+        rawData = fileData.astype(fileData.dtype.newbyteorder("<")).tobytes(order='F')
+        if compressionLevel > 0:
+            compressor = zlib.compressobj(compressionLevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            rawData = compressor.compress(rawData) + compressor.flush()
+        with open(fileName, 'wb') as f:
+            f.write(("\n".join(lines) + "\n\n").encode('latin-1'))
+            f.write(rawData)
+        return
+
+    # NIfTI-1: x, y, z, volumes, components
+    dims = [3] + dimensions + [1, 1, 1, 1]
+    intentCode = 0
+    if numVolumes > 1:
+        dims[0] = 4
+        dims[4] = numVolumes
+    if numComponents > 1:
+        dims[0] = 5
+        dims[5] = numComponents
+        intentCode = 1007
+
+    headerBytes = bytearray(352)
+    struct.pack_into("<i", headerBytes, 0, 348)
+    struct.pack_into("<8h", headerBytes, 40, *dims[0:8])
+    struct.pack_into("<h", headerBytes, 68, intentCode)
+    struct.pack_into("<2h", headerBytes, 70, niftiTypeCodes[pixelType], data.dtype.itemsize * 8)
+    struct.pack_into("<8f", headerBytes, 76, 1.0, spacing[0], spacing[1], spacing[2], 1.0, 1.0, 1.0, 1.0)
+    struct.pack_into("<3f", headerBytes, 108, 352.0, 1.0, 0.0)
+    struct.pack_into("<2h", headerBytes, 252, 0, 1)
+    rasOrigin = _lpsToRas(origin[0:3])
+    rasColumns = [_lpsToRas([value * spacing[axis] for value in direction[axis][0:3]]) for axis in range(0, 3)]
+    for row in range(0, 3):
+        struct.pack_into("<4f", headerBytes, 280 + 16 * row, rasColumns[0][row], rasColumns[1][row],
+                         rasColumns[2][row], rasOrigin[row])
+    headerBytes[344:348] = b"n+1\x00"
+
+    # Components are the slowest axis in NIfTI files
+    fileData = data.transpose(tuple(range(1, data.ndim)) + (0,))
+    rawData = fileData.astype(fileData.dtype.newbyteorder("<")).tobytes(order='F')
+    if fileName.endswith(".gz"):
+        import gzip
+        with gzip.open(fileName, 'wb', compressionLevel if compressionLevel > 0 else 1) as f:
+            f.write(bytes(headerBytes))
+            f.write(rawData)
+    else:
+        with open(fileName, 'wb') as f:
+            f.write(bytes(headerBytes))
+            f.write(rawData)
+
+
+def _seed(fileName):
+    return int(hashlib.md5(os.path.basename(fileName).encode('utf-8')).hexdigest()[0:8], 16)
+
+
+def writeTransform(fileName, inputTransforms=()):
+    if fileName.endswith(".xml"):
+        # Transform serie: one entry per input transform, in order
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>', "<TransformationList>"]
+        for transformFile in inputTransforms:
+            transformType = "linear" if transformFile.endswith(".txt") else "svf"
+            lines += ["<Transformation>", "<Type>" + transformType + "</Type>",
+                      "<Path>" + os.path.abspath(transformFile) + "</Path>", "<Inversion>0</Inversion>",
+                      "</Transformation>"]
+        lines.append("</TransformationList>")
+    else:
+        lines = ["#Insight Transform File V1.0", "#Transform 0", "Transform: AffineTransform_double_3_3",
+                 "Parameters: 1 0 0 0 1 0 0 0 1 0 0 0", "FixedParameters: 0 0 0"]
+
+    with open(fileName, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def writeFakeMCM(fileName, header, numCompartments, compressionLevel):
+    # Model description referencing weights and compartment images in a folder named after the model
+    modelName = os.path.splitext(os.path.basename(fileName))[0]
+    modelFolder = os.path.join(os.path.dirname(os.path.abspath(fileName)), modelName)
+    if not os.path.isdir(modelFolder):
+        os.makedirs(modelFolder)
+
+    # Free and isotropic restricted water, then tensor compartments
+    compartments = [("FreeWater", 1), ("IsotropicRestrictedWater", 1)] + [("Tensor", 6)] * numCompartments
+    weightsFile = os.path.join(modelName, modelName + "_weights.nrrd")
+    writeFakeImage(os.path.join(os.path.dirname(os.path.abspath(fileName)), weightsFile), header,
+                   len(compartments), 1, syntheticData(header.dimensions, len(compartments), 1, "scalar",
+                                                       _seed(weightsFile)), compressionLevel)
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', "<Model>", "<Weights>" + weightsFile + "</Weights>"]
+    for index, (compartmentType, numParameters) in enumerate(compartments):
+        compartmentFile = os.path.join(modelName, modelName + "_" + str(index) + ".nrrd")
+        writeFakeImage(os.path.join(os.path.dirname(os.path.abspath(fileName)), compartmentFile), header,
+                       numParameters, 1, syntheticData(header.dimensions, numParameters, 1, "scalar",
+                                                       _seed(compartmentFile)), compressionLevel)
+        lines += ["<Compartment>", "<Type>" + compartmentType + "</Type>",
+                  "<FileName>" + compartmentFile + "</FileName>", "</Compartment>"]
+    lines.append("</Model>")
+
+    with open(fileName, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+    return [fileName, os.path.join(os.path.dirname(os.path.abspath(fileName)), weightsFile)]
+
+
+def _burn(cpuSeconds):
+    endTime = time.process_time() + cpuSeconds if hasattr(time, "process_time") else time.clock() + cpuSeconds
+    value = 0
+    while (time.process_time() if hasattr(time, "process_time") else time.clock()) < endTime:
+        for index in range(0, 10000):
+            value += index * index
+
+
+def spendTime(cost, numThreads, mode, parallelFraction):
+    # Serial part on one core, then the parallel part split over the threads
+    serialTime = cost * (1.0 - parallelFraction)
+    parallelTime = cost * parallelFraction / numThreads
+    if mode != "burn":
+        time.sleep(serialTime + parallelTime)
+        return
+
+    _burn(serialTime)
+    workers = [Process(target=_burn, args=(parallelTime,)) for thread in range(0, numThreads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def firstExisting(options, optionNames, fileFilter=isImage):
+    for optionName in optionNames:
+        for value in options.get(optionName, []):
+            if fileFilter(value) and os.path.exists(value):
+                return value
+    return ""
+
+
+def runTool(toolName, arguments):
+    if toolName not in toolContracts:
+        sys.exit("Unknown fake Anima tool: " + toolName)
+
+    startTime = time.time()
+    contract = toolContracts[toolName]
+    options = parseArguments(arguments)
+    compressionLevel = int(os.environ.get("ANIMA_FAKE_COMPRESSION", "6"))
+
+    inputs = []
+    for argument in arguments:
+        if os.path.isfile(argument):
+            inputs.append(argument)
+            inputs += listedFiles(argument)
+
+    if toolName == "animaConvertImage" and "-I" in options:
+        # Information only
+        header = readImageHeader(options["-i"][0])
+        print("Image " + options["-i"][0] + ": " + "x".join(str(size) for size in header.dimensions) + " voxels, " +
+              str(header.numVolumes) + " volumes, " + header.pixelType)
+        return
+
+    # Reference geometry, and data input giving volumes and cost
+    listInputs = [inputFile for inputFile in inputs if isImage(inputFile)]
+    referenceFile = firstExisting(options, contract["reference"])
+    if toolName in ["animaAverageImages", "animaMCMModelAveraging"]:
+        listFileOption = "-i" if toolName == "animaAverageImages" else "-b"
+        listed = listedFiles(options[listFileOption][0])
+        referenceFile = listed[0] if len(listed) > 0 else ""
+    if referenceFile == "" and len(listInputs) > 0:
+        referenceFile = listInputs[0]
+    if referenceFile == "":
+        referenceHeader = None
+    else:
+        referenceHeader = readImageHeader(referenceFile)
+
+    dataFile = firstExisting(options, [contract["data"]]) if contract["data"] != "" else referenceFile
+    dataHeader = readImageHeader(dataFile) if dataFile != "" else referenceHeader
+    numComponents, numVolumes = imageLayout(dataHeader) if dataHeader is not None else (1, 1)
+
+    # Time slab extraction keeps one volume
+    if toolName == "animaCropImage" and "-T" in options:
+        numVolumes = 1
+
+    numThreads = cpu_count()
+    threadOption = threadOptions.get(toolName)
+    if threadOption is not None and threadOption in options and options[threadOption][0] != "":
+        numThreads = max(1, int(options[threadOption][0]))
+
+    workUnits = 0.0
+    if dataHeader is not None:
+        workUnits = dataHeader.numVoxels() * dataHeader.numVolumes / 1e5
+    cost = contract["cost"] * workUnits * float(os.environ.get("ANIMA_FAKE_SCALE", "1"))
+    if toolName == "animaMCMEstimator":
+        cost *= int(options.get("-n", ["1"])[0]) + 1
+    spendTime(cost, numThreads, os.environ.get("ANIMA_FAKE_MODE", "sleep"),
+              float(os.environ.get("ANIMA_FAKE_PARALLEL_FRACTION", "0.9")))
+
+    outputs = []
+    for optionName, kind in sorted(contract["outputs"].items()):
+        for outputFile in options.get(optionName, []):
+            if outputFile == "":
+                continue
+
+            if kind == "xml" or (kind == "transform" and not isImage(outputFile)):
+                writeTransform(outputFile, options.get("-i", []))
+                outputs.append(outputFile)
+            elif kind == "bvec":
+                with open(options["-I"][0]) as f:
+                    gradients = f.read()
+                with open(outputFile, 'w') as f:
+                    f.write(gradients)
+                outputs.append(outputFile)
+            elif kind == "mcm":
+                # -n is the number of compartments of the estimator, a list of noise images for the averaging
+                numCompartments = 3
+                if toolName == "animaMCMEstimator":
+                    numCompartments = int(options.get("-n", ["3"])[0])
+                outputs += writeFakeMCM(outputFile, referenceHeader, numCompartments, compressionLevel)
+            else:
+                outputComponents, outputVolumes, dataKind = 1, 1, kind
+                if kind == "same" or kind == "like":
+                    outputComponents, outputVolumes, dataKind = numComponents, numVolumes, "scalar"
+                    if outputComponents == 3:
+                        dataKind = "vector"
+                elif kind in ["vector", "transform"]:
+                    outputComponents = 3
+                elif kind == "tensor":
+                    outputComponents = 6
+                elif kind == "components":
+                    outputComponents = int(options.get("-v", ["1"])[0])
+                    dataKind = "scalar"
+
+                data = syntheticData(referenceHeader.dimensions, outputComponents, outputVolumes, dataKind,
+                                     _seed(outputFile))
+                if kind == "components":
+                    data[...] = float(options.get("-b", ["0"])[0])
+                writeFakeImage(outputFile, referenceHeader, outputComponents, outputVolumes, data, compressionLevel)
+                outputs.append(outputFile)
+
+    logFile = os.environ.get("ANIMA_FAKE_LOG", "")
+    if logFile != "":
+        record = {"tool": toolName, "arguments": arguments, "start": startTime, "end": time.time(),
+                  "threads": numThreads, "cost": cost, "inputs": [os.path.realpath(inputFile) for inputFile in inputs],
+                  "outputs": [os.path.realpath(outputFile) for outputFile in outputs]}
+        logDescriptor = os.open(logFile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(logDescriptor, (json.dumps(record) + "\n").encode('utf-8'))
+        finally:
+            os.close(logDescriptor)
+
+    print(toolName + " (fake) done in " + "%.2f" % (time.time() - startTime) + "s with " + str(numThreads) +
+          " threads")
@@ -2,117 +2,63 @@
 # Warning: works only on unix-like systems, not windows where "python animaAtlasBasedBrainExtraction.py ..." has to be run
 
 import sys
+import argparse
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
-import glob
+import atexit
 import os
-import shutil
-from subprocess import call, check_output
-
-configFilePath = os.path.expanduser("~") + "/.anima/config.txt"
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
-    quit()
 
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
-animaExtraDataDir = configParser.get("anima-scripts", 'extra-data-root')
-animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
-animaDenseSVFBMRegistration = os.path.join(animaDir, "animaDenseSVFBMRegistration")
-animaTransformSerieXmlGenerator = os.path.join(animaDir, "animaTransformSerieXmlGenerator")
-animaApplyTransformSerie = os.path.join(animaDir, "animaApplyTransformSerie")
-animaConvertImage = os.path.join(animaDir, "animaConvertImage")
-animaMaskImage = os.path.join(animaDir, "animaMaskImage")
-
-if len(sys.argv) < 2:
-    print(
-        'Computes the brain mask of images given in input by registering a known atlas on it. Their output is prefix_brainMask.nrrd and prefix_masked.nrrd.')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.brain_extraction import extractBrains
+from anima_scripts.cache import getCacheFromConfig
+from anima_scripts.config import readConfig
+from anima_scripts.resources import getResourceManager
+from anima_scripts.runner import CommandRunner
+
+try:
+    configParser = readConfig()
+except IOError as error:
+    print(str(error))
     quit()
 
-numImages = len(sys.argv) - 1
-atlasImage = animaExtraDataDir + "icc_atlas/Reference_T1.nrrd"
-atlasImageMasked = animaExtraDataDir + "icc_atlas/Reference_T1_masked.nrrd"
-iccImage = animaExtraDataDir + "icc_atlas/BrainMask.nrrd"
-
-for brainImage in sys.argv[1:]:
-    print("Brain masking image: " + brainImage)
-
-    # Get floating image prefix
-    brainImagePrefix = os.path.splitext(brainImage)[0]
-    if os.path.splitext(brainImage)[1] == '.gz':
-        brainImagePrefix = os.path.splitext(brainImagePrefix)[0]
-
-    # Decide on whether to use large image setting or small image setting
-    command = [animaConvertImage, "-i", brainImage, "-I"]
-    convert_output = check_output(command)
-    size_info = convert_output.split('\n')[1].split('[')[1].split(']')[0]
-    large_image = False
-    for i in range(0, 3):
-        size_tmp = int(size_info.split(', ')[i])
-        if size_tmp >= 256:
-            large_image = True
-            break
-
-    pyramidOptions = ["-p", "4", "-l", "1"]
-    if large_image:
-        pyramidOptions = ["-p", "5", "-l", "2"]
-
-    # Rough mask with whole brain
-    command = [animaPyramidalBMRegistration, "-m", atlasImage, "-r", brainImage, "-o", brainImagePrefix + "_rig.nrrd",
-               "-O", brainImagePrefix + "_rig_tr.txt", "--sp", "3"] + pyramidOptions
-    call(command)
-
-    command = [animaPyramidalBMRegistration, "-m", atlasImage, "-r", brainImage, "-o", brainImagePrefix + "_aff.nrrd",
-               "-O", brainImagePrefix + "_aff_tr.txt", "-i", brainImagePrefix + "_rig_tr.txt", "--sp", "3", "--ot",
-               "2"] + pyramidOptions
-    call(command)
-
-    command = [animaDenseSVFBMRegistration, "-r", brainImage, "-m", brainImagePrefix + "_aff.nrrd", "-o",
-               brainImagePrefix + "_nl.nrrd", "-O", brainImagePrefix + "_nl_tr.nrrd", "--sr", "1"] + pyramidOptions
-    call(command)
-
-    command = [animaTransformSerieXmlGenerator, "-i", brainImagePrefix + "_aff_tr.txt", "-i",
-               brainImagePrefix + "_nl_tr.nrrd", "-o", brainImagePrefix + "_nl_tr.xml"]
-    call(command)
-
-    command = [animaApplyTransformSerie, "-i", iccImage, "-t", brainImagePrefix + "_nl_tr.xml", "-g", brainImage, "-o",
-               brainImagePrefix + "_rough_brainMask.nrrd", "-n", "nearest"]
-    call(command)
-
-    command = [animaMaskImage, "-i", brainImage, "-m", brainImagePrefix + "_rough_brainMask.nrrd", "-o",
-               brainImagePrefix + "_rough_masked.nrrd"]
-    call(command)
-
-    brainImageRoughMasked = brainImagePrefix + "_rough_masked.nrrd"
-    # Fine mask with masked brain
-    command = [animaPyramidalBMRegistration, "-m", atlasImageMasked, "-r", brainImageRoughMasked, "-o",
-               brainImagePrefix + "_rig.nrrd", "-O", brainImagePrefix + "_rig_tr.txt", "--sp", "3"] + pyramidOptions
-    call(command)
-
-    command = [animaPyramidalBMRegistration, "-m", atlasImageMasked, "-r", brainImageRoughMasked, "-o",
-               brainImagePrefix + "_aff.nrrd", "-O", brainImagePrefix + "_aff_tr.txt", "-i",
-               brainImagePrefix + "_rig_tr.txt", "--sp", "3", "--ot", "2"] + pyramidOptions
-    call(command)
-
-    command = [animaDenseSVFBMRegistration, "-r", brainImageRoughMasked, "-m", brainImagePrefix + "_aff.nrrd", "-o",
-               brainImagePrefix + "_nl.nrrd", "-O", brainImagePrefix + "_nl_tr.nrrd", "--sr", "1"] + pyramidOptions
-    call(command)
-
-    command = [animaApplyTransformSerie, "-i", iccImage, "-t", brainImagePrefix + "_nl_tr.xml", "-g", brainImage, "-o",
-               brainImagePrefix + "_brainMask.nrrd", "-n", "nearest"]
-    call(command)
-
-    command = [animaMaskImage, "-i", brainImage, "-m", brainImagePrefix + "_brainMask.nrrd", "-o",
-               brainImagePrefix + "_masked.nrrd"]
-    call(command)
-
-map(os.remove, glob.glob("*_rig*"))
-map(os.remove, glob.glob("*_aff*"))
-map(os.remove, glob.glob("*_nl*"))
-map(os.remove, glob.glob("*_rough*"))
+# Argument parsing
+parser = argparse.ArgumentParser(
+    description="Computes the brain mask of images given in input by registering a known atlas on it. Their output is "
+                "prefix_brainMask.nrrd and prefix_masked.nrrd.")
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help="Number of images processed concurrently (default: 1, 0 uses all available cores)")
+parser.add_argument('-c', '--cores', type=int, default=0,
+                    help="Number of cores shared by the images (default: max-cores entry of the configuration file, or "
+                         "all available cores)")
+parser.add_argument('--cache-dir', type=str, default="",
+                    help="Folder caching registration results (default: cache-dir entry of the configuration file)")
+parser.add_argument('--cache-size', type=float, default=None,
+                    help="Cache size limit in GB, least recently used results are evicted (0: no limit)")
+parser.add_argument('--no-cache', action='store_true', help="Do not use the registration results cache")
+parser.add_argument('--trace', type=str, default="",
+                    help="JSON lines file recording each command run (time, CPU, memory, I/O), summarized at the end")
+parser.add_argument('images', nargs='+', help="Images to brain mask")
+
+args = parser.parse_args()
+
+runner = CommandRunner(args.trace, getResourceManager(configParser, args.cores))
+if args.trace != "":
+    atexit.register(runner.printSummary)
+
+resultCache = None
+if args.no_cache is False:
+    resultCache = getCacheFromConfig(configParser, args.cache_dir, args.cache_size)
+
+results = extractBrains(configParser, args.images, runner, args.jobs, resultCache)
+
+numFailures = 0
+print("Brain extraction summary:")
+for brainImage, error in results:
+    if error == "":
+        print("  OK      " + brainImage)
+    else:
+        numFailures += 1
+        print("  FAILED  " + brainImage)
+        print(error)
+
+if numFailures > 0:
+    sys.exit(str(numFailures) + " image(s) out of " + str(len(results)) + " could not be brain masked")
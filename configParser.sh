@@ -7,6 +7,9 @@ ANIMA_DIR=''
 ROOT_PUBLIC_DIR=''
 ROOT_DIR=''
 ANIMA_EXTRA_DATA_DIR=''
+ANIMA_SCRATCH_DIRS=''
+ANIMA_INTERMEDIATE_FORMAT=''
+ANIMA_INTERMEDIATE_COMPRESSION=''
 IFS=$(echo -en "\n\b")
 
 for data in `cat $configFile | sed "s/ = /=/g" | grep '='`
@@ -29,6 +32,18 @@ do
 	if [ "$key" == "extra-data-root" ]; then
 		ANIMA_EXTRA_DATA_DIR=$value
 	fi
+
+	if [ "$key" == "scratch-dirs" ]; then
+		ANIMA_SCRATCH_DIRS=$value
+	fi
+
+	if [ "$key" == "intermediate-format" ]; then
+		ANIMA_INTERMEDIATE_FORMAT=$value
+	fi
+
+	if [ "$key" == "intermediate-compression" ]; then
+		ANIMA_INTERMEDIATE_COMPRESSION=$value
+	fi
 done 
 
 unset IFS
@@ -3,32 +3,23 @@
 
 import sys
 import argparse
-import tempfile
-import pydicom
-import numpy as np
-import struct
-
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
 
+import atexit
 import os
-import shutil
-from subprocess import call
 
-configFilePath = os.path.expanduser("~") + "/.anima/config.txt"
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.cache import getCacheFromConfig
+from anima_scripts.config import readConfig
+from anima_scripts.dwi_preprocessing import preprocessDWI
+from anima_scripts.resources import getResourceManager
+from anima_scripts.runner import CommandRunner
+
+try:
+    configParser = readConfig()
+except IOError as error:
+    print(str(error))
     quit()
 
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
-animaDataDir = configParser.get("anima-scripts", 'extra-data-root')
-animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
-
 # Argument parsing
 parser = argparse.ArgumentParser(
     description="Prepares DWI for model estimation: gradients reworking on Siemens based on dicoms, denoising, brain masking, distortion correction.")
@@ -44,223 +35,27 @@ parser.add_argument('-t', '--t1', type=str, default="", help="T1 image for brain
 parser.add_argument('--no-brain-masking', action='store_true', help="Do not perform any brain masking")
 parser.add_argument('--no-eddy-correction', action='store_true',
                     help="Do not perform Eddy current distortion correction")
+parser.add_argument('-c', '--cores', type=int, default=0,
+                    help="Number of cores shared by concurrent preprocessing steps (default: max-cores entry of the "
+                         "configuration file, or all available cores)")
+parser.add_argument('-w', '--work-dir', type=str, default="",
+                    help="Persistent work folder: intermediate files are kept there and a new run resumes from them")
+parser.add_argument('--trace', type=str, default="",
+                    help="JSON lines file recording each command run (time, CPU, memory, I/O), summarized at the end")
 parser.add_argument('-i', '--input', type=str, required=True, help='DWI file to process')
 
 args = parser.parse_args()
 
-tmpFolder = tempfile.mkdtemp()
-
-dwiImage = args.input
-dwiImagePrefix = os.path.splitext(dwiImage)[0]
-if os.path.splitext(dwiImage)[1] == '.gz':
-    dwiImagePrefix = os.path.splitext(dwiImagePrefix)[0]
-
-tmpDWIImagePrefix = os.path.join(tmpFolder, os.path.basename(dwiImagePrefix))
-
-outputImage = dwiImage
-outputBVec = args.grad
-
-if not (args.dicom == "") and not (args.grad == ""):
-    # adapted from http://neurohut.blogspot.fr/2015/11/how-to-extract-bval-bvec-from-dicom.html
-    # The goal here is to ensure the bvec file extracted from dcm2nii is well put
-    # back in real coordinates. This assumes dcm2nii worked for gradient extraction which is not always the case.
-    # If not, use the dicom folder option In any case, it works only for Siemens scanners though as far as I know
-    image = pydicom.read_file(args.dicom[0])
-    img_plane_position = image[0x0020, 0x0037].value
-    V1 = np.array([float(img_plane_position[0]), float(img_plane_position[1]), float(img_plane_position[2])])
-    V2 = np.array([float(img_plane_position[3]), float(img_plane_position[4]), float(img_plane_position[5])])
-    V3 = np.cross(V1, V2)
-
-    orMatrix = np.array([V1, V2, V3])
-
-    bvecs = np.loadtxt(args.grad)
-    bvecs_corrected = np.dot(orMatrix.transpose(), bvecs)
-
-    np.savetxt(tmpDWIImagePrefix + "_real.bvec", bvecs_corrected, fmt="%.12f")
-    outputBVec = tmpDWIImagePrefix + "_real.bvec"
-
-elif not (args.dicom == "") and (args.grad == ""):
-    bvecs_corrected = []
-    acq_number = -1
-    for dicom_file in sorted(args.dicom):
-        image = pydicom.read_file(dicom_file)
-        bval = float(image[0x0019, 0x100c].value)
-
-        if image[0x0019, 0x100d].value == 'NONE' or bval == 0:
-            bvec = [0, 0, 0]
-        else:
-            buffer = struct.unpack('ddd', image[0x0019, 0x100e].value)
-            img_plane_position = image[0x0020, 0x0037].value
-            vec = np.array(buffer)
-            V1 = np.array([float(img_plane_position[0]), float(img_plane_position[1]), float(img_plane_position[2])])
-            V2 = np.array([float(img_plane_position[3]), float(img_plane_position[4]), float(img_plane_position[5])])
-            V3 = np.cross(V1, V2)
+# Tools get explicit thread counts within the cores budget
+runner = CommandRunner(args.trace, getResourceManager(configParser, args.cores))
+if args.trace != "":
+    atexit.register(runner.printSummary)
 
-            bvec = np.zeros(3)
-            bvec = vec
-
-        add_bvec = True
-        if acq_number == image[0x0020, 0x0012].value :
-            add_bvec = False
-        else:
-            acq_number = image[0x0020, 0x0012].value
-
-        if add_bvec:
-            bvecs_corrected.append(bvec)
-
-    bvecs_corrected = np.array(bvecs_corrected)
-    np.savetxt(tmpDWIImagePrefix + "_real.bvec", bvecs_corrected.transpose(), fmt="%.12f")
-    outputBVec = tmpDWIImagePrefix + "_real.bvec"
-
-if outputBVec == "":
+if args.grad == "" and args.dicom == "":
     sys.exit("Gradient file needs to be provided (either through Dicom folder or through dcm2nii)")
 
-# Distortion correction first
-# Eddy current first
-if args.no_eddy_correction is False:
-    eddyCorrectionCommand = [animaDir + "animaEddyCurrentCorrection", "-i", dwiImage, "-I", outputBVec, "-o",
-                             tmpDWIImagePrefix + "_eddy_corrected.nrrd", \
-                             "-O", tmpDWIImagePrefix + "_eddy_corrected.bvec", "-d", str(args.direction)]
-    call(eddyCorrectionCommand)
-
-    outputImage = tmpDWIImagePrefix + "_eddy_corrected.nrrd"
-    outputBVec = tmpDWIImagePrefix + "_eddy_corrected.bvec"
-
-# Extract brain from T1 image if present (used for further processing)
-if (args.no_disto_correction is False or args.no_brain_masking is False) and not args.t1 == "":
-    brainExtractionCommand = ["python", animaScriptsDir + "brain_extraction/animaAtlasBasedBrainExtraction.py", args.t1]
-    call(brainExtractionCommand)
-
-# Then susceptibility distortion
-if args.no_disto_correction is False:
-    if not (args.reverse == ""):
-        b0ExtractCommand = [animaDir + "animaCropImage", "-i", outputImage, "-t", "0", "-T", "0", "-o",
-                            tmpDWIImagePrefix + "_B0.nrrd"]
-        call(b0ExtractCommand)
-
-        idTrsfName = os.path.join(animaDataDir, "id.txt")
-        idTrsfXmlName = os.path.join(tmpFolder, "id.xml")
-        idGenCommand = [animaDir + "animaTransformSerieXmlGenerator", "-i", idTrsfName, "-o", idTrsfXmlName]
-        call(idGenCommand)
-
-        resampleB0PACommand = [animaDir + "animaApplyTransformSerie", "-i", args.reverse, "-t", idTrsfXmlName, "-o",
-                               tmpDWIImagePrefix + "_B0_Reverse.nrrd", "-g", tmpDWIImagePrefix + "_B0.nrrd"]
-        call(resampleB0PACommand)
-
-        initCorrectionCommand = [animaDir + "animaDistortionCorrection", "-s", "2", "-d", str(args.direction), \
-                                 "-f", tmpDWIImagePrefix + "_B0.nrrd", "-b", tmpDWIImagePrefix + "_B0_Reverse.nrrd",
-                                 "-o", tmpDWIImagePrefix + "_init_correction_tr.nrrd"]
-        call(initCorrectionCommand)
-        bmCorrectionCommand = [animaDir + "animaBMDistortionCorrection", "-f", tmpDWIImagePrefix + "_B0.nrrd", \
-                               "-b", tmpDWIImagePrefix + "_B0_Reverse.nrrd", "-o",
-                               tmpDWIImagePrefix + "_B0_corrected.nrrd", "-i",
-                               tmpDWIImagePrefix + "_init_correction_tr.nrrd", \
-                               "--bs", "3", "-s", "10", "-d", str(args.direction), "-O",
-                               tmpDWIImagePrefix + "_B0_correction_tr.nrrd"]
-        call(bmCorrectionCommand)
-
-        applyCorrectionCommand = [animaDir + "animaApplyDistortionCorrection", "-f", outputImage, "-t", \
-                                  tmpDWIImagePrefix + "_B0_correction_tr.nrrd", "-o",
-                                  tmpDWIImagePrefix + "_corrected.nrrd"]
-        call(applyCorrectionCommand)
-
-        outputImage = tmpDWIImagePrefix + "_corrected.nrrd"
-    elif not (args.t1 == ""):
-        b0ExtractCommand = [animaDir + "animaCropImage", "-i", outputImage, "-t", "0", "-T", "0", "-o",
-                            tmpDWIImagePrefix + "_B0.nrrd"]
-        call(b0ExtractCommand)
-
-        T1Prefix = os.path.splitext(args.t1)[0]
-        if os.path.splitext(args.t1)[1] == '.gz':
-            T1Prefix = os.path.splitext(T1Prefix)[0]
-
-        tmpT1Prefix = os.path.join(tmpFolder, os.path.basename(T1Prefix))
-
-        correctionCommand = [animaDir + "animaPyramidalBMRegistration", "-r", tmpDWIImagePrefix + "_B0.nrrd", \
-                             "-m", T1Prefix + "_masked.nrrd", "-o", tmpT1Prefix + "_rig.nrrd"]
-        call(correctionCommand)
-
-        correctionCommand = [animaDir + "animaDenseSVFBMRegistration", "-r", tmpT1Prefix + "_rig.nrrd", \
-                             "-m", tmpDWIImagePrefix + "_B0.nrrd", "-o", tmpDWIImagePrefix + "_B0_corrected.nrrd", "-d",
-                             str(args.direction), \
-                             "-O", tmpDWIImagePrefix + "_B0_correction_tr.nrrd", "-t", "3"]
-        call(correctionCommand)
-
-        applyCorrectionCommand = [animaDir + "animaApplyDistortionCorrection", "-f", outputImage, "-t", \
-                                  tmpDWIImagePrefix + "_B0_correction_tr.nrrd", "-o",
-                                  tmpDWIImagePrefix + "_corrected.nrrd"]
-        call(applyCorrectionCommand)
-
-        outputImage = tmpDWIImagePrefix + "_corrected.nrrd"
-
-# Then re-orient image to be axial first
-dwiReorientCommand = [animaDir + "animaConvertImage", "-i", outputImage, "-o", tmpDWIImagePrefix + "_or.nrrd", "-R",
-                      "AXIAL"]
-call(dwiReorientCommand)
-outputImage = tmpDWIImagePrefix + "_or.nrrd"
-
-# Then perform denoising
-if args.no_denoising is False:
-    denoisingCommand = [animaDir + "animaNLMeansTemporal", "-i", outputImage, "-b", "0.5", "-o",
-                        tmpDWIImagePrefix + "_nlm.nrrd"]
-    call(denoisingCommand)
-    outputImage = tmpDWIImagePrefix + "_nlm.nrrd"
-
-# Finally, brain mask image
-if args.no_brain_masking is False:
-    brainImage = args.t1
-
-    b0ExtractCommand = [animaDir + "animaCropImage", "-i", outputImage, "-t", "0", "-T", "0", "-o",
-                        tmpDWIImagePrefix + "_forBrainExtract.nrrd"]
-    call(b0ExtractCommand)
-
-    if brainImage == "":
-        brainImage = tmpDWIImagePrefix + "_forBrainExtract.nrrd"
-        brainExtractionCommand = ["python", animaScriptsDir + "brain_extraction/animaAtlasBasedBrainExtraction.py",
-                                  brainImage]
-        call(brainExtractionCommand)
-
-    if args.t1 == "":
-        shutil.move(tmpDWIImagePrefix + "_forBrainExtract_brainMask.nrrd", dwiImagePrefix + "_brainMask.nrrd")
-    else:
-        T1Prefix = os.path.splitext(args.t1)[0]
-        if os.path.splitext(args.t1)[1] == '.gz':
-            T1Prefix = os.path.splitext(T1Prefix)[0]
-
-        tmpT1Prefix = os.path.join(tmpFolder, os.path.basename(T1Prefix))
-
-        t1RegistrationCommand = [animaDir + "animaPyramidalBMRegistration", "-r",
-                                 tmpDWIImagePrefix + "_forBrainExtract.nrrd", "-m", T1Prefix + "_masked.nrrd", "-o",
-                                 tmpT1Prefix + "_rig.nrrd", "-O", tmpT1Prefix + "_rig_tr.txt", "-p", "4", "-l", "1",
-                                 "--sp", "2", "-I", "0"]
-        call(t1RegistrationCommand)
-
-        command = [animaDir + "animaTransformSerieXmlGenerator", "-i", tmpT1Prefix + "_rig_tr.txt", "-o",
-                   tmpT1Prefix + "_rig_tr.xml"]
-        call(command)
-
-        command = [animaDir + "animaApplyTransformSerie", "-i", T1Prefix + "_brainMask.nrrd", "-t",
-                   tmpT1Prefix + "_rig_tr.xml", "-o", dwiImagePrefix + "_brainMask.nrrd", "-g",
-                   tmpDWIImagePrefix + "_forBrainExtract.nrrd", "-n", "nearest"]
-        call(command)
-
-    brainExtractionCommand = [animaDir + "animaMaskImage", "-i", outputImage, "-m", dwiImagePrefix + "_brainMask.nrrd", \
-                              "-o", tmpDWIImagePrefix + "_masked.nrrd"]
-    call(brainExtractionCommand)
-
-    outputImage = tmpDWIImagePrefix + "_masked.nrrd"
-
-shutil.copy(outputImage, dwiImagePrefix + "_preprocessed.nrrd")
-shutil.copy(outputBVec, dwiImagePrefix + "_preprocessed.bvec")
-
-# Estimate tensors if files were provided
-dtiEstimationCommand = [animaDir + "animaDTIEstimator", "-i", outputImage, "-o", dwiImagePrefix + "_Tensors.nrrd", \
-                        "-O", dwiImagePrefix + "_Tensors_B0.nrrd", "-N", dwiImagePrefix + "_Tensors_NoiseVariance.nrrd", \
-                        "-g", outputBVec, "-b", args.bval]
-
-if args.no_brain_masking is False:
-    dtiEstimationCommand += ["-m", dwiImagePrefix + "_brainMask.nrrd"]
-
-call(dtiEstimationCommand)
-
-shutil.rmtree(tmpFolder)
+preprocessDWI(configParser, args.input, args.bval, grad=args.grad, reverse=args.reverse, direction=args.direction,
+              dicomFiles=args.dicom if args.dicom != "" else (), t1=args.t1,
+              distortionCorrection=args.no_disto_correction is False, denoising=args.no_denoising is False,
+              brainMasking=args.no_brain_masking is False, eddyCorrection=args.no_eddy_correction is False,
+              workDir=args.work_dir, runner=runner, resultCache=getCacheFromConfig(configParser))
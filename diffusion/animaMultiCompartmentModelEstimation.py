@@ -4,24 +4,28 @@
 import sys
 import argparse
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
+import atexit
 import os
-from subprocess import call
 
-configFilePath = os.path.expanduser("~") + "/.anima/config.txt"
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.config import readConfig
+from anima_scripts.mcm_estimation import estimateMCM, mcmTileFolder
+from anima_scripts.resources import getResourceManager
+from anima_scripts.runner import CommandRunner
+from anima_scripts.schedulers import arrayIndexVariable, getScheduler
+from anima_scripts.tiling import splitMask
+
+try:
+    configParser = readConfig()
+except IOError as error:
+    print(str(error))
     quit()
 
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
-
 # Argument parsing
 parser = argparse.ArgumentParser(
     description="Performs multi-compartment models estimation and averaging from pre-processed or unprocessed DWI image(s)")
@@ -42,88 +46,73 @@ parser.add_argument('-b', '--bval', type=str, required=True, help='DWI b-value o
 parser.add_argument('-g', '--bvec', type=str, required=True, help='DWI gradients file')
 parser.add_argument('-m', '--mask', type=str, default="", help='Computation mask')
 
+parser.add_argument('--tiles', type=int, default=1,
+                    help="Split the mask into this number of slabs estimated separately and stitched back")
+parser.add_argument('--tile-index', type=int, default=0,
+                    help="Only estimate this tile (from 1), e.g. in an array job (requires --tiles)")
+parser.add_argument('--stitch-only', action='store_true',
+                    help="Only stitch already estimated tiles and perform model averaging (requires --tiles)")
+parser.add_argument('-s', '--scheduler', type=str, default="", choices=["", "local", "oar", "slurm"],
+                    help="Run tile estimations as an array job followed by a stitching job, on this machine or "
+                         "submitted to OAR or SLURM (requires --tiles)")
+parser.add_argument('--oar', action='store_true', help="Same as --scheduler oar")
+parser.add_argument('--walltime', type=str, default="03:59:00", help="Walltime of OAR or SLURM jobs")
+
+parser.add_argument('-c', '--cores', type=int, default=0,
+                    help="Number of cores shared by the estimations (default: max-cores entry of the "
+                         "configuration file, or all available cores)")
+parser.add_argument('--trace', type=str, default="",
+                    help="JSON lines file recording each command run (time, CPU, memory, I/O), summarized at the end")
+
 args = parser.parse_args()
 
-# Get parameters from arguments parser
-baseEstimationCommand = [animaDir + "animaMCMEstimator", "-FR"]
-if args.type.lower() == "ddi":
-    baseEstimationCommand += ["--optimizer", "bobyqa", "--ml-mode", "1"]
-else:
-    baseEstimationCommand += ["--optimizer", "levenberg", "--ml-mode", "2"]
-
-if args.hcp is True:
-    baseEstimationCommand += ["-S"]
-
-if args.no_model_simplification is False:
-    if args.model_selection is True:
-        baseEstimationCommand += ["-M"]
-
-# Default model is stick
-modelNumber = 1
-if args.type.lower() == "zeppelin":
-    modelNumber = 2
-elif args.type.lower() == "tensor":
-    modelNumber = 3
-elif args.type.lower() == "ddi":
-    modelNumber = 4
-
-baseEstimationCommand += ["-c", str(modelNumber)]
-
-dwiImage = args.input
-print("Computing MCM for image " + dwiImage)
-
-dwiImagePrefix = os.path.splitext(dwiImage)[0]
-if os.path.splitext(dwiImage)[1] == '.gz':
-    dwiImagePrefix = os.path.splitext(dwiImagePrefix)[0]
-
-estimationCommandWithInputs = baseEstimationCommand + ["-i", dwiImage, "-b", args.bval, "-g", args.bvec]
-if not (args.mask == ""):
-    estimationCommandWithInputs += ["-m", args.mask]
-
-if (args.no_model_simplification is False) and (args.model_selection is False):
-    # Perform all estimations and model averaging
-    mergeDataFile = open(dwiImagePrefix + "_MCM_List.txt", 'w')
-    mergeDataAICFile = open(dwiImagePrefix + "_MCM_AIC_List.txt", 'w')
-    mergeDataB0File = open(dwiImagePrefix + "_MCM_B0_List.txt", 'w')
-    mergeDataS2File = open(dwiImagePrefix + "_MCM_S2_List.txt", 'w')
-
-    for numCompartments in range(0, args.num_compartments + 1):
-        outputPrefix = dwiImagePrefix + "_MCM_N" + str(numCompartments)
-        estimationCommand = estimationCommandWithInputs + ["-o", outputPrefix + ".mcm", "-a",
-                                                           outputPrefix + "_aic.nrrd", "--out-b0",
-                                                           outputPrefix + "_B0.nrrd", "--out-sig",
-                                                           outputPrefix + "_S2.nrrd", "-n", str(numCompartments)]
-        call(estimationCommand)
-
-        mergeDataFile.write(outputPrefix + ".mcm\n")
-        mergeDataAICFile.write(outputPrefix + "_aic.nrrd\n")
-        mergeDataB0File.write(outputPrefix + "_B0.nrrd\n")
-        mergeDataS2File.write(outputPrefix + "_S2.nrrd\n")
-
-    mergeDataFile.close()
-    mergeDataAICFile.close()
-    mergeDataB0File.close()
-    mergeDataS2File.close()
-
-    averagingCommand = [animaDir + "animaMCMModelAveraging", "-i", dwiImagePrefix + "_MCM_List.txt", "-b",
-                        dwiImagePrefix + "_MCM_B0_List.txt", "-n", dwiImagePrefix + "_MCM_S2_List.txt", "-a",
-                        dwiImagePrefix + "_MCM_AIC_List.txt", "-o",
-                        dwiImagePrefix + "_MCM_avg.mcm", "-O", dwiImagePrefix + "_MCM_B0_avg.nrrd", "-N",
-                        dwiImagePrefix + "_MCM_S2_avg.nrrd", "-m",
-                        dwiImagePrefix + "_MCM_mose_avg.nrrd", "-C"]
-    call(averagingCommand)
-
-else:
-    if args.no_model_simplification is True:
-        outputPrefix = dwiImagePrefix + "_MCM_N" + str(args.num_compartments)
-    else:
-        outputPrefix = dwiImagePrefix + "_MCM_MS" + str(args.num_compartments)
-
-    estimationCommand = estimationCommandWithInputs + ["-o", outputPrefix + ".mcm", "-a", outputPrefix + "_aic.nrrd",
-                                                       "--out-b0", outputPrefix + "_B0.nrrd", "--out-sig",
-                                                       outputPrefix + "_S2.nrrd", "-n", str(args.num_compartments)]
-
-    if args.no_model_simplification is False:
-        estimationCommand += ["--out-mose", outputPrefix + "_mose.nrrd"]
-
-    call(estimationCommand)
+# Tools get explicit thread counts within the cores budget
+runner = CommandRunner(args.trace, getResourceManager(configParser, args.cores))
+if args.trace != "":
+    atexit.register(runner.printSummary)
+
+if args.tiles > 1 and args.mask == "":
+    sys.exit("Tiled estimation requires a computation mask")
+
+if args.oar:
+    args.scheduler = "oar"
+
+if args.tiles > 1 and args.scheduler != "":
+    # One array job estimating each tile, then a job stitching them and averaging models
+    tileFolder = mcmTileFolder(args.input)
+    tileMasks = splitMask(args.mask, args.tiles, tileFolder)
+    print("Mask split into " + str(len(tileMasks)) + " tiles")
+
+    # Local tile jobs share the cores budget
+    numJobCores = runner.resources.maxCores
+    if args.scheduler == "local":
+        numJobCores = max(1, numJobCores // len(tileMasks))
+
+    scriptArguments = ["-i", args.input, "-b", args.bval, "-g", args.bvec, "-m", args.mask, "-t", args.type, "-n",
+                       str(args.num_compartments), "--tiles", str(args.tiles), "-c", str(numJobCores)]
+    if args.hcp:
+        scriptArguments.append("--hcp")
+    if args.no_model_simplification:
+        scriptArguments.append("--no-model-simplification")
+    if args.model_selection:
+        scriptArguments.append("--model-selection")
+    baseCommand = "python " + quote(os.path.realpath(__file__)) + " " + \
+                  " ".join(quote(argument) for argument in scriptArguments)
+
+    scheduler = getScheduler(args.scheduler, tileFolder, runner, runner.resources.maxCores)
+    cdCommand = "cd " + quote(os.getcwd())
+    tileIds = scheduler.submit("mcm-tiles", "tileRun",
+                               [cdCommand, baseCommand + " --tile-index ${" + arrayIndexVariable + "}"], numJobCores,
+                               args.walltime, len(tileMasks))
+    stitchIds = scheduler.submit("mcm-stitch", "stitchRun", [cdCommand, baseCommand + " --stitch-only"], numJobCores,
+                                 args.walltime, 0, tileIds)
+    if args.scheduler != "local":
+        print("Submitted tile job(s) " + ", ".join(tileIds) + " and stitching job " + ", ".join(stitchIds))
+
+    scheduler.wait()
+    sys.exit(0)
+
+estimateMCM(configParser, args.input, args.bval, args.bvec, mask=args.mask, modelType=args.type,
+            numCompartments=args.num_compartments, hcp=args.hcp,
+            modelSimplification=args.no_model_simplification is False, modelSelection=args.model_selection,
+            tiles=args.tiles, tileIndex=args.tile_index, stitchOnly=args.stitch_only, runner=runner)
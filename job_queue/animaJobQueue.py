@@ -0,0 +1,186 @@
+#!/usr/bin/python
+# Warning: works only on unix-like systems, not windows where "python animaJobQueue.py ..." has to be run
+
+import argparse
+import sys
+
+import atexit
+import json
+import os
+import signal
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.config import readConfig
+from anima_scripts.jobqueue import JobQueue, JobQueueServer, JobStore, getQueuePaths, jobKinds, sendRequest
+from anima_scripts.resources import getResourceManager
+from anima_scripts.runner import CommandRunner
+
+try:
+    configParser = readConfig()
+except IOError as error:
+    print(str(error))
+    quit()
+
+parser = argparse.ArgumentParser(
+    prog='animaJobQueue',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="Local job queue: a daemon (serve) runs brain extraction, DWI preprocessing, MCM estimation and MS "
+                "exam jobs submitted to it (submit), highest priority first, within a global cores budget. Jobs are "
+                "kept in an SQLite database and identical submissions are answered with the existing job.\n\n"
+                "Job parameters are the keyword arguments of the anima_scripts functions, e.g.:\n"
+                "  animaJobQueue.py submit brainExtraction brainImage=T1.nrrd\n"
+                "  animaJobQueue.py submit dwiPreprocessing dwiImage=dwi.nii.gz bval=dwi.bval grad=dwi.bvec "
+                "t1=T1.nrrd\n"
+                "  animaJobQueue.py submit mcmEstimation dwiImage=dwi_preprocessed.nrrd bval=dwi.bval "
+                "bvec=dwi_preprocessed.bvec numCompartments=2\n"
+                "  animaJobQueue.py submit msExam reference=flair.nrrd flair=flair.nrrd t1=t1.nrrd t1Gd=t1gd.nrrd")
+parser.add_argument('--socket', type=str, default="",
+                    help="Daemon socket (default: queue-socket entry of the configuration file, or "
+                         "~/.anima/jobqueue.sock)")
+subparsers = parser.add_subparsers(dest='action')
+
+serveParser = subparsers.add_parser('serve', help="Run the daemon")
+serveParser.add_argument('--database', type=str, default="",
+                         help="Jobs database (default: queue-database entry of the configuration file, or "
+                              "~/.anima/jobqueue.db)")
+serveParser.add_argument('-w', '--workers', type=int, default=2, help="Number of jobs run concurrently (default: 2)")
+serveParser.add_argument('-c', '--cores', type=int, default=0,
+                         help="Number of cores shared by all jobs (default: max-cores entry of the configuration file, "
+                              "or all available cores)")
+serveParser.add_argument('-j', '--job-cores', type=int, default=1,
+                         help="Number of cores reserved by jobs submitted without a cores count (default: 1)")
+serveParser.add_argument('-q', '--max-queued', type=int, default=0,
+                         help="Submissions are refused while this many jobs are queued (default: 0, no limit)")
+serveParser.add_argument('--trace', type=str, default="",
+                         help="JSON lines file recording each command run (time, CPU, memory, I/O), summarized at exit")
+
+submitParser = subparsers.add_parser('submit', help="Submit a job")
+submitParser.add_argument('kind', choices=sorted(jobKinds), help="Job kind")
+submitParser.add_argument('parameters', nargs='*',
+                          help="Job parameters as name=value, values being JSON (numbers, true/false, lists) or "
+                               "strings. Existing files are given to the daemon as absolute paths")
+submitParser.add_argument('-p', '--priority', type=int, default=0,
+                          help="Job priority, higher priorities are run first (default: 0)")
+submitParser.add_argument('-c', '--cores', type=int, default=0,
+                          help="Number of cores reserved by the job (default: job-cores of the daemon)")
+
+statusParser = subparsers.add_parser('status', help="Show a job, or the latest jobs")
+statusParser.add_argument('id', type=int, nargs='?', default=None, help="Job id")
+statusParser.add_argument('-s', '--status', type=str, default="", choices=["", "queued", "running", "done", "failed"],
+                          help="Only show jobs with this status")
+statusParser.add_argument('-n', '--limit', type=int, default=20, help="Number of jobs shown (default: 20)")
+
+subparsers.add_parser('stats', help="Show queue depth and throughput")
+
+args = parser.parse_args()
+
+socketPath, databaseFile = getQueuePaths(configParser)
+if args.socket != "":
+    socketPath = args.socket
+
+
+def parseParameter(parameter):
+    if "=" not in parameter:
+        sys.exit("Parameter " + parameter + " is not of the form name=value")
+    name, value = parameter.split("=", 1)
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+
+    # Paths are relative to the submitting process, not to the daemon
+    if not isinstance(value, (bool, int, float, list, dict)) and value is not None and os.path.exists(value):
+        value = os.path.abspath(value)
+    elif isinstance(value, list):
+        value = [os.path.abspath(item) if not isinstance(item, (bool, int, float, list, dict)) and
+                 item is not None and os.path.exists(item) else item for item in value]
+
+    return name, value
+
+
+def printJob(job):
+    line = str(job["id"]).rjust(6) + "  " + job["status"].ljust(8) + " " + job["kind"].ljust(17) + " p" + \
+           str(job["priority"]) + " c" + str(job["cores"])
+    if job["startTime"] is not None:
+        endTime = job["endTime"] if job["endTime"] is not None else time.time()
+        line += "  waited " + str(round(job["startTime"] - job["submitTime"], 1)) + "s, ran " + \
+                str(round(endTime - job["startTime"], 1)) + "s"
+    print(line)
+
+
+def request(content):
+    try:
+        return sendRequest(socketPath, content)
+    except RuntimeError as error:
+        sys.exit(str(error))
+    except (IOError, OSError) as error:
+        sys.exit("Cannot reach the job queue daemon on " + socketPath + " (" + str(error) + "), start it with "
+                 "animaJobQueue.py serve")
+
+
+if args.action == 'serve':
+    if args.database != "":
+        databaseFile = args.database
+    for path in [databaseFile, socketPath]:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+
+    runner = CommandRunner(args.trace, getResourceManager(configParser, args.cores))
+    if args.trace != "":
+        atexit.register(runner.printSummary)
+
+    jobQueue = JobQueue(configParser, JobStore(databaseFile), runner, args.workers, args.job_cores, args.max_queued)
+    try:
+        server = JobQueueServer(socketPath, jobQueue)
+    except IOError as error:
+        sys.exit(str(error))
+
+    def stopServer(signalNumber, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stopServer)
+
+    jobQueue.start()
+    print("Job queue listening on " + socketPath + " (" + str(jobQueue.numWorkers) + " workers, " +
+          str(runner.resources.maxCores) + " cores, database " + databaseFile + ")")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping, running jobs will be queued again at next start")
+    finally:
+        jobQueue.stop()
+        server.server_close()
+
+elif args.action == 'submit':
+    parameters = dict(parseParameter(parameter) for parameter in args.parameters)
+    response = request({"action": "submit", "kind": args.kind, "parameters": parameters, "priority": args.priority,
+                        "cores": args.cores})
+    job = response["job"]
+    if response["duplicate"]:
+        print("Identical job " + str(job["id"]) + " already submitted (" + job["status"] + ")")
+    else:
+        print("Submitted job " + str(job["id"]))
+
+elif args.action == 'status':
+    response = request({"action": "status", "id": args.id, "status": args.status, "limit": args.limit})
+    for job in response["jobs"]:
+        printJob(job)
+        if args.id is not None:
+            print(json.dumps(job["parameters"], indent=2, sort_keys=True))
+            if job["error"]:
+                print(job["error"])
+
+elif args.action == 'stats':
+    stats = request({"action": "stats"})["stats"]
+    print("Queued: " + str(stats["counts"]["queued"]) + " (" + ", ".join(
+        "priority " + priority + ": " + str(count) for priority, count in
+        sorted(stats["queuedByPriority"].items(), key=lambda item: -int(item[0]))) + ")")
+    print("Running: " + str(stats["runningJobs"]) + " job(s) on " + str(stats["reservedCores"]) + " of " +
+          str(stats["maxCores"]) + " cores (" + str(stats["workers"]) + " workers)")
+    print("Done: " + str(stats["counts"]["done"]) + ", failed: " + str(stats["counts"]["failed"]))
+    print("Last hour: " + str(stats["doneInWindow"]) + " done, " + str(stats["failedInWindow"]) + " failed, mean " +
+          "wait " + str(round(stats["meanWaitTime"], 1)) + "s, mean run " + str(round(stats["meanRunTime"], 1)) + "s")
+
+else:
+    parser.print_help()
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+import argparse
+import sys
+
+import atexit
+import csv
+import json
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.brain_extraction import brainExtractionOutputs, extractBrain
+from anima_scripts.cache import getCacheFromConfig
+from anima_scripts.config import readConfig
+from anima_scripts.manifest import Manifest
+from anima_scripts.ms_exam import examOutputs, prepareExam
+from anima_scripts.pipeline import Pipeline
+from anima_scripts.resources import getResourceManager
+from anima_scripts.runner import CommandRunner
+
+try:
+    configParser = readConfig()
+except IOError as error:
+    print(str(error))
+    quit()
+
+parser = argparse.ArgumentParser(
+    prog='animaMSCohortPreparation',
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="Prepares all exams of an MS cohort (see animaMSExamPreparation). The cohort is described by a CSV "
+                "file (with a header line) or a JSON list of objects, with columns / keys patient, timepoint, "
+                "reference, flair, t1, t1gd and optionally t2. The brain mask of each reference image is computed "
+                "once and shared by all exams using it, exams being run concurrently within a global cores budget.")
+
+parser.add_argument('-i', '--input', required=True, help='Cohort description file (.csv or .json)')
+parser.add_argument('-w', '--work-dir', required=True,
+                    help='Work folder: one sub-folder per exam, kept to resume an interrupted cohort run')
+parser.add_argument('-c', '--cores', type=int, default=0,
+                    help="Number of cores shared by all exams (default: max-cores entry of the configuration file, or "
+                         "all available cores)")
+parser.add_argument('-e', '--exam-cores', type=int, default=4, help="Number of cores given to each exam (default: 4)")
+parser.add_argument('-R', '--retries', type=int, default=1,
+                    help="Number of times a failed exam or brain extraction is run again (default: 1)")
+parser.add_argument('-o', '--report', default="",
+                    help="JSON report of the status of each exam (default: cohortReport.json in the work folder)")
+parser.add_argument('--trace', type=str, default="",
+                    help="JSON lines file recording each command run (time, CPU, memory, I/O), summarized at the end")
+
+args = parser.parse_args()
+
+imageKeys = ["reference", "flair", "t1", "t1gd", "t2"]
+
+
+def readCohort(cohortFile):
+    if os.path.splitext(cohortFile)[1].lower() == ".json":
+        with open(cohortFile) as f:
+            exams = json.load(f)
+    else:
+        with open(cohortFile) as f:
+            exams = [dict((key.strip().lower(), value.strip()) for key, value in row.items() if key is not None)
+                     for row in csv.DictReader(f)]
+
+    # Relative paths are taken from the cohort file folder
+    cohortDir = os.path.dirname(os.path.abspath(cohortFile))
+    for exam in exams:
+        for key in ["patient", "timepoint", "reference", "flair", "t1", "t1gd"]:
+            if exam.get(key, "") == "":
+                raise ValueError("Exam " + str(exam) + " has no " + key)
+        exam["patient"] = str(exam["patient"])
+        exam["timepoint"] = str(exam["timepoint"])
+        for key in imageKeys:
+            if exam.get(key, "") != "":
+                exam[key] = os.path.join(cohortDir, exam[key])
+
+    return exams
+
+
+exams = readCohort(args.input)
+
+workDir = os.path.abspath(args.work_dir)
+if not os.path.isdir(workDir):
+    os.makedirs(workDir)
+
+reportFile = args.report
+if reportFile == "":
+    reportFile = os.path.join(workDir, "cohortReport.json")
+
+# Tools get explicit thread counts within the cores budget
+runner = CommandRunner(args.trace, getResourceManager(configParser, args.cores))
+if args.trace != "":
+    atexit.register(runner.printSummary)
+
+# Failed exams do not stop the others, completed ones are skipped when running again in the same work folder
+pipeline = Pipeline(runner, 0, Manifest(os.path.join(workDir, "cohortManifest.json")), keepGoing=True)
+examCores = max(1, min(args.exam_cores, pipeline.maxCores))
+
+# Brain extractions and exams run in this process, sharing the configuration, results cache and cores budget: each
+# step is given its cores, which the tools of its own steps share
+resultCache = getCacheFromConfig(configParser)
+
+# One brain extraction per reference image, however many time points are registered on it
+brainMasks = {}
+for exam in exams:
+    refImage = exam["reference"]
+    if refImage in brainMasks:
+        continue
+
+    stepName = "brainExtraction_" + exam["patient"]
+    if stepName in pipeline.stepsByName:
+        stepName += "_" + str(len(brainMasks))
+
+    brainMasks[refImage] = brainExtractionOutputs(refImage)[0]
+    pipeline.addStep(stepName, function=lambda refImage=refImage: extractBrain(configParser, refImage, runner,
+                                                                               resultCache),
+                     inputs=[refImage], outputs=brainExtractionOutputs(refImage), cores=examCores, priority=1,
+                     retries=args.retries)
+
+examSteps = []
+for exam in exams:
+    examName = exam["patient"] + "_" + exam["timepoint"]
+    images = [exam["flair"], exam["t1"], exam["t1gd"]]
+    if exam.get("t2", "") != "":
+        images.append(exam["t2"])
+
+    def examFunction(exam=exam, examName=examName):
+        prepareExam(configParser, exam["reference"], exam["flair"], exam["t1"], exam["t1gd"], t2=exam.get("t2", ""),
+                    brainMask=brainMasks[exam["reference"]], workDir=os.path.join(workDir, examName), runner=runner,
+                    resultCache=resultCache)
+
+    step = pipeline.addStep("exam_" + examName, function=examFunction,
+                            inputs=[exam["reference"], brainMasks[exam["reference"]]] + images,
+                            outputs=examOutputs(images), cores=examCores, retries=args.retries)
+    examSteps.append((exam, step))
+
+try:
+    pipeline.run()
+except RuntimeError as error:
+    print(str(error))
+finally:
+    report = {"exams": [], "brainExtractions": []}
+    for exam, step in examSteps:
+        report["exams"].append({"patient": exam["patient"], "timepoint": exam["timepoint"], "status": step.status,
+                                "attempts": step.attempts, "wallTime": step.wallTime, "outputs": step.outputs,
+                                "error": step.error})
+    for step in pipeline.steps:
+        if step.name.startswith("brainExtraction_"):
+            report["brainExtractions"].append({"reference": step.inputs[0], "status": step.status,
+                                               "attempts": step.attempts, "wallTime": step.wallTime,
+                                               "error": step.error})
+
+    statusCounts = {}
+    for examReport in report["exams"]:
+        statusCounts[examReport["status"]] = statusCounts.get(examReport["status"], 0) + 1
+    report["summary"] = statusCounts
+
+    with open(reportFile + ".tmp", 'w') as f:
+        json.dump(report, f, indent=2)
+    os.rename(reportFile + ".tmp", reportFile)
+
+print("Cohort summary: " + ", ".join(status + " " + str(count) for status, count in sorted(statusCounts.items())))
+print("Report written to " + reportFile)
+
+if statusCounts.get("failed", 0) + statusCounts.get("blocked", 0) > 0:
+    sys.exit(1)
@@ -3,27 +3,22 @@
 import argparse
 import sys
 
-if sys.version_info[0] > 2:
-    import configparser as ConfParser
-else:
-    import ConfigParser as ConfParser
-
+import atexit
 import os
-import shutil
-import tempfile
-from subprocess import call
 
-configFilePath = os.path.expanduser("~") + "/.anima/config.txt"
-if not os.path.exists(configFilePath):
-    print('Please create a configuration file for Anima python scripts. Refer to the README')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.cache import getCacheFromConfig
+from anima_scripts.config import readConfig
+from anima_scripts.ms_exam import prepareExam
+from anima_scripts.resources import getResourceManager
+from anima_scripts.runner import CommandRunner
+
+try:
+    configParser = readConfig()
+except IOError as error:
+    print(str(error))
     quit()
 
-configParser = ConfParser.RawConfigParser()
-configParser.read(configFilePath)
-
-animaDir = configParser.get("anima-scripts", 'anima')
-animaScriptsDir = configParser.get("anima-scripts", 'anima-scripts-public-root')
-
 parser = argparse.ArgumentParser(
     prog='animaMSExamPreparation',
     formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -35,52 +30,22 @@ parser.add_argument('-f', '--flair', required=True, help='Path to the MS patient
 parser.add_argument('-t', '--t1', required=True, help='Path to the MS patient T1 image to register')
 parser.add_argument('-g', '--t1-gd', required=True, help='Path to the MS patient T1-Gd image to register')
 parser.add_argument('-T', '--t2', default="", help='Path to the MS patient T2 image to register')
+parser.add_argument('-m', '--brain-mask', default="",
+                    help='Brain mask of the reference image if already computed (e.g. shared by all time points)')
+parser.add_argument('-c', '--cores', type=int, default=0,
+                    help="Number of cores shared by the concurrent modality chains (default: max-cores entry of the "
+                         "configuration file, or all available cores)")
+parser.add_argument('-w', '--work-dir', default="",
+                    help='Persistent work folder: intermediate files are kept there and a new run resumes from them')
+parser.add_argument('--trace', type=str, default="",
+                    help="JSON lines file recording each command run (time, CPU, memory, I/O), summarized at the end")
 
 args = parser.parse_args()
-tmpFolder = tempfile.mkdtemp()
-
-# Anima commands
-animaPyramidalBMRegistration = os.path.join(animaDir, "animaPyramidalBMRegistration")
-animaMaskImage = os.path.join(animaDir, "animaMaskImage")
-animaNLMeans = os.path.join(animaDir, "animaNLMeans")
-animaN4BiasCorrection = os.path.join(animaDir, "animaN4BiasCorrection")
-animaBrainExtractionScript = os.path.join(animaScriptsDir, "brain_extraction", "animaAtlasBasedBrainExtraction.py")
-
-refImage = args.reference
-listImages = [args.flair, args.t1, args.t1_gd]
-if args.t2 != "":
-    listImages.append(args.t2)
-
-brainExtractionCommand = ["python", animaBrainExtractionScript, refImage]
-call(brainExtractionCommand)
-
-refImagePrefix = os.path.splitext(refImage)[0]
-if os.path.splitext(refImage)[1] == '.gz':
-    refImagePrefix = os.path.splitext(refImagePrefix)[0]
-
-brainMask = refImagePrefix + "_brainMask.nrrd"
-
-# Main loop
-for i in range(0, len(listImages)):
-    inputPrefix = os.path.splitext(listImages[i])[0]
-    if os.path.splitext(listImages[i])[1] == '.gz':
-        inputPrefix = os.path.splitext(inputPrefix)[0]
-
-    registeredDataFile = os.path.join(tmpFolder, "SecondImage_registered.nrrd")
-    rigidRegistrationCommand = [animaPyramidalBMRegistration, "-r", refImage, "-m", listImages[i], "-o",
-                                registeredDataFile, "-p", "4", "-l", "1"]
-    call(rigidRegistrationCommand)
-
-    unbiasedSecondImage = os.path.join(tmpFolder, "SecondImage_unbiased.nrrd")
-    biasCorrectionCommand = [animaN4BiasCorrection, "-i", registeredDataFile, "-o", unbiasedSecondImage, "-B", "0.3"]
-    call(biasCorrectionCommand)
-
-    nlmSecondImage = os.path.join(tmpFolder, "SecondImage_unbiased_nlm.nrrd")
-    nlmCommand = [animaNLMeans, "-i", unbiasedSecondImage, "-o", nlmSecondImage, "-n", "3"]
-    call(nlmCommand)
 
-    outputPreprocessedFile = inputPrefix + "_preprocessed.nrrd"
-    secondMaskCommand = [animaMaskImage, "-i", nlmSecondImage, "-m", brainMask, "-o", outputPreprocessedFile]
-    call(secondMaskCommand)
+# Tools get explicit thread counts within the cores budget
+runner = CommandRunner(args.trace, getResourceManager(configParser, args.cores))
+if args.trace != "":
+    atexit.register(runner.printSummary)
 
-shutil.rmtree(tmpFolder)
+prepareExam(configParser, args.reference, args.flair, args.t1, args.t1_gd, t2=args.t2, brainMask=args.brain_mask,
+            workDir=args.work_dir, runner=runner, resultCache=getCacheFromConfig(configParser))
@@ -0,0 +1,90 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.cache import ResultCache, computeKey
+
+
+def writeFile(filePath, content):
+    with open(filePath, 'w') as f:
+        f.write(content)
+
+
+def readFile(filePath):
+    with open(filePath) as f:
+        return f.read()
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpFolder = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.tmpFolder, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpFolder)
+
+    def path(self, fileName):
+        return os.path.join(self.tmpFolder, fileName)
+
+    def testKey(self):
+        writeFile(self.path("a"), "a")
+        writeFile(self.path("b"), "b")
+        key = computeKey([self.path("a"), self.path("b")], ["-p", "4"])
+
+        self.assertEqual(key, computeKey([self.path("a"), self.path("b")], ["-p", "4"]))
+        self.assertNotEqual(key, computeKey([self.path("b"), self.path("a")], ["-p", "4"]))
+        self.assertNotEqual(key, computeKey([self.path("a"), self.path("b")], ["-p", "5"]))
+
+        # Content, not names nor times, is hashed
+        writeFile(self.path("c"), "a")
+        self.assertEqual(key, computeKey([self.path("c"), self.path("b")], ["-p", "4"]))
+        writeFile(self.path("a"), "changed")
+        self.assertNotEqual(key, computeKey([self.path("a"), self.path("b")], ["-p", "4"]))
+
+    def testStoreAndFetch(self):
+        writeFile(self.path("mask"), "mask")
+        writeFile(self.path("masked"), "masked")
+        self.assertFalse(self.cache.fetch("0123", {"mask": self.path("fetched")}))
+
+        self.cache.store("0123", {"mask": self.path("mask"), "masked": self.path("masked")})
+        self.assertTrue(self.cache.fetch("0123", {"mask": self.path("fetched")}))
+        self.assertEqual(readFile(self.path("fetched")), "mask")
+
+        # Results missing from the entry
+        self.assertFalse(self.cache.fetch("0123", {"transform": self.path("transform")}))
+        self.assertFalse(os.path.exists(self.path("transform")))
+
+        # Entries are never overwritten
+        writeFile(self.path("mask"), "other mask")
+        self.cache.store("0123", {"mask": self.path("mask")})
+        self.assertTrue(self.cache.fetch("0123", {"mask": self.path("fetched")}))
+        self.assertEqual(readFile(self.path("fetched")), "mask")
+
+    def testLeastRecentlyUsedEviction(self):
+        writeFile(self.path("result"), "x" * 1000)
+        for key in ["aa01", "bb02", "cc03"]:
+            self.cache.store(key, {"result": self.path("result")})
+        for lastUse, key in enumerate(["aa01", "bb02", "cc03"], 1):
+            os.utime(os.path.join(self.cache.entryFolder(key), "entry.json"), (lastUse, lastUse))
+
+        # Fetching marks the oldest entry as recently used
+        self.assertTrue(self.cache.fetch("aa01", {"result": self.path("fetched")}))
+
+        self.cache.maxSize = 2500
+        self.cache.evict()
+        self.assertTrue(os.path.isdir(self.cache.entryFolder("aa01")))
+        self.assertFalse(os.path.isdir(self.cache.entryFolder("bb02")))
+        self.assertTrue(os.path.isdir(self.cache.entryFolder("cc03")))
+
+        self.cache.maxSize = 100
+        self.cache.evict()
+        self.assertFalse(os.path.isdir(self.cache.entryFolder("aa01")))
+        self.assertFalse(os.path.isdir(self.cache.entryFolder("cc03")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import gzip
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.images import compressImage, imagePrefix, readImage, readImageHeader, writeImage
+
+
+def niftiOneHeader(shape, spacing, voxOffset, endian="<"):
+    # float32 image with a 348 bytes header, data at voxOffset (extension bytes in between)
+    header = bytearray(voxOffset)
+    struct.pack_into(endian + "i", header, 0, 348)
+    dims = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    struct.pack_into(endian + "8h", header, 40, *dims)
+    struct.pack_into(endian + "2h", header, 70, 16, 32)
+    struct.pack_into(endian + "8f", header, 76, *([1.0] + list(spacing) + [1.0] * (7 - len(spacing))))
+    struct.pack_into(endian + "f", header, 108, float(voxOffset))
+    struct.pack_into(endian + "2f", header, 112, 1.0, 0.0)
+    header[344:348] = b"n+1\0"
+    if voxOffset > 352:
+        header[352:voxOffset] = b"\x01" * (voxOffset - 352)
+    return header
+
+
+def niftiTwoHeader(shape, spacing, voxOffset):
+    # float32 image with a 540 bytes header, data at voxOffset
+    header = bytearray(voxOffset)
+    struct.pack_into("<i", header, 0, 540)
+    header[4:12] = b"n+2\0\r\n\x1a\n"
+    struct.pack_into("<2h", header, 12, 16, 32)
+    dims = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    struct.pack_into("<8q", header, 16, *dims)
+    struct.pack_into("<8d", header, 104, *([1.0] + list(spacing) + [1.0] * (7 - len(spacing))))
+    struct.pack_into("<q", header, 168, voxOffset)
+    struct.pack_into("<2d", header, 176, 1.0, 0.0)
+    return header
+
+
+class ImagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpFolder = tempfile.mkdtemp()
+        self.data = np.arange(2 * 3 * 4, dtype=np.float32).reshape((2, 3, 4), order='F')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpFolder)
+
+    def path(self, fileName):
+        return os.path.join(self.tmpFolder, fileName)
+
+    def writeNifti(self, fileName, header, endian="<"):
+        content = bytes(header) + self.data.astype(np.dtype(np.float32).newbyteorder(endian)).tobytes(order='F')
+        if fileName.endswith(".gz"):
+            with gzip.open(fileName, 'wb') as f:
+                f.write(content)
+        else:
+            with open(fileName, 'wb') as f:
+                f.write(content)
+
+    def testNiftiOneOffset(self):
+        for fileName in ["image.nii", "image.nii.gz"]:
+            # Header followed by the 4 bytes extension flag and an extension
+            self.writeNifti(self.path(fileName), niftiOneHeader((2, 3, 4), (1.0, 2.0, 3.0), 368))
+            header, data = readImage(self.path(fileName))
+
+            self.assertEqual(header.fileFormat, "nifti")
+            self.assertEqual(header.fields["header size"], 348)
+            self.assertEqual(header.fields["vox offset"], 368)
+            self.assertEqual(header.dimensions, (2, 3, 4))
+            self.assertEqual(header.spacing, (1.0, 2.0, 3.0))
+            self.assertEqual(header.pixelType, "float32")
+            np.testing.assert_array_equal(data, self.data)
+
+    def testNiftiOneBigEndian(self):
+        self.writeNifti(self.path("image.nii"), niftiOneHeader((2, 3, 4), (1.0, 1.0, 1.0), 352, ">"), ">")
+        header, data = readImage(self.path("image.nii"))
+
+        self.assertEqual(header.fields["endian"], ">")
+        self.assertEqual(header.fields["vox offset"], 352)
+        np.testing.assert_array_equal(data, self.data)
+
+    def testNiftiTwoOffset(self):
+        self.writeNifti(self.path("image.nii"), niftiTwoHeader((2, 3, 4), (1.5, 1.5, 2.0), 544))
+        header, data = readImage(self.path("image.nii"))
+
+        self.assertEqual(header.fields["header size"], 540)
+        self.assertEqual(header.fields["vox offset"], 544)
+        self.assertEqual(header.dimensions, (2, 3, 4))
+        self.assertEqual(header.spacing, (1.5, 1.5, 2.0))
+        np.testing.assert_array_equal(data, self.data)
+
+    def testNiftiWriteKeepsHeader(self):
+        self.writeNifti(self.path("image.nii"), niftiOneHeader((2, 3, 4), (1.0, 2.0, 3.0), 368))
+        header = readImageHeader(self.path("image.nii"))
+        writeImage(self.path("output.nii.gz"), (self.data * 2).astype(np.int16), header)
+        outputHeader, outputData = readImage(self.path("output.nii.gz"))
+
+        self.assertEqual(outputHeader.fields["vox offset"], 368)
+        self.assertEqual(outputHeader.pixelType, "int16")
+        self.assertEqual(outputHeader.spacing, (1.0, 2.0, 3.0))
+        np.testing.assert_array_equal(outputData, self.data * 2)
+
+    def testNrrdHeader(self):
+        headerText = ("NRRD0004\n# comment\ntype: float\ndimension: 4\nspace: left-posterior-superior\n"
+                      "sizes: 3 2 3 4\nspace directions: none (2,0,0) (0,2,0) (0,0,2.5)\n"
+                      "kinds: vector domain domain domain\nendian: little\nencoding: raw\n"
+                      "space origin: (1,2,3)\nmeasurement frame: (1,0,0) (0,1,0) (0,0,1)\n"
+                      "modality:=DWMRI\n\n").encode('latin-1')
+        vectorData = np.arange(3 * 2 * 3 * 4, dtype=np.float32).reshape((3, 2, 3, 4), order='F')
+        with open(self.path("image.nrrd"), 'wb') as f:
+            f.write(headerText)
+            f.write(vectorData.tobytes(order='F'))
+
+        header, data = readImage(self.path("image.nrrd"))
+        self.assertEqual(header.fields["header size"], len(headerText))
+        self.assertEqual(header.fields["spatial axes"], [1, 2, 3])
+        self.assertEqual(header.fields["keyvalue:modality"], "DWMRI")
+        self.assertEqual(header.dimensions, (2, 3, 4))
+        self.assertEqual(header.spacing, (2.0, 2.0, 2.5))
+        self.assertEqual(header.origin, (1.0, 2.0, 3.0))
+        self.assertEqual(header.numVolumes, 3)
+        np.testing.assert_array_equal(data, vectorData)
+
+        # Compressed copy with the same header information
+        compressImage(self.path("image.nrrd"), self.path("compressed.nrrd"))
+        compressedHeader, compressedData = readImage(self.path("compressed.nrrd"))
+        self.assertEqual(compressedHeader.fields["encoding"], "gzip")
+        self.assertEqual(compressedHeader.fields["keyvalue:modality"], "DWMRI")
+        self.assertEqual(compressedHeader.spacing, header.spacing)
+        np.testing.assert_array_equal(compressedData, vectorData)
+
+        writeImage(self.path("raw.nrrd"), vectorData, header, 0)
+        self.assertEqual(readImageHeader(self.path("raw.nrrd")).fields["encoding"], "raw")
+
+    def testImagePrefix(self):
+        self.assertEqual(imagePrefix("folder/image.nii.gz"), "folder/image")
+        self.assertEqual(imagePrefix("folder/image.nrrd"), "folder/image")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.manifest import Manifest, fileFingerprint, manifestVersion
+
+
+def writeFile(filePath, content):
+    with open(filePath, 'w') as f:
+        f.write(content)
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpFolder = tempfile.mkdtemp()
+        self.manifestFile = os.path.join(self.tmpFolder, "manifest.json")
+        self.inputFile = os.path.join(self.tmpFolder, "input.txt")
+        self.outputFile = os.path.join(self.tmpFolder, "output.txt")
+        writeFile(self.inputFile, "input")
+        writeFile(self.outputFile, "output")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpFolder)
+
+    def readContent(self):
+        with open(self.manifestFile) as f:
+            return json.load(f)
+
+    def testRecordAndReload(self):
+        manifest = Manifest(self.manifestFile)
+        self.assertFalse(manifest.isUpToDate("step", ["tool", "-i", "input"], [self.inputFile], [self.outputFile]))
+        manifest.record("step", ["tool", "-i", "input"], [self.inputFile], [self.outputFile])
+
+        # Versioned format even without released files
+        content = self.readContent()
+        self.assertEqual(content["version"], manifestVersion)
+        self.assertEqual(content["released"], {})
+        self.assertEqual(content["steps"]["step"]["inputs"], {self.inputFile: fileFingerprint(self.inputFile)})
+
+        manifest = Manifest(self.manifestFile)
+        self.assertTrue(manifest.isUpToDate("step", ["tool", "-i", "input"], [self.inputFile], [self.outputFile]))
+        self.assertFalse(manifest.isUpToDate("step", ["tool", "-i", "other"], [self.inputFile], [self.outputFile]))
+        self.assertFalse(manifest.isUpToDate("step", ["tool", "-i", "input"], [self.inputFile], []))
+        self.assertFalse(manifest.isUpToDate("other", ["tool", "-i", "input"], [self.inputFile], [self.outputFile]))
+
+        writeFile(self.inputFile, "changed")
+        self.assertFalse(manifest.isUpToDate("step", ["tool", "-i", "input"], [self.inputFile], [self.outputFile]))
+
+    def testReleasedFiles(self):
+        manifest = Manifest(self.manifestFile)
+        manifest.record("step", ["tool"], [self.inputFile], [self.outputFile])
+        outputFingerprint = fileFingerprint(self.outputFile)
+        manifest.release(self.outputFile)
+        os.remove(self.outputFile)
+
+        content = self.readContent()
+        self.assertEqual(content["released"], {self.outputFile: outputFingerprint})
+
+        # Deleted intermediates keep the fingerprint of their last producer
+        manifest = Manifest(self.manifestFile)
+        self.assertTrue(manifest.isReleased(self.outputFile))
+        self.assertEqual(manifest.fingerprint(self.outputFile), outputFingerprint)
+        self.assertTrue(manifest.isUpToDate("step", ["tool"], [self.inputFile], [self.outputFile]))
+
+        # Produced again, it is not released anymore
+        writeFile(self.outputFile, "output")
+        manifest.record("step", ["tool"], [self.inputFile], [self.outputFile])
+        self.assertFalse(manifest.isReleased(self.outputFile))
+        self.assertEqual(self.readContent()["released"], {})
+
+    def testOtherFormats(self):
+        # Only the current version is read, anything else giving an empty manifest
+        entry = {"signature": ["tool"], "inputs": {}, "outputs": {}}
+        for content in [{"step": entry}, {"steps": {"step": entry}, "released": {}},
+                        {"version": manifestVersion + 1, "steps": {"step": entry}, "released": {}},
+                        {"version": manifestVersion, "steps": {"step": entry}}, ["step"]]:
+            with open(self.manifestFile, 'w') as f:
+                json.dump(content, f)
+
+            manifest = Manifest(self.manifestFile)
+            self.assertEqual(manifest.entries, {})
+            self.assertEqual(manifest.released, {})
+            self.assertFalse(manifest.isUpToDate("step", ["tool"], [], []))
+
+    def testUnreadableManifest(self):
+        writeFile(self.manifestFile, "{not json")
+        manifest = Manifest(self.manifestFile)
+        self.assertEqual(manifest.entries, {})
+        self.assertFalse(manifest.isUpToDate("step", ["tool"], [], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
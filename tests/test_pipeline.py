@@ -0,0 +1,191 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.manifest import Manifest
+from anima_scripts.pipeline import Pipeline
+
+
+def writeFile(filePath, content):
+    with open(filePath, 'w') as f:
+        f.write(content)
+
+
+def readFile(filePath):
+    with open(filePath) as f:
+        return f.read()
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpFolder = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpFolder)
+
+    def path(self, fileName):
+        return os.path.join(self.tmpFolder, fileName)
+
+    def copyStep(self, name, inputFile, outputFile):
+        # Function step copying inputFile to outputFile, recording its calls
+        def copy():
+            self.calls.append(name)
+            writeFile(outputFile, readFile(inputFile) + name)
+
+        return copy
+
+    def testDependenciesFromFiles(self):
+        pipeline = Pipeline(None, 2)
+        producer = pipeline.addStep("producer", function=lambda: None, outputs=[self.path("a")])
+        reader = pipeline.addStep("reader", function=lambda: None, inputs=[self.path("a")])
+        overwriter = pipeline.addStep("overwriter", function=lambda: None, outputs=[self.path("a")])
+        independent = pipeline.addStep("independent", function=lambda: None, after=["reader"])
+        pipeline.resolveDependencies()
+
+        self.assertEqual(producer.dependencies, set())
+        self.assertEqual(reader.dependencies, set([producer]))
+        self.assertEqual(overwriter.dependencies, set([producer, reader]))
+        self.assertEqual(independent.dependencies, set([reader]))
+
+    def testDuplicateStepName(self):
+        pipeline = Pipeline(None, 1)
+        pipeline.addStep("step", function=lambda: None)
+        self.assertRaises(ValueError, pipeline.addStep, "step", function=lambda: None)
+
+    def testRunOrder(self):
+        writeFile(self.path("input"), "")
+        pipeline = Pipeline(None, 2)
+        # Declared in order, the second reading the output of the first
+        pipeline.addStep("first", function=self.copyStep("first", self.path("input"), self.path("a")),
+                         inputs=[self.path("input")], outputs=[self.path("a")])
+        pipeline.addStep("second", function=self.copyStep("second", self.path("a"), self.path("b")),
+                         inputs=[self.path("a")], outputs=[self.path("b")])
+        pipeline.run()
+
+        self.assertEqual(self.calls, ["first", "second"])
+        self.assertEqual(readFile(self.path("b")), "firstsecond")
+
+    def testFailureStopsPipeline(self):
+        def fail():
+            raise IOError("failure")
+
+        pipeline = Pipeline(None, 1)
+        pipeline.addStep("failing", function=fail, outputs=[self.path("a")], priority=1)
+        pipeline.addStep("dependent", function=lambda: self.calls.append("dependent"), inputs=[self.path("a")])
+        pipeline.addStep("independent", function=lambda: self.calls.append("independent"))
+
+        self.assertRaises(RuntimeError, pipeline.run)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(pipeline.stepsByName["failing"].status, "failed")
+        self.assertEqual(pipeline.stepsByName["dependent"].status, "blocked")
+
+    def testKeepGoing(self):
+        def fail():
+            raise IOError("failure")
+
+        pipeline = Pipeline(None, 1, keepGoing=True)
+        pipeline.addStep("failing", function=fail, outputs=[self.path("a")], priority=1)
+        pipeline.addStep("dependent", function=lambda: self.calls.append("dependent"), inputs=[self.path("a")])
+        pipeline.addStep("independent", function=lambda: self.calls.append("independent"))
+
+        self.assertRaises(RuntimeError, pipeline.run)
+        self.assertEqual(self.calls, ["independent"])
+        self.assertEqual(pipeline.stepsByName["failing"].status, "failed")
+        self.assertIn("failure", pipeline.stepsByName["failing"].error)
+        self.assertEqual(pipeline.stepsByName["dependent"].status, "blocked")
+        self.assertEqual(pipeline.stepsByName["independent"].status, "done")
+
+    def testRetries(self):
+        def flaky():
+            self.calls.append("flaky")
+            if len(self.calls) < 3:
+                raise IOError("failure")
+
+        pipeline = Pipeline(None, 1)
+        step = pipeline.addStep("flaky", function=flaky, retries=2)
+        pipeline.run()
+
+        self.assertEqual(step.attempts, 3)
+        self.assertEqual(step.status, "done")
+
+    def testRetriesExhausted(self):
+        def failing():
+            self.calls.append("failing")
+            raise IOError("failure")
+
+        pipeline = Pipeline(None, 1)
+        step = pipeline.addStep("failing", function=failing, retries=1)
+
+        self.assertRaises(RuntimeError, pipeline.run)
+        self.assertEqual(step.attempts, 2)
+        self.assertEqual(step.status, "failed")
+
+    def buildChain(self, manifest, key=()):
+        pipeline = Pipeline(None, 1, manifest)
+        pipeline.addStep("first", function=self.copyStep("first", self.path("input"), self.path("a")),
+                         inputs=[self.path("input")], outputs=[self.path("a")])
+        pipeline.addStep("second", function=self.copyStep("second", self.path("a"), self.path("b")),
+                         inputs=[self.path("a")], outputs=[self.path("b")], key=key)
+        return pipeline
+
+    def testManifestSkipsUpToDateSteps(self):
+        writeFile(self.path("input"), "")
+        manifestFile = self.path("manifest.json")
+        self.buildChain(Manifest(manifestFile)).run()
+        self.assertEqual(self.calls, ["first", "second"])
+
+        pipeline = self.buildChain(Manifest(manifestFile))
+        pipeline.run()
+        self.assertEqual(self.calls, ["first", "second"])
+        self.assertEqual([step.status for step in pipeline.steps], ["skipped", "skipped"])
+
+        # A modified output is recomputed, its consumer being skipped when it is recomputed identically
+        writeFile(self.path("a"), "modified")
+        self.buildChain(Manifest(manifestFile)).run()
+        self.assertEqual(self.calls, ["first", "second", "first"])
+
+        writeFile(self.path("input"), "changed")
+        self.buildChain(Manifest(manifestFile)).run()
+        self.assertEqual(self.calls, ["first", "second", "first", "first", "second"])
+
+    def testStepKeyChange(self):
+        writeFile(self.path("input"), "")
+        manifestFile = self.path("manifest.json")
+        self.buildChain(Manifest(manifestFile), ["options"]).run()
+        self.buildChain(Manifest(manifestFile), ["other options"]).run()
+        self.assertEqual(self.calls, ["first", "second", "second"])
+
+    def testReleasedInputsRerunProducers(self):
+        writeFile(self.path("input"), "")
+        manifestFile = self.path("manifest.json")
+        self.buildChain(Manifest(manifestFile)).run()
+
+        # Intermediate deleted by a scratch manager
+        manifest = Manifest(manifestFile)
+        manifest.release(self.path("a"))
+        os.remove(self.path("a"))
+
+        # Nothing to run while its consumer is up to date
+        pipeline = self.buildChain(Manifest(manifestFile))
+        pipeline.resolveDependencies()
+        pipeline.planReruns()
+        self.assertEqual([step.forceRun for step in pipeline.steps], [False, False])
+
+        # Its consumer running again needs its producer to run again
+        pipeline = self.buildChain(Manifest(manifestFile), ["new key"])
+        pipeline.resolveDependencies()
+        pipeline.planReruns()
+        self.assertEqual([step.forceRun for step in pipeline.steps], [True, False])
+
+        pipeline.run()
+        self.assertEqual(self.calls, ["first", "second", "first", "second"])
+        self.assertTrue(os.path.exists(self.path("a")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+from anima_scripts.images import readImage, readImageHeader, writeImage
+from anima_scripts.tiling import computeSlabs, splitMask, stitchImages
+
+
+def writeNrrd(fileName, data, vectorSize=0):
+    # Raw NRRD image, with a first vector axis if vectorSize > 0
+    sizes = ([vectorSize] if vectorSize > 0 else []) + list(data.shape[-3:])
+    directions = (["none"] if vectorSize > 0 else []) + ["(1,0,0)", "(0,1,0)", "(0,0,1)"]
+    with open(fileName, 'wb') as f:
+        f.write(("NRRD0004\ntype: " + {"float32": "float", "uint8": "uchar"}[data.dtype.name] + "\ndimension: " +
+                 str(len(sizes)) + "\nspace: left-posterior-superior\nsizes: " + " ".join(str(size) for size in sizes) +
+                 "\nspace directions: " + " ".join(directions) + "\nendian: little\nencoding: raw\n"
+                 "space origin: (0,0,0)\n\n").encode('latin-1'))
+        f.write(data.tobytes(order='F'))
+
+
+class TilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpFolder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpFolder)
+
+    def path(self, fileName):
+        return os.path.join(self.tmpFolder, fileName)
+
+    def testBalancedSlabs(self):
+        mask = np.zeros((4, 4, 10), dtype=bool)
+        mask[:, :, 2:8] = True
+        slabs = computeSlabs(mask, 3)
+
+        self.assertEqual(len(slabs), 3)
+        self.assertEqual(slabs[0][0], 0)
+        self.assertEqual(slabs[-1][1], 10)
+        for (start, end), (nextStart, nextEnd) in zip(slabs[:-1], slabs[1:]):
+            self.assertEqual(end, nextStart)
+        self.assertEqual([int(mask[:, :, start:end].sum()) for start, end in slabs], [32, 32, 32])
+
+    def testFewSlices(self):
+        mask = np.zeros((4, 4, 10), dtype=bool)
+        mask[:, :, 3] = True
+        mask[:, :, 6] = True
+        slabs = computeSlabs(mask, 5)
+
+        # At most one slab per non empty slice, each holding some voxels
+        self.assertEqual(len(slabs), 2)
+        self.assertTrue(all(mask[:, :, start:end].sum() > 0 for start, end in slabs))
+
+        self.assertEqual(computeSlabs(np.zeros((4, 4, 10), dtype=bool), 3), [(0, 10)])
+
+    def testSplitAndStitch(self):
+        mask = np.zeros((5, 4, 9), dtype=np.uint8)
+        mask[1:4, :, 1:8] = 1
+        writeNrrd(self.path("mask.nrrd"), mask)
+
+        tileFolder = self.path("tiles")
+        tileMasks = splitMask(self.path("mask.nrrd"), 3, tileFolder, compressionLevel=0)
+        self.assertEqual(len(tileMasks), 3)
+        self.assertEqual(readImageHeader(tileMasks[0]).fields["encoding"], "raw")
+
+        tileMaskData = [readImage(tileMask)[1] for tileMask in tileMasks]
+        np.testing.assert_array_equal(sum(tileMaskData), mask)
+
+        # Vector images estimated on each tile only, stitched back
+        image = np.random.RandomState(0).rand(3, 5, 4, 9).astype(np.float32)
+        writeNrrd(self.path("image.nrrd"), image, 3)
+        header = readImageHeader(self.path("image.nrrd"))
+        tileFiles = []
+        for index, tileMask in enumerate(tileMaskData):
+            tileFiles.append(self.path("tile" + str(index) + ".nrrd"))
+            writeImage(tileFiles[-1], image * tileMask[np.newaxis], header)
+
+        stitchImages(tileFiles, tileMasks, self.path("stitched.nrrd"))
+        stitchedHeader, stitched = readImage(self.path("stitched.nrrd"))
+
+        self.assertEqual(stitchedHeader.fields["encoding"], "gzip")
+        np.testing.assert_array_equal(stitched, image * mask[np.newaxis])
+
+    def testSplitOnlyRequestedTiles(self):
+        mask = np.ones((3, 3, 6), dtype=np.uint8)
+        writeNrrd(self.path("mask.nrrd"), mask)
+
+        tileMasks = splitMask(self.path("mask.nrrd"), 3, self.path("tiles"), [2])
+        self.assertEqual(len(tileMasks), 3)
+        self.assertEqual([os.path.exists(tileMask) for tileMask in tileMasks], [False, True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()